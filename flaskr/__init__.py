@@ -10,7 +10,93 @@ def create_app(test_config=None):
         SECRET_KEY='dev',
         DATABASE=os.path.join(app.instance_path, "flaskr.sqlite"),
         UPLOAD_DIR=os.path.join(app.instance_path, "uploads"),
-        POSTS_PER_PAGE=5
+        # "flat" to store all uploads directly in UPLOAD_DIR or "sharded" to
+        # spread them over subdirectories, which keeps directories small.
+        # Run migrate-uploads after changing it.
+        UPLOAD_DIR_LAYOUT="flat",
+        # Maximum size of a request in bytes, larger ones are rejected early
+        MAX_CONTENT_LENGTH=16 * 1024 * 1024,
+        # Maximum size of an uploaded image in bytes
+        IMAGE_MAX_SIZE=8 * 1024 * 1024,
+        # Bytes of an uploaded image read and hashed at once
+        IMAGE_UPLOAD_CHUNK_SIZE=64 * 1024,
+        # Threads generating downscaled and WebP variants of uploaded images
+        # (requires Pillow) or 0 to disable variants
+        IMAGE_VARIANT_WORKERS=2,
+        # Widths of the downscaled variants and quality of the WebP variants
+        IMAGE_VARIANT_WIDTHS=(320, 960),
+        IMAGE_WEBP_QUALITY=80,
+        # Seconds for which browsers and proxies keep original images without
+        # asking
+        IMAGE_CACHE_MAX_AGE=365 * 24 * 60 * 60,
+        # None to send images from the app, "x-sendfile" (Apache, lighttpd)
+        # or "x-accel-redirect" (nginx) to let the front proxy send them.
+        # X-Accel-Redirect URIs start with IMAGE_ACCEL_REDIRECT_PREFIX, which
+        # has to be an internal location of the proxy aliased to UPLOAD_DIR.
+        IMAGE_SENDFILE=None,
+        IMAGE_ACCEL_REDIRECT_PREFIX="/protected-uploads/",
+        POSTS_PER_PAGE=5,
+        # Number of comments shown at once on the detail page of a post
+        COMMENTS_PER_PAGE=20,
+        # Maximum number of posts in one page of the RSS feed
+        RSS_FEED_ITEMS=20,
+        # Extras of markdown2 used to render the posts. Run rerender-posts
+        # after changing them.
+        MARKDOWN_EXTRAS=(),
+        # Maximum number of rendered post bodies cached per process
+        MARKDOWN_RENDER_CACHE_SIZE=256,
+        # Feed formats ("rss", "json") of which the first page is published as
+        # a static snapshot into FEED_SNAPSHOT_DIR on every change of a post
+        FEED_SNAPSHOT_FORMATS=("rss",),
+        FEED_SNAPSHOT_DIR=os.path.join(app.instance_path, "feeds"),
+        # "offset" for numbered pages or "keyset" for cursor based pages
+        PAGINATION_MODE="offset",
+        # Maximum number of open database connections per process
+        DB_POOL_SIZE=8,
+        # Seconds to wait for a free database connection
+        DB_POOL_TIMEOUT=10,
+        # PRAGMAs applied once to each new database connection
+        DB_PRAGMAS={
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -16 * 1024,  # Negative values are in KiB
+            "temp_store": "MEMORY",
+        },
+        # Read through query only connections and send all writes through
+        # one writer thread, which commits them in batches.
+        DB_SPLIT_READ_WRITE=False,
+        # Maximum number of writes committed in one transaction by the writer
+        DB_WRITER_BATCH_SIZE=64,
+        # Seconds to wait for the writer to commit a write
+        DB_WRITER_TIMEOUT=10,
+        # Cache of full responses for anonymous users: None to disable it,
+        # "memory" for an in-process LRU cache (only invalidated correctly
+        # when the app runs in a single process) or "directory" for a cache
+        # shared by all processes through RESPONSE_CACHE_DIR. Both keep at
+        # most RESPONSE_CACHE_MAX_ENTRIES entries.
+        RESPONSE_CACHE_BACKEND=None,
+        RESPONSE_CACHE_MAX_ENTRIES=1024,
+        RESPONSE_CACHE_DIR=os.path.join(app.instance_path, "response_cache"),
+        # Seconds after which a cached response expires in any case
+        RESPONSE_CACHE_TIMEOUT=300,
+        # Method and cost of password hashes as understood by werkzeug's
+        # generate_password_hash. Existing hashes are replaced on login.
+        # Run benchmark-password-hashing to compare the costs.
+        PASSWORD_HASH_METHOD="scrypt:32768:8:1",
+        # Number of passwords hashed at the same time per process and number
+        # of further passwords which may wait for them
+        PASSWORD_HASH_WORKERS=2,
+        PASSWORD_HASH_MAX_PENDING=16,
+        # Logged in users cached per process and seconds for which they are
+        # cached. 0 entries disable the cache.
+        USER_CACHE_MAX_ENTRIES=1024,
+        USER_CACHE_TIMEOUT=60,
+        # Maximum number of rendered template fragments cached per process or
+        # 0 to disable the fragment cache
+        FRAGMENT_CACHE_MAX_ENTRIES=2048,
+        # Part of all ETags. Change it when a deployment changes the pages.
+        ETAG_SALT=""
     )
 
     if test_config is None:
@@ -39,7 +125,23 @@ def create_app(test_config=None):
     from . import db
     db.init_app(app)
 
+    from . import migrations
+    migrations.init_app(app)
+
+    from . import cache
+    cache.init_app(app)
+
+    from . import rendering
+    rendering.init_app(app)
+
+    from . import fragments
+    fragments.init_app(app)
+
+    from . import passwords
+    passwords.init_app(app)
+
     from . import auth
+    auth.init_app(app)
     app.register_blueprint(auth.bp)
 
     from . import blog
@@ -53,15 +155,31 @@ def create_app(test_config=None):
     app.register_blueprint(likes.bp)
 
     from . import tags
+    tags.init_app(app)
     app.register_blueprint(tags.bp)
 
     from . import search
+    search.init_app(app)
     app.register_blueprint(search.bp)
 
+    from . import uploads
+    uploads.init_app(app)
+
+    from . import variants
+    variants.init_app(app)
+
     from . import images
+    images.init_app(app)
     app.register_blueprint(images.bp)
 
     from . import rss
+    rss.init_app(app)
     app.register_blueprint(rss.bp)
 
+    from . import transfer
+    transfer.init_app(app)
+
+    from . import benchmark
+    benchmark.init_app(app)
+
     return app
@@ -1,11 +1,19 @@
 import functools
+import time
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for
+    Blueprint, current_app, flash, g, redirect, render_template, request,
+    session, url_for
 )
-from werkzeug.security import check_password_hash, generate_password_hash
 
-from flaskr.db import get_db
+from flaskr.cache import LRUCache
+from flaskr.db import execute_write, get_db
+from flaskr.passwords import (
+    PasswordHashingBusyError, hash_password, password_needs_rehash,
+    verify_password
+)
+
+BUSY_MESSAGE = "Too many users are logging in. Please try again."
 
 bp = Blueprint("auth", __name__, url_prefix="/auth")
 
@@ -28,12 +36,16 @@ def register():
             error = "User {} is already registered".format(username)
 
         if error is None:
-            db.execute(
-                "INSERT INTO user (username, password) VALUES (?, ?)",
-                (username, generate_password_hash(password))
-            )
-            db.commit()
-            return redirect(url_for("auth.login"))
+            try:
+                pwhash = hash_password(password)
+            except PasswordHashingBusyError:
+                error = BUSY_MESSAGE
+            else:
+                execute_write(
+                    "INSERT INTO user (username, password) VALUES (?, ?)",
+                    (username, pwhash)
+                )
+                return redirect(url_for("auth.login"))
 
         flash(error)
 
@@ -49,13 +61,23 @@ def login():
         error = None
 
         user = db.execute(
-            "SELECT * FROM user WHERE username = ?", (username,)
+            "SELECT id, password FROM user WHERE username = ?", (username,)
         ).fetchone()
 
-        if user is None:
-            error = "Incorrect user name."
-        elif not check_password_hash(user["password"], password):
-            error = "Incorrect password."
+        try:
+            if user is None:
+                error = "Incorrect user name."
+            elif not verify_password(user["password"], password):
+                error = "Incorrect password."
+            elif password_needs_rehash(user["password"]):
+                # The hash parameters have changed since the password was set
+                execute_write(
+                    "UPDATE user SET password = ? WHERE id = ?",
+                    (hash_password(password), user["id"])
+                )
+                invalidate_user(user["id"])
+        except PasswordHashingBusyError:
+            error = BUSY_MESSAGE
 
         if error is None:
             session.clear()
@@ -67,17 +89,76 @@ def login():
     return render_template("auth/login.html")
 
 
+def skip_user_lookup(view):
+    """
+    Decorator for views which do not use the logged in user
+
+    The user is not looked up before these views are called and `g.user` is
+    None, even if a user is logged in.
+    """
+    view.skip_user_lookup = True
+    return view
+
+
+def get_user_cache():
+    """Return the cache of logged in users of the current app or None"""
+    return current_app.extensions.get("flaskr_user_cache")
+
+
+def get_user(user_id):
+    """
+    Get the user with the given id as needed by the views and templates
+
+    Only the columns which are used for every request are selected. Users are
+    cached per process for `USER_CACHE_TIMEOUT` seconds, which bounds how long
+    other processes can see outdated users.
+
+    :param user_id: Id of the user.
+    :type user_id: int
+
+    :returns: The user or None if there is no user with the id.
+    :rtype: sqlite3.Row or None
+    """
+    cache = get_user_cache()
+    if cache is not None:
+        entry = cache.get(user_id)
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+
+    user = get_db().execute(
+        "SELECT id, username FROM user WHERE id = ?", (user_id,)
+    ).fetchone()
+    if cache is not None and user is not None:
+        cache.set(
+            user_id,
+            (time.time() + current_app.config["USER_CACHE_TIMEOUT"], user))
+    return user
+
+
+def invalidate_user(user_id):
+    """Remove the user from the cache. Call this after changing a user."""
+    cache = get_user_cache()
+    if cache is not None:
+        cache.delete(user_id)
+
+
 # This function is run before any view function is called, no matter the URL.
 @bp.before_app_request
 def load_logged_in_user():
     user_id = session.get("user_id")
+    view = current_app.view_functions.get(request.endpoint)
 
-    if user_id is None:
+    if (user_id is None or request.endpoint == "static"
+            or getattr(view, "skip_user_lookup", False)):
         g.user = None
     else:
-        g.user = get_db().execute(
-            "SELECT * FROM user WHERE id = ?", (user_id,)
-        ).fetchone()
+        g.user = get_user(user_id)
+
+
+def init_app(app):
+    max_entries = app.config["USER_CACHE_MAX_ENTRIES"]
+    app.extensions["flaskr_user_cache"] = (
+        LRUCache(max_entries=max_entries) if max_entries else None)
 
 
 @bp.route("/logout")
@@ -0,0 +1,532 @@
+"""
+Benchmarks of the hot endpoints on synthetic data
+
+`flask generate-data` fills an empty database with a configurable number of
+users, posts, tags, comments and likes. `flask benchmark` then requests each
+scenario, e.g. the index or liking a post, many times and reports the latency
+percentiles and the throughput as JSON.
+
+The requests are sent through the Flask test client by default, which measures
+the app alone. With `--server` the app is served by werkzeug's threaded WSGI
+server and requested by concurrent clients over HTTP. `--url` requests an app
+served elsewhere, e.g. by the production WSGI server.
+
+A result can be stored and passed as `--baseline` to a later run. Scenarios
+which got slower than the baseline by more than the threshold are reported
+and make the command fail, so that it can run in CI.
+"""
+import http.cookiejar
+import itertools
+import json
+import platform
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from flaskr.db import get_db
+from flaskr.passwords import hash_password
+from flaskr.transfer import import_records
+
+WORDS = (
+    "alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel",
+    "india", "juliett", "kilo", "lima", "mike", "november", "oscar", "papa",
+    "quebec", "romeo", "sierra", "tango", "uniform", "victor", "whiskey",
+    "xray", "yankee", "zulu",
+)
+
+BENCHMARK_PASSWORD = "password"
+
+
+def generate_records(users=100, posts=1000, tags=50, comments=10000,
+                     likes=5000, password_hash="", seed=0):
+    """
+    Generate random content as records of `flaskr.transfer`
+
+    The users are named "user1", "user2" and so on and share the password
+    hash. The first user likes no posts, so that it can like any post during
+    a benchmark. The same seed generates the same records.
+
+    :param password_hash: Hash of the password of all users.
+    :type password_hash: str
+
+    :param seed: Seed of the random choices.
+    :type seed: int
+
+    :raises ValueError: If there are more likes than pairs of posts and users
+                        other than the first.
+
+    :returns: Iterator of records.
+    :rtype: iterator
+    """
+    if likes and likes > (users - 1) * posts:
+        raise ValueError("There can be at most one like per user and post.")
+    if (posts or comments) and not users:
+        raise ValueError("Posts and comments need users.")
+    rng = random.Random(seed)
+    tag_names = ["tag{}".format(i) for i in range(1, tags + 1)]
+
+    def created(i):
+        return time.strftime(
+            "%Y-%m-%d %H:%M:%S", time.gmtime(1514764800 + i * 60))
+
+    for i in range(1, users + 1):
+        yield {"type": "user", "id": i, "username": "user{}".format(i),
+               "password": password_hash}
+    for i in range(1, posts + 1):
+        paragraphs = (" ".join(rng.choices(WORDS, k=30)) for _ in range(3))
+        yield {
+            "type": "post",
+            "id": i,
+            "author_id": rng.randint(1, users),
+            "created": created(i),
+            "title": " ".join(rng.choices(WORDS, k=4)),
+            "body": "\n\n".join(paragraphs),
+            "tags": rng.sample(tag_names, k=min(len(tag_names), 3)),
+        }
+    for i in range(1, comments + 1):
+        yield {
+            "type": "comment",
+            "id": i,
+            "post_id": rng.randint(1, posts),
+            "author_id": rng.randint(1, users),
+            "created": created(posts + i),
+            "body": " ".join(rng.choices(WORDS, k=12)),
+        }
+    for i in range(likes):
+        yield {
+            "type": "like",
+            "user_id": i % (users - 1) + 2,
+            "post_id": i // (users - 1) + 1,
+            "created": created(posts + comments + i),
+        }
+
+
+def _get_counts():
+    db = get_db()
+    return {table: db.execute(
+        "SELECT COUNT() FROM {}".format(table)).fetchone()[0]
+        for table in ("user", "post", "tag", "comment", "like")}
+
+
+# The scenarios generate the requests of one client from its random generator,
+# the row counts and the ids of the posts the client requests. Concurrent
+# clients request different posts, so that a like of one client is not taken
+# back by another.
+
+def index_requests(rng, counts, post_ids):
+    while True:
+        yield "GET", "/", None
+
+
+def detail_requests(rng, counts, post_ids):
+    while True:
+        yield "GET", "/{}/detail".format(rng.choice(post_ids)), None
+
+
+def search_requests(rng, counts, post_ids):
+    while True:
+        yield "GET", "/search/?q={}".format(rng.choice(WORDS)), None
+
+
+def tags_requests(rng, counts, post_ids):
+    while True:
+        yield "GET", "/tags/tag{}".format(rng.randint(1, counts["tag"])), None
+
+
+def feed_requests(rng, counts, post_ids):
+    while True:
+        yield "GET", "/feed.rss", None
+
+
+def comment_requests(rng, counts, post_ids):
+    while True:
+        yield "POST", "/comments/create", {
+            "post_id": rng.choice(post_ids),
+            "body": " ".join(rng.choices(WORDS, k=12))}
+
+
+def like_requests(rng, counts, post_ids):
+    """Like a post and take the like back"""
+    while True:
+        data = {"post_id": rng.choice(post_ids)}
+        yield "POST", "/likes/create", data
+        yield "POST", "/likes/delete", data
+
+
+# Name, function generating the requests and whether a login is needed
+SCENARIOS = (
+    ("index", index_requests, False),
+    ("detail", detail_requests, False),
+    ("search", search_requests, False),
+    ("tags", tags_requests, False),
+    ("feed", feed_requests, False),
+    ("comment", comment_requests, True),
+    ("like", like_requests, True),
+)
+
+
+def percentile(sorted_values, percent):
+    """Return the percentile of sorted values by the nearest-rank method"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    """
+    Summarize the latencies of the requests of a scenario
+
+    :param latencies: Seconds each request took.
+    :type latencies: list
+
+    :param errors: Number of requests answered with an error.
+    :type errors: int
+
+    :param elapsed: Seconds all requests took together.
+    :type elapsed: float
+
+    :returns: Number of requests and errors, the throughput in requests per
+              second and the latencies in milliseconds.
+    :rtype: dict
+    """
+    latencies = sorted(latency * 1000 for latency in latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed if elapsed else None,
+        "latency_ms": {
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else None,
+        },
+    }
+
+
+class FlaskClientDriver(object):
+    """Sends the requests one after another through the Flask test client"""
+
+    concurrency = 1
+
+    def __init__(self, app):
+        self.app = app
+
+    def run(self, requests, count, login):
+        """
+        Send requests and measure them
+
+        :param requests: Iterator of the requests of each client.
+        :type requests: list
+
+        :param count: Total number of requests to send.
+        :type count: int
+
+        :param login: Form data of the login or None.
+        :type login: dict or None
+
+        :returns: Latencies, number of errors and elapsed seconds.
+        :rtype: tuple
+        """
+        requests, = requests
+        client = self.app.test_client()
+        if login:
+            client.post("/auth/login", data=login)
+        latencies = []
+        errors = 0
+        start = time.perf_counter()
+        for method, path, data in itertools.islice(requests, count):
+            request_start = time.perf_counter()
+            response = client.open(path, method=method, data=data)
+            # Streamed responses are only generated when they are read
+            response.get_data()
+            latencies.append(time.perf_counter() - request_start)
+            errors += response.status_code >= 400
+        return latencies, errors, time.perf_counter() - start
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class _NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPDriver(object):
+    """Sends the requests over HTTP from concurrent clients"""
+
+    def __init__(self, url, concurrency=1):
+        self.url = url.rstrip("/")
+        self.concurrency = concurrency
+
+    def _open(self, opener, method, path, data):
+        if data is not None:
+            data = urllib.parse.urlencode(data).encode()
+        request = urllib.request.Request(
+            self.url + path, data=data, method=method)
+        try:
+            with opener.open(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+    def _run_client(self, requests, count, login):
+        opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            _NoRedirectHandler())
+        if login:
+            self._open(opener, "POST", "/auth/login", login)
+        latencies = []
+        errors = 0
+        for method, path, data in itertools.islice(requests, count):
+            request_start = time.perf_counter()
+            status = self._open(opener, method, path, data)
+            latencies.append(time.perf_counter() - request_start)
+            errors += status >= 400
+        return latencies, errors
+
+    def run(self, requests, count, login):
+        """Send requests like `FlaskClientDriver.run` from each client"""
+        per_client = [count // self.concurrency] * self.concurrency
+        for i in range(count % self.concurrency):
+            per_client[i] += 1
+        start = time.perf_counter()
+        # Each client sends the requests of its own generator, because the
+        # generators are not thread-safe and the order within them matters
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            results = list(pool.map(
+                lambda args: self._run_client(*args, login),
+                zip(requests, per_client)))
+        elapsed = time.perf_counter() - start
+        latencies = [latency for result in results for latency in result[0]]
+        return latencies, sum(result[1] for result in results), elapsed
+
+
+def run_benchmark(driver, counts, scenarios=None, requests=200, warmup=10,
+                  username="user1", password=BENCHMARK_PASSWORD, seed=0):
+    """
+    Request the scenarios and summarize the measurements
+
+    :param driver: Driver sending the requests.
+    :type driver: FlaskClientDriver or HTTPDriver
+
+    :param counts: Number of rows per table, which the requests are chosen
+                   from.
+    :type counts: dict
+
+    :param scenarios: Names of the scenarios to run. Defaults to all.
+    :type scenarios: list or None
+
+    :param requests: Number of measured requests per scenario.
+    :type requests: int
+
+    :param warmup: Number of requests per scenario sent before measuring.
+    :type warmup: int
+
+    :raises ValueError: If there are more clients than posts.
+
+    :returns: Summary of each scenario, see `summarize`.
+    :rtype: dict
+    """
+    clients = driver.concurrency
+    if counts["post"] < clients:
+        raise ValueError("Every client needs a post of its own.")
+    login = {"username": username, "password": password}
+    results = {}
+    for name, make_requests, needs_login in SCENARIOS:
+        if scenarios and name not in scenarios:
+            continue
+        request_iters = [
+            make_requests(random.Random(seed + client), counts,
+                          range(client + 1, counts["post"] + 1, clients))
+            for client in range(clients)]
+        if warmup:
+            driver.run(request_iters, warmup, login if needs_login else None)
+        results[name] = summarize(*driver.run(
+            request_iters, requests, login if needs_login else None))
+    return results
+
+
+def compare_results(results, baseline, threshold=1.2):
+    """
+    Compare the scenarios of a benchmark result with a baseline
+
+    A scenario regressed if its median or 99th percentile latency grew or its
+    throughput shrank by more than the threshold factor.
+
+    :param results: Scenarios of the current result.
+    :type results: dict
+
+    :param baseline: Scenarios of the baseline result.
+    :type baseline: dict
+
+    :param threshold: Factor by which a measurement may get worse.
+    :type threshold: float
+
+    :returns: Tuples of the scenario, the measurement, its baseline and
+              current value and the factor by which it got worse.
+    :rtype: list
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ("p50", "p99"):
+            before = baseline[name]["latency_ms"][metric]
+            after = result["latency_ms"][metric]
+            if before and after is not None and after / before > threshold:
+                regressions.append(
+                    (name, metric, before, after, after / before))
+        before = baseline[name]["throughput"]
+        after = result["throughput"]
+        if before and after and before / after > threshold:
+            regressions.append(
+                (name, "throughput", before, after, before / after))
+    return regressions
+
+
+@click.command("generate-data")
+@click.option("--users", type=click.IntRange(min=0), default=100,
+              show_default=True)
+@click.option("--posts", type=click.IntRange(min=0), default=1000,
+              show_default=True)
+@click.option("--tags", type=click.IntRange(min=0), default=50,
+              show_default=True)
+@click.option("--comments", type=click.IntRange(min=0), default=10000,
+              show_default=True)
+@click.option("--likes", type=click.IntRange(min=0), default=5000,
+              show_default=True)
+@click.option("--seed", type=int, default=0, show_default=True)
+@click.option("--output", type=click.File("w"), default=None,
+              help="Write NDJSON for import-data instead of importing it.")
+@with_appcontext
+def generate_data_command(users, posts, tags, comments, likes, seed, output):
+    """Fill the empty database with random content for benchmarks"""
+    records = generate_records(
+        users=users, posts=posts, tags=tags, comments=comments, likes=likes,
+        password_hash=hash_password(BENCHMARK_PASSWORD), seed=seed)
+    try:
+        if output is not None:
+            for record in records:
+                output.write(json.dumps(record) + "\n")
+        else:
+            import_records(records)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo("Generated {} users, {} posts, {} tags, {} comments and {}"
+               " likes. All users have the password {!r}.".format(
+                   users, posts, tags, comments, likes, BENCHMARK_PASSWORD),
+               err=output is not None)
+
+
+@click.command("benchmark")
+@click.option("--scenario", "scenarios", multiple=True,
+              type=click.Choice([scenario[0] for scenario in SCENARIOS]),
+              help="Scenario to run, may be repeated. Defaults to all.")
+@click.option("--requests", type=click.IntRange(min=1), default=200,
+              show_default=True, help="Measured requests per scenario.")
+@click.option("--warmup", type=click.IntRange(min=0), default=10,
+              show_default=True, help="Unmeasured requests per scenario.")
+@click.option("--server", is_flag=True,
+              help="Serve the app with werkzeug's threaded server.")
+@click.option("--url", default=None,
+              help="Request the app served at this URL.")
+@click.option("--concurrency", type=click.IntRange(min=1), default=4,
+              show_default=True,
+              help="Concurrent clients with --server or --url.")
+@click.option("--username", default="user1", show_default=True)
+@click.option("--password", default=BENCHMARK_PASSWORD, show_default=True)
+@click.option("--output", type=click.File("w"), default="-",
+              show_default=True, help="File to write the JSON result to.")
+@click.option("--baseline", type=click.File("r"), default=None,
+              help="JSON result of an earlier run to compare with.")
+@click.option("--threshold", type=click.FloatRange(min=1), default=1.2,
+              show_default=True,
+              help="Factor by which a measurement may get worse.")
+@with_appcontext
+def benchmark_command(scenarios, requests, warmup, server, url, concurrency,
+                      username, password, output, baseline, threshold):
+    """Measure latency and throughput of the hot endpoints"""
+    app = current_app._get_current_object()
+    counts = _get_counts()
+    if not counts["post"] or not counts["tag"]:
+        raise click.ClickException(
+            "There is nothing to request, run generate-data first.")
+
+    http_server = None
+    if server:
+        http_server = make_server(
+            "127.0.0.1", 0, app, threaded=True,
+            request_handler=_QuietRequestHandler)
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}".format(http_server.server_port)
+    if url is not None:
+        driver = HTTPDriver(url, concurrency=concurrency)
+        mode = "server" if server else "url"
+    else:
+        driver = FlaskClientDriver(app)
+        mode = "test-client"
+
+    try:
+        results = run_benchmark(
+            driver, counts, scenarios=scenarios, requests=requests,
+            warmup=warmup, username=username, password=password)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    finally:
+        if http_server is not None:
+            http_server.shutdown()
+
+    meta = {
+        "mode": mode,
+        "concurrency": driver.concurrency,
+        "requests": requests,
+        "counts": counts,
+        "python": platform.python_version(),
+    }
+    output.write(json.dumps(
+        {"meta": meta, "scenarios": results}, indent=2) + "\n")
+
+    for name, result in results.items():
+        latency = result["latency_ms"]
+        click.echo(
+            "{:<8} p50 {:8.2f} ms  p99 {:8.2f} ms  {:8.1f} req/s"
+            "  {} errors".format(
+                name, latency["p50"], latency["p99"], result["throughput"],
+                result["errors"]), err=True)
+
+    if baseline is not None:
+        baseline = json.load(baseline)
+        for key in ("mode", "concurrency"):
+            if baseline["meta"].get(key) != meta[key]:
+                click.echo("The baseline differs in its {}: {}".format(
+                    key, baseline["meta"].get(key)), err=True)
+        regressions = compare_results(
+            results, baseline["scenarios"], threshold=threshold)
+        for name, metric, before, after, factor in regressions:
+            click.echo(
+                "Regression of {} {}: {:.2f} -> {:.2f} ({:.2f}x)".format(
+                    name, metric, before, after, factor), err=True)
+        if regressions:
+            raise click.ClickException("{} regressions against the baseline."
+                                       .format(len(regressions)))
+
+
+def init_app(app):
+    app.cli.add_command(generate_data_command)
+    app.cli.add_command(benchmark_command)
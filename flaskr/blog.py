@@ -1,18 +1,28 @@
+import json
+from collections import namedtuple
+from datetime import datetime
+from types import MappingProxyType
+
 from flask import (
     Blueprint, flash, g, redirect, render_template, request, url_for,
     current_app
 )
-from markdown2 import markdown
 from markupsafe import escape
 from werkzeug.exceptions import abort
 
 from flaskr.auth import login_required
-from flaskr.comments import get_comments_for_post
-from flaskr.db import get_db
-from flaskr.images import (save_image_and_create_or_update_post_association,
+from flaskr.cache import (
+    bump_content_versions, cached_response, conditional_response,
+    invalidate_cached_responses
+)
+from flaskr.db import get_db, run_write
+from flaskr.images import (ImageTooLargeError, receive_image,
+                           associate_received_image_with_post,
                            delete_post_image_associations_of_post)
-from flaskr.likes import get_users_liking_post
-from flaskr.pagination import Pagination
+from flaskr.pagination import (
+    PAGINATION_ARGS, KeysetPagination, get_pagination)
+from flaskr.rendering import render_markdown
+from flaskr.rss import publish_feeds
 from flaskr.tags import update_tag_associations_for_post
 
 bp = Blueprint("blog", __name__)
@@ -21,16 +31,13 @@ bp = Blueprint("blog", __name__)
 def get_post(id, check_author=True):
     post = get_db().execute(
         "SELECT p.id, p.title, p.body, p.body_html,  p.created, p.author_id,"
-        "  u.username, GROUP_CONCAT(t.name, ' ') AS tag_string,"
-        " pi.filename AS image_filename"
+        "  u.username, p.tag_string, p.like_count,"
+        "  pi.filename AS image_filename"
         " FROM post p"
         " JOIN user u ON p.author_id = u.id"
         # LEFT JOIN makes the existence of values in the right table optional!
-        " LEFT JOIN post_tag pt ON p.id = pt.post_id"
-        " LEFT JOIN tag t ON pt.tag_id = t.id"
         " LEFT JOIN post_image pi ON p.id = pi.post_id"
-        " WHERE p.id = ?"
-        " GROUP BY p.id",
+        " WHERE p.id = ?",
         (id,)
     ).fetchone()
 
@@ -43,47 +50,115 @@ def get_post(id, check_author=True):
     return post
 
 
+PostDetail = namedtuple(
+    "PostDetail", ("post", "comments", "comments_pagination", "liked"))
+
+
+def load_post_detail(id, user_id=None):
+    """
+    Load everything shown on the detail page of a post with one statement
+
+    The post with its author, tags, image and like count, whether the user
+    likes it and the first page of its comments are selected together. The
+    comments are aggregated into a JSON array by a correlated subquery.
+
+    :param id: Id of the post.
+    :type id: int
+
+    :param user_id: Id of the user viewing the post or None if anonymous.
+    :type user_id: int or None
+
+    :returns: Immutable detail data of the post. The comments are a tuple of
+              read-only mappings.
+    :rtype: PostDetail
+    """
+    comments_pagination = KeysetPagination(
+        items_per_page=current_app.config["COMMENTS_PER_PAGE"])
+    limit, limit_params = comments_pagination.limit_clause()
+    row = get_db().execute(
+        "SELECT p.id, p.title, p.body, p.body_html, p.created, p.author_id,"
+        "  u.username, p.tag_string, p.like_count,"
+        "  pi.filename AS image_filename,"
+        "  EXISTS (SELECT 1 FROM like l"
+        "   WHERE l.user_id = ? AND l.post_id = p.id) AS liked,"
+        "  (SELECT json_group_array(json_object("
+        "    'id', c.id, 'body', c.body, 'created', c.created,"
+        "    'post_id', c.post_id, 'author_id', c.author_id,"
+        "    'username', c.username))"
+        "   FROM (SELECT c.id, c.body, c.created, c.post_id, c.author_id,"
+        "     cu.username"
+        "    FROM comment c JOIN user cu ON c.author_id = cu.id"
+        "    WHERE c.post_id = p.id"
+        "    ORDER BY " + comments_pagination.order_by(
+            "c.id", descending=False) +
+        "    " + limit + ") c) AS comments_json"
+        " FROM post p"
+        " JOIN user u ON p.author_id = u.id"
+        " LEFT JOIN post_image pi ON p.id = pi.post_id"
+        " WHERE p.id = ?",
+        (user_id,) + limit_params + (id,)
+    ).fetchone()
+
+    if row is None:
+        abort(404, "Post id {} does not exist.".format(id))
+
+    comments = []
+    for comment in json.loads(row["comments_json"]):
+        comment["created"] = datetime.fromisoformat(comment["created"])
+        comments.append(MappingProxyType(comment))
+    # The order of aggregated rows is not guaranteed
+    comments.sort(key=lambda comment: comment["id"])
+    comments = tuple(comments_pagination.paginate(comments))
+    return PostDetail(
+        post=row,
+        comments=comments,
+        comments_pagination=comments_pagination,
+        liked=bool(row["liked"]))
+
+
 @bp.route("/")
+@conditional_response("posts")
+@cached_response("posts", query_args=PAGINATION_ARGS)
 def index():
     db = get_db()
-    post_count = db.execute("SELECT COUNT() FROM post").fetchone()[0]
-    page = int(request.args.get("page", default="1"))
-    pagination = Pagination(
-        total_items=post_count,
-        items_per_page=current_app.config["POSTS_PER_PAGE"],
-        current_page=page)
+    pagination = get_pagination(
+        count_items=lambda: db.execute(
+            "SELECT COUNT() FROM post").fetchone()[0])
+    condition, condition_params = pagination.key_condition("p.id")
+    limit, limit_params = pagination.limit_clause()
     posts = db.execute(
         "SELECT p.id, p.title, p.body, p.body_html, p.created, p.author_id,"
-        " u.username, GROUP_CONCAT(t.name, ' ') AS tag_string"
+        " u.username, p.tag_string,"
+        " (SELECT pi.filename FROM post_image pi WHERE pi.post_id = p.id)"
+        "  AS image_filename"
         " FROM post p"
         " JOIN user u ON p.author_id = u.id"
-        # LEFT JOIN makes the existence of values in the right table optional!
-        " LEFT JOIN post_tag pt ON p.id = pt.post_id"
-        " LEFT JOIN tag t ON pt.tag_id = t.id"
-        " GROUP BY p.id"
-        " ORDER BY p.id DESC"
-        " LIMIT ? OFFSET ?",
-        (pagination.items_per_page, pagination.item_offset)
+        " WHERE " + condition +
+        " ORDER BY " + pagination.order_by("p.id") +
+        " " + limit,
+        condition_params + limit_params
     ).fetchall()
+    posts = pagination.paginate(posts)
     return render_template(
         "blog/index.html", posts=posts, pagination=pagination)
 
 
 @bp.route("/<int:id>/detail", methods=("GET",))
+@conditional_response("post:{id}")
+@cached_response("post:{id}")
 def detail(id):
     """
     Display a detail page with only one post
     """
-    post = get_post(id, check_author=False)
-    comments = get_comments_for_post(post_id=id)
-    users_likes = get_users_liking_post(post_id=id)
-
-    # Post existence is already checked in get_post
+    # Further comments are loaded from the comments blueprint
+    detail = load_post_detail(
+        id, user_id=g.user["id"] if g.user is not None else None)
     return render_template(
         "blog/detail.html",
-        post=post,
-        comments=comments,
-        users_likes=users_likes
+        post=detail.post,
+        comments=detail.comments,
+        comments_pagination=detail.comments_pagination,
+        liked=detail.liked
     )
 
 
@@ -105,24 +180,37 @@ def create_post(title, body, author_id):
     """
     # Escaping html in user input
     body = escape(body)
-    db = get_db()
-    cursor = db.execute(
-        "INSERT INTO post (title, body, body_html,author_id)"
-        " VALUES (?, ?, ?, ?)",
-        (title, body, markdown(body), author_id)
-    )
-    db.commit()
-    return cursor.lastrowid
+    body_html, render_options = render_markdown(body)
+    def create(db):
+        cursor = db.execute(
+            "INSERT INTO post"
+            " (title, body, body_html, render_options, author_id)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (title, body, body_html, render_options, author_id)
+        )
+        bump_content_versions(db, dependencies)
+        return cursor.lastrowid
+
+    dependencies = ["posts"]
+    post_id = run_write(create)
+    invalidate_cached_responses(*dependencies)
+    return post_id
 
 
 def update_post(id, title, body):
-    db = get_db()
-    db.execute(
-        "UPDATE post SET title = ?, body = ?, body_html = ?"
-        " WHERE id = ?",
-        (title, body, markdown(body), id)
-    )
-    db.commit()
+    body_html, render_options = render_markdown(body)
+    def update(db):
+        db.execute(
+            "UPDATE post"
+            " SET title = ?, body = ?, body_html = ?, render_options = ?"
+            " WHERE id = ?",
+            (title, body, body_html, render_options, id)
+        )
+        bump_content_versions(db, dependencies)
+
+    dependencies = ["posts", "post:{}".format(id)]
+    run_write(update)
+    invalidate_cached_responses(*dependencies)
 
 
 def create_or_update_post(id=None):
@@ -141,6 +229,14 @@ def create_or_update_post(id=None):
         if not title:
             error = "Title is required."
 
+        received_image = None
+        if error is None and image:
+            # The image is checked before anything is written
+            try:
+                received_image = receive_image(image)
+            except ImageTooLargeError as e:
+                error = str(e)
+
         if error is not None:
             flash(error)
         else:
@@ -151,11 +247,14 @@ def create_or_update_post(id=None):
             update_tag_associations_for_post(tag_string=tag_string, post_id=id)
             if delete_image:
                 delete_post_image_associations_of_post(post_id=id)
-            if image:
-                save_image_and_create_or_update_post_association(
-                    image=image,
+            if received_image:
+                temp_path, filename = received_image
+                associate_received_image_with_post(
+                    temp_path=temp_path,
+                    filename=filename,
                     post_id=id
                 )
+            publish_feeds()
             return redirect(url_for("blog.index"))
 
     return render_template("blog/create_or_update.html", post=post)
@@ -177,8 +276,15 @@ def update(id):
 @login_required
 def delete(id):
     get_post(id)  # This is to check  existence and ownership
-    db = get_db()
-    db.execute("DELETE FROM post WHERE id = ?", (id, ))
-    db.commit()
+    delete_post_image_associations_of_post(post_id=id)
+
+    def delete_post(db):
+        db.execute("DELETE FROM post WHERE id = ?", (id, ))
+        bump_content_versions(db, dependencies)
+
+    dependencies = ["posts", "post:{}".format(id)]
+    run_write(delete_post)
+    invalidate_cached_responses(*dependencies)
     update_tag_associations_for_post(tag_string="", post_id=id)
+    publish_feeds()
     return redirect(url_for("blog.index"))
@@ -0,0 +1,494 @@
+import functools
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+import click
+from flask import current_app, g, request, session
+from flask.cli import with_appcontext
+
+from flaskr.db import get_db, run_write
+
+
+class LRUCache(object):
+    """Thread-safe in-process cache evicting the least recently used entry"""
+
+    def __init__(self, max_entries):
+        """
+        Initialize LRUCache object
+
+        :param max_entries: Maximum number of entries kept in the cache.
+        :type max_entries: int
+        """
+        super(LRUCache, self).__init__()
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value stored for the key or None"""
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return None
+            return self._entries[key]
+
+    def set(self, key, value):
+        """Store the value for the key"""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Remove the value stored for the key, if there is one"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove all values"""
+        with self._lock:
+            self._entries.clear()
+
+
+class DirectoryCache(object):
+    """
+    Cache storing each entry as a file in a directory
+
+    The directory can be shared by several processes of the app. Entries are
+    written to a temporary file first and then moved into place, so that
+    readers never see a partially written entry. Only the app itself should be
+    able to write to the directory, because entries are pickled.
+
+    The number of entries is bounded. Every tenth of `max_entries` writes of a
+    process, the directory is checked and the oldest written entries beyond
+    the limit are removed.
+    """
+
+    def __init__(self, path, max_entries=1024):
+        """
+        Initialize DirectoryCache object
+
+        :param path: Directory in which the entries are stored. It is created
+                     if it does not exist.
+        :type path: str
+
+        :param max_entries: Maximum number of entries kept in the directory.
+        :type max_entries: int
+        """
+        super(DirectoryCache, self).__init__()
+        self.path = path
+        self.max_entries = max_entries
+        self._check_interval = max(1, max_entries // 10)
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(
+            self.path, hashlib.sha256(key.encode("utf8")).hexdigest())
+
+    def get(self, key):
+        """Return the value stored for the key or None"""
+        try:
+            with open(self._path(key), mode="rb") as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, value):
+        """Store the value for the key"""
+        fd, temp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, mode="wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        with self._lock:
+            self._writes += 1
+            check = self._writes % self._check_interval == 0
+        if check:
+            self.evict()
+
+    def evict(self):
+        """Remove the oldest written entries beyond `max_entries`"""
+        entries = []
+        with os.scandir(self.path) as scanned:
+            for entry in scanned:
+                # Temporary files are written right now or left by a crash
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        for _, path in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def delete(self, key):
+        """Remove the value stored for the key, if there is one"""
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """Remove all values"""
+        for entry in os.scandir(self.path):
+            if entry.is_file():
+                os.remove(entry.path)
+
+
+class ResponseCache(object):
+    """
+    Cache of full responses which is invalidated by dependencies
+
+    Each cached response depends on named dependencies, e.g. "posts" or
+    "post:1". Every dependency has a version, which is a random token stored
+    in the backend. A response is stored together with the versions of its
+    dependencies at the time it was rendered. Invalidating a dependency
+    replaces its version, which makes all responses stored with the old
+    version stale. This works the same way for all processes sharing a
+    backend.
+    """
+
+    def __init__(self, backend, timeout):
+        """
+        Initialize ResponseCache object
+
+        :param backend: Backend storing the responses and versions, e.g. an
+                        `LRUCache` or a `DirectoryCache`.
+
+        :param timeout: Seconds after which a response expires regardless of
+                        its dependencies.
+        :type timeout: float
+        """
+        super(ResponseCache, self).__init__()
+        self.backend = backend
+        self.timeout = timeout
+
+    def get_versions(self, dependencies):
+        """
+        Return the current versions of the dependencies
+
+        A dependency without a version gets a new one. Had it been evicted
+        from the backend, all responses depending on it are stale.
+
+        :rtype: dict
+        """
+        versions = {}
+        for dependency in dependencies:
+            key = "version:" + dependency
+            version = self.backend.get(key)
+            if version is None:
+                version = uuid.uuid4().hex
+                self.backend.set(key, version)
+            versions[dependency] = version
+        return versions
+
+    def invalidate(self, *dependencies):
+        """Make all responses stale which depend on any of the dependencies"""
+        for dependency in dependencies:
+            self.backend.set("version:" + dependency, uuid.uuid4().hex)
+
+    def get(self, key):
+        """
+        Return the cached response data for the key or None if there is none
+
+        :returns: Tuple of status code, headers and body of the response.
+        :rtype: tuple or None
+        """
+        entry = self.backend.get("response:" + key)
+        if entry is None:
+            return None
+        expires, versions, response_data = entry
+        if expires < time.time():
+            return None
+        if self.get_versions(versions) != versions:
+            return None
+        return response_data
+
+    def set(self, key, versions, response_data):
+        """
+        Store the response data for the key
+
+        :param versions: Versions of the dependencies as returned by
+                         `get_versions` *before* the response was rendered.
+        :type versions: dict
+
+        :param response_data: Tuple of status code, headers and body.
+        :type response_data: tuple
+        """
+        self.backend.set(
+            "response:" + key,
+            (time.time() + self.timeout, versions, response_data))
+
+    def clear(self):
+        self.backend.clear()
+
+
+def create_response_cache(app):
+    """Create the response cache configured for the app or None"""
+    backend_name = app.config["RESPONSE_CACHE_BACKEND"]
+    if not backend_name:
+        return None
+    if backend_name == "memory":
+        backend = LRUCache(
+            max_entries=app.config["RESPONSE_CACHE_MAX_ENTRIES"])
+    elif backend_name == "directory":
+        backend = DirectoryCache(
+            path=app.config["RESPONSE_CACHE_DIR"],
+            max_entries=app.config["RESPONSE_CACHE_MAX_ENTRIES"])
+    else:
+        raise ValueError(
+            "Unknown response cache backend {!r}.".format(backend_name))
+    return ResponseCache(
+        backend=backend, timeout=app.config["RESPONSE_CACHE_TIMEOUT"])
+
+
+def get_response_cache():
+    """Return the response cache of the current app or None if disabled"""
+    return current_app.extensions.get("flaskr_response_cache")
+
+
+def get_content_versions(dependencies):
+    """
+    Return the stored content versions of the dependencies
+
+    Dependencies which have never been changed are missing in the result.
+
+    :param dependencies: Names of the dependencies.
+    :type dependencies: list
+
+    :returns: Dictionary mapping the names to tuples of change counter and
+              unix time of the last change.
+    :rtype: dict
+    """
+    rows = get_db().execute(
+        "SELECT name, counter, modified FROM content_version"
+        " WHERE name IN ({})".format(", ".join("?" * len(dependencies))),
+        tuple(dependencies)
+    ).fetchall()
+    return {row["name"]: (row["counter"], row["modified"]) for row in rows}
+
+
+def bump_content_versions(db, dependencies):
+    """
+    Increment the content versions of the dependencies
+
+    This can be called inside of the transaction which changes the content,
+    so that no additional commit is needed. The caller is responsible for
+    committing and has to call `invalidate_cached_responses` afterwards.
+
+    :param db: Connection to use for the statement.
+    :type db: sqlite3.Connection
+
+    :param dependencies: Names of the dependencies.
+    :type dependencies: list
+    """
+    db.executemany(
+        "INSERT INTO content_version (name, counter, modified)"
+        " VALUES (?, 1, CAST(strftime('%s', 'now') AS INTEGER))"
+        " ON CONFLICT (name) DO UPDATE"
+        " SET counter = counter + 1, modified = excluded.modified",
+        [(dependency,) for dependency in dependencies]
+    )
+
+
+def invalidate_cached_responses(*dependencies):
+    """Make the cached responses stale which depend on the dependencies"""
+    # Versions read for template fragments earlier in the request are outdated
+    g.pop("fragment_versions", None)
+    cache = get_response_cache()
+    if cache is not None:
+        cache.invalidate(*dependencies)
+
+
+def invalidate(*dependencies):
+    """
+    Record that the content of the dependencies has changed
+
+    The content versions used as validators for conditional requests are
+    incremented in a transaction of their own and the cached responses
+    depending on the dependencies become stale. This is only meant for
+    changes which are not made by one transaction, e.g. of files or of bulk
+    imports. Functions changing data in a transaction call
+    `bump_content_versions` in it and `invalidate_cached_responses` after the
+    commit, so that the data and the versions change together.
+
+    :param dependencies: Names of the dependencies, e.g. "posts" for anything
+                         shown in the post listings and "post:<id>" for
+                         anything shown on the detail page of a post.
+    :type dependencies: str
+    """
+    run_write(lambda db: bump_content_versions(db, dependencies))
+    invalidate_cached_responses(*dependencies)
+
+
+def conditional_response(*dependencies, representation=None, vary=()):
+    """
+    Decorator answering conditional GET requests of a view
+
+    The ETag is derived from the content versions of the dependencies and the
+    logged in user, the Last-Modified date from the latest change of the
+    dependencies. If the client's copy is still fresh, 304 Not Modified is
+    returned without calling the view. This costs a single indexed query.
+
+    :param dependencies: Names of the dependencies of the view's responses.
+                         They are formatted with the keyword arguments of the
+                         view, e.g. "post:{id}".
+    :type dependencies: str
+
+    :param representation: Function returning the name of the representation
+                           the view returns for the request, e.g. "json". It
+                           is part of the ETag.
+    :type representation: callable or None
+
+    :param vary: Request headers by which the representation is selected.
+    :type vary: tuple
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped_view(**kwargs):
+            # Flashed messages are shown once and not part of the versions
+            if "_flashes" in session:
+                return view(**kwargs)
+
+            names = [d.format(**kwargs) for d in dependencies]
+            versions = get_content_versions(names)
+            user_id = g.user["id"] if g.user is not None else None
+            etag = hashlib.sha1(repr((
+                current_app.config["ETAG_SALT"],
+                user_id,
+                [(name, versions.get(name, (0, None))[0]) for name in names],
+                representation() if representation is not None else None,
+            )).encode("utf8")).hexdigest()
+            last_modified = None
+            if len(versions) == len(names):
+                last_modified = datetime.fromtimestamp(
+                    max(modified for _, modified in versions.values()),
+                    tz=timezone.utc)
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            elif request.if_modified_since and last_modified:
+                not_modified = last_modified <= request.if_modified_since
+            else:
+                not_modified = False
+
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(**kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            for header in vary:
+                response.vary.add(header)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            # Clients may store the response, but have to revalidate it
+            response.cache_control.no_cache = True
+            return response
+        return wrapped_view
+    return decorator
+
+
+def cached_response(*dependencies, query_args=()):
+    """
+    Decorator caching the responses of a view for anonymous users
+
+    Only successful GET requests of users without a session are cached,
+    because the pages of logged-in users and flashed messages are personal.
+    The cache key is the path with the query arguments read by the view, so
+    that other arguments cannot fill the cache with copies of a page.
+    Streamed responses are stored after they have been sent completely.
+
+    :param dependencies: Names of the dependencies of the view's responses.
+                         They are formatted with the keyword arguments of the
+                         view, e.g. "post:{id}".
+    :type dependencies: str
+
+    :param query_args: Names of the query arguments read by the view.
+    :type query_args: tuple
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped_view(**kwargs):
+            cache = get_response_cache()
+            if (cache is None or request.method != "GET"
+                    or g.user is not None or session):
+                return view(**kwargs)
+
+            key = request.path + "?" + urlencode(sorted(
+                (name, value) for name, value in request.args.items(multi=True)
+                if name in query_args))
+            response_data = cache.get(key)
+            if response_data is not None:
+                status, headers, body = response_data
+                response = current_app.response_class(
+                    body, status=status, headers=headers)
+                response.headers["X-Cache"] = "HIT"
+                return response
+
+            versions = cache.get_versions(
+                [d.format(**kwargs) for d in dependencies])
+            response = current_app.make_response(view(**kwargs))
+            response.headers["X-Cache"] = "MISS"
+            if response.status_code != 200 or session:
+                return response
+
+            headers = [(name, value) for name, value in response.headers
+                       if name != "X-Cache"]
+            if not response.is_streamed:
+                cache.set(key, versions, (
+                    response.status_code, headers, response.get_data()))
+                return response
+
+            # A streamed response is stored once it has been sent completely
+            def store_while_streaming(chunks):
+                body = []
+                for chunk in chunks:
+                    body.append(chunk)
+                    yield chunk
+                cache.set(key, versions, (
+                    response.status_code, headers,
+                    b"".join(c.encode("utf-8")
+                             if isinstance(c, str) else c for c in body)))
+
+            response.response = store_while_streaming(response.response)
+            return response
+        return wrapped_view
+    return decorator
+
+
+@click.command("clear-response-cache")
+@with_appcontext
+def clear_response_cache_command():
+    """Remove all cached responses"""
+    cache = get_response_cache()
+    if cache is not None:
+        cache.clear()
+    click.echo("Cleared the response cache.")
+
+
+def init_app(app):
+    app.extensions["flaskr_response_cache"] = create_response_cache(app)
+    app.cli.add_command(clear_response_cache_command)
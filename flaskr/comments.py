@@ -1,10 +1,15 @@
 from flask import (
-    Blueprint, flash, g, redirect, request, url_for
+    Blueprint, current_app, flash, g, jsonify, redirect, render_template,
+    request, url_for
 )
 from werkzeug.exceptions import abort
 
 from flaskr.auth import login_required
-from flaskr.db import get_db
+from flaskr.cache import (
+    bump_content_versions, conditional_response, invalidate_cached_responses
+)
+from flaskr.db import get_db, run_write
+from flaskr.pagination import KeysetPagination
 
 bp = Blueprint("comments", __name__, url_prefix="/comments")
 
@@ -18,12 +23,110 @@ def get_comments_for_post(post_id=None):
         comments = db.execute(
             "SELECT c.id, body, created, post_id, author_id, username"
             " FROM comment c JOIN user u ON c.author_id = u.id"
-            " WHERE post_id = ?",
+            " WHERE post_id = ?"
+            " ORDER BY c.id",
             (post_id,)
         ).fetchall()
         return comments
 
 
+def get_comment_page(post_id, after=None):
+    """
+    Get one page of the comments for a post, oldest first.
+
+    The comments are paginated by keyset on their id, so that each page is
+    selected from the index on the post id.
+
+    :param post_id: Id of the post for which the comments should be retrieved.
+    :type post_id: int
+
+    :param after: Id of the comment after which the page starts.
+    :type after: int or None
+
+    :returns: Tuple of the list of comments and the pagination object, of
+              which `next` is the cursor of the following page.
+    :rtype: tuple
+    """
+    pagination = KeysetPagination(
+        items_per_page=current_app.config["COMMENTS_PER_PAGE"], after=after)
+    condition, condition_params = pagination.key_condition(
+        "c.id", descending=False)
+    limit, limit_params = pagination.limit_clause()
+    comments = get_db().execute(
+        "SELECT c.id, body, created, post_id, author_id, username"
+        " FROM comment c JOIN user u ON c.author_id = u.id"
+        " WHERE post_id = ? AND " + condition +
+        " ORDER BY " + pagination.order_by("c.id", descending=False) +
+        " " + limit,
+        (post_id,) + condition_params + limit_params
+    ).fetchall()
+    return pagination.paginate(comments), pagination
+
+
+def get_comment_page_representation():
+    """
+    Return the representation of a comment page requested by the client
+
+    :returns: "json" if the client prefers JSON or the `format` argument is
+              "json", "fragment" for scripts loading more comments into the
+              post and "page" otherwise.
+    :rtype: str
+    """
+    if request.args.get("format") == "json" or (
+            request.accept_mimetypes.best == "application/json"):
+        return "json"
+    if request.headers.get("X-Requested-With") == "XMLHttpRequest":
+        return "fragment"
+    return "page"
+
+
+@bp.route("/post/<int:post_id>")
+@conditional_response(
+    "post:{post_id}", representation=get_comment_page_representation,
+    vary=("Accept", "X-Requested-With"))
+def list_for_post(post_id):
+    """
+    Return a page of the comments for a post to load more comments
+
+    The page is returned as JSON, as HTML fragment which the script of the
+    post's page appends to the comments or as complete HTML page, see
+    `get_comment_page_representation`.
+    """
+    post = get_db().execute(
+        "SELECT id, title, author_id FROM post WHERE id = ?", (post_id,)
+    ).fetchone()
+    if post is None:
+        abort(404, "Post id {} does not exist.".format(post_id))
+
+    comments, pagination = get_comment_page(
+        post_id, after=request.args.get("after", type=int))
+    representation = get_comment_page_representation()
+    if representation == "json":
+        next_url = None
+        if pagination.next:
+            next_url = url_for(
+                "comments.list_for_post", post_id=post_id,
+                after=pagination.next, format="json")
+        return jsonify(
+            comments=[{
+                "id": comment["id"],
+                "body": comment["body"],
+                "created": comment["created"].isoformat(),
+                "author_id": comment["author_id"],
+                "username": comment["username"],
+            } for comment in comments],
+            next=next_url)
+
+    return render_template(
+        "comments/{}.html".format(representation),
+        comments=comments,
+        pagination=pagination,
+        post=post,
+        post_id=post_id,
+        user_is_post_author=(
+            g.user is not None and g.user["id"] == post["author_id"]))
+
+
 @bp.route("/create", methods=("POST",))
 @login_required
 def create():
@@ -38,13 +141,19 @@ def create():
         flash(error)
     else:
         # Create the comment in the db
-        db = get_db()
-        db.execute(
-            "INSERT INTO comment (author_id, post_id, body)"
-            " VALUES (?, ?, ?)",
-            (g.user["id"], post_id, body)
-        )
-        db.commit()
+        author_id = g.user["id"]
+
+        def create_comment(db):
+            db.execute(
+                "INSERT INTO comment (author_id, post_id, body)"
+                " VALUES (?, ?, ?)",
+                (author_id, post_id, body)
+            )
+            bump_content_versions(db, dependencies)
+
+        dependencies = ["post:{}".format(post_id)]
+        run_write(create_comment)
+        invalidate_cached_responses(*dependencies)
     return redirect(url_for("blog.detail", id=post_id))
 
 
@@ -56,13 +165,18 @@ def delete(id):
     # Only the author of the *post* can delete comments to that post.
     post_info = db.execute(
         "SELECT p.author_id, p.id "
-        "FROM comment c JOIN post p"
+        "FROM comment c JOIN post p ON c.post_id = p.id"
         " WHERE c.id = ?", (id,)
     ).fetchone()
     if not post_info["author_id"] == g.user["id"]:
         abort(403)  # Forbidden is returned
 
-    db.execute("DELETE FROM comment WHERE id = ?", (id, ))
-    db.commit()
+    def delete_comment(db):
+        db.execute("DELETE FROM comment WHERE id = ?", (id, ))
+        bump_content_versions(db, dependencies)
+
+    dependencies = ["post:{}".format(post_info["id"])]
+    run_write(delete_comment)
+    invalidate_cached_responses(*dependencies)
 
     return redirect(url_for("blog.detail", id=post_info["id"]))
@@ -1,17 +1,534 @@
+import os
+import queue
 import sqlite3
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
 
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
 
+class PoolTimeoutError(Exception):
+    """Raised when no connection becomes available in the pool in time"""
+
+
+class PooledConnection(object):
+    """
+    Connection checked out from a `ConnectionPool`
+
+    All attributes are delegated to the underlying `sqlite3.Connection`.
+    Closing the pooled connection returns the underlying connection to the
+    pool instead of closing it. Using the pooled connection after it has been
+    closed raises a `sqlite3.ProgrammingError`, just like using a closed
+    `sqlite3.Connection` does.
+    """
+
+    def __init__(self, pool, connection):
+        self._pool = pool
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._checked_out_connection(), name)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_"):
+            super(PooledConnection, self).__setattr__(name, value)
+        else:
+            setattr(self._checked_out_connection(), name, value)
+
+    def __enter__(self):
+        return self._checked_out_connection().__enter__()
+
+    def __exit__(self, *exc_info):
+        return self._checked_out_connection().__exit__(*exc_info)
+
+    def _checked_out_connection(self):
+        if self._connection is None:
+            raise sqlite3.ProgrammingError(
+                "Cannot operate on a closed database.")
+        return self._connection
+
+    def close(self):
+        """Return the underlying connection to the pool"""
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            self._pool.release(connection)
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of reusable connections to one SQLite database
+
+    Opening a connection is expensive compared to the short queries of a
+    request. The connections in the pool are kept open between requests, so
+    that they also keep their page cache. Connections are opened lazily up to
+    the size of the pool. When all connections are checked out, a checkout
+    waits until a connection is returned.
+
+    The PRAGMAs are applied once when a connection is opened.
+    """
+
+    def __init__(self, database, size, timeout, pragmas=None):
+        """
+        Initialize ConnectionPool object
+
+        :param database: Path of the SQLite database file.
+        :type database: str
+
+        :param size: Maximum number of open connections.
+        :type size: int
+
+        :param timeout: Seconds to wait for a connection before a
+                        `PoolTimeoutError` is raised.
+        :type timeout: float
+
+        :param pragmas: Mapping of PRAGMA names to values applied to each new
+                        connection.
+        :type pragmas: dict
+        """
+        super(ConnectionPool, self).__init__()
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = pragmas or {}
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._open_count = 0
+        self._closed = False
+        self.hits = 0
+        self.waits = 0
+        self.opens = 0
+
+    def _connect(self):
+        connection = sqlite3.connect(
+            self.database,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            # Connections are handed between the threads of the server, but
+            # only ever used by one thread at a time.
+            check_same_thread=False
+        )
+        connection.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            connection.execute("PRAGMA {} = {}".format(name, value))
+        return connection
+
+    def acquire(self):
+        """
+        Check out a connection from the pool
+
+        :rtype: PooledConnection
+        """
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            connection = None
+
+        if connection is not None:
+            with self._lock:
+                self.hits += 1
+            return PooledConnection(self, connection)
+
+        with self._lock:
+            may_open = self._open_count < self.size
+            if may_open:
+                self._open_count += 1
+                self.opens += 1
+            else:
+                self.waits += 1
+
+        if may_open:
+            try:
+                connection = self._connect()
+            except Exception:
+                with self._lock:
+                    self._open_count -= 1
+                raise
+        else:
+            try:
+                connection = self._idle.get(timeout=self.timeout)
+            except queue.Empty:
+                raise PoolTimeoutError(
+                    "No database connection available after {} seconds."
+                    .format(self.timeout))
+        return PooledConnection(self, connection)
+
+    def release(self, connection):
+        """
+        Return a connection to the pool
+
+        A transaction which has been left open is rolled back, so that the
+        next user of the connection starts with a clean state.
+
+        :param connection: Connection which has been checked out before.
+        :type connection: sqlite3.Connection
+        """
+        if connection.in_transaction:
+            connection.rollback()
+        if self._closed:
+            connection.close()
+            return
+        self._idle.put(connection)
+
+    def close(self):
+        """Close all idle connections and those returned from now on"""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def stats(self):
+        """
+        Return usage statistics of the pool
+
+        `hits` counts checkouts served by an idle connection, `opens` counts
+        newly opened connections and `waits` counts checkouts which had to
+        wait for a connection to be returned.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                "size": self.size,
+                "open": self._open_count,
+                "idle": self._idle.qsize(),
+                "hits": self.hits,
+                "waits": self.waits,
+                "opens": self.opens,
+            }
+
+
+# Result of a single writing statement. The cursor itself stays with the
+# writer, because it belongs to the writer's connection.
+WriteResult = namedtuple("WriteResult", ("lastrowid", "rowcount"))
+
+
+class _WriteJob(object):
+    """Function to be run by the `DatabaseWriter` and its future result"""
+
+    def __init__(self, func, transactional):
+        self.func = func
+        self.transactional = transactional
+        self.future = Future()
+
+
+class DatabaseWriter(object):
+    """
+    Single writer thread which group-commits the writes of all requests
+
+    SQLite allows only one writer at a time. When every request writes on its
+    own connection, concurrent writers wait for the database lock and each
+    commit costs a sync to disk. Instead, writes are submitted to the queue of
+    this writer. The writer runs the queued writes one after another on its
+    own connection and commits up to `batch_size` of them in one transaction.
+
+    Each write runs in a savepoint of its own. A write that raises is rolled
+    back without affecting the other writes of the batch.
+    """
+
+    def __init__(self, database, batch_size, pragmas=None):
+        """
+        Initialize DatabaseWriter object and start the writer thread
+
+        :param database: Path of the SQLite database file.
+        :type database: str
+
+        :param batch_size: Maximum number of writes committed together.
+        :type batch_size: int
+
+        :param pragmas: Mapping of PRAGMA names to values applied to the
+                        writer's connection.
+        :type pragmas: dict
+        """
+        super(DatabaseWriter, self).__init__()
+        self.batch_size = batch_size
+        self.pid = os.getpid()
+        # The writer controls the transactions itself (autocommit mode).
+        self._connection = sqlite3.connect(
+            database,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+            isolation_level=None
+        )
+        self._connection.row_factory = sqlite3.Row
+        for name, value in (pragmas or {}).items():
+            self._connection.execute("PRAGMA {} = {}".format(name, value))
+        self._queue = queue.Queue()
+        self.writes = 0
+        self.batches = 0
+        self._thread = threading.Thread(
+            target=self._run, name="flaskr-db-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, func, transactional=True):
+        """
+        Queue a write and return the future of its result
+
+        :param func: Function which is called with the writer's connection
+                     and performs the write.
+        :type func: callable
+
+        :param transactional: If false, the function is run on its own and
+                              outside of a transaction. This is needed for
+                              `executescript`, which commits by itself.
+        :type transactional: bool
+
+        :rtype: concurrent.futures.Future
+        """
+        job = _WriteJob(func, transactional)
+        self._queue.put(job)
+        return job.future
+
+    def close(self):
+        """Stop the writer thread after the queued writes are done"""
+        self._queue.put(None)
+        self._thread.join()
+        self._connection.close()
+
+    def stats(self):
+        """
+        Return usage statistics of the writer
+
+        :rtype: dict
+        """
+        return {
+            "writes": self.writes,
+            "batches": self.batches,
+            "queued": self._queue.qsize(),
+        }
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                stopping = True
+                batch.pop()
+
+            transactional = []
+            for job in batch:
+                if job.transactional:
+                    transactional.append(job)
+                    continue
+                self._run_batch(transactional)
+                transactional = []
+                self._run_alone(job)
+            self._run_batch(transactional)
+
+    def _run_alone(self, job):
+        try:
+            result = job.func(self._connection)
+        except Exception as e:
+            job.future.set_exception(e)
+        else:
+            job.future.set_result(result)
+        self.writes += 1
+        self.batches += 1
+
+    def _run_batch(self, jobs):
+        if not jobs:
+            return
+        db = self._connection
+        outcomes = []
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            for job in jobs:
+                db.execute("SAVEPOINT write_job")
+                try:
+                    outcomes.append((job, job.func(db), None))
+                except Exception as e:
+                    db.execute("ROLLBACK TO write_job")
+                    outcomes.append((job, None, e))
+                db.execute("RELEASE write_job")
+            db.execute("COMMIT")
+        except Exception as e:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            for job in jobs:
+                job.future.set_exception(e)
+            return
+        finally:
+            self.writes += len(jobs)
+            self.batches += 1
+
+        for job, result, exception in outcomes:
+            if exception is not None:
+                job.future.set_exception(exception)
+            else:
+                job.future.set_result(result)
+
+
+_pool_lock = threading.Lock()
+
+
+def get_pool(app=None):
+    """
+    Get the connection pool of the app
+
+    The pool is created on first use. A process which has been forked from
+    the one that created the pool, gets a pool of its own.
+    """
+    app = app or current_app._get_current_object()
+    pool = app.extensions.get("flaskr_db_pool")
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+
+    with _pool_lock:
+        pool = app.extensions.get("flaskr_db_pool")
+        if pool is None or pool.pid != os.getpid():
+            pragmas = dict(app.config["DB_PRAGMAS"])
+            if app.config["DB_SPLIT_READ_WRITE"]:
+                # Writes have to go through the writer
+                pragmas["query_only"] = "ON"
+            pool = ConnectionPool(
+                database=app.config["DATABASE"],
+                size=app.config["DB_POOL_SIZE"],
+                timeout=app.config["DB_POOL_TIMEOUT"],
+                pragmas=pragmas
+            )
+            app.extensions["flaskr_db_pool"] = pool
+    return pool
+
+
+def get_writer(app=None):
+    """
+    Get the database writer of the app
+
+    The writer is started on first use, once per process.
+    """
+    app = app or current_app._get_current_object()
+    writer = app.extensions.get("flaskr_db_writer")
+    if writer is not None and writer.pid == os.getpid():
+        return writer
+
+    with _pool_lock:
+        writer = app.extensions.get("flaskr_db_writer")
+        if writer is None or writer.pid != os.getpid():
+            writer = DatabaseWriter(
+                database=app.config["DATABASE"],
+                batch_size=app.config["DB_WRITER_BATCH_SIZE"],
+                pragmas=app.config["DB_PRAGMAS"]
+            )
+            app.extensions["flaskr_db_writer"] = writer
+    return writer
+
+
+def close_connections(app):
+    """Close the connection pool and stop the writer of the app"""
+    pool = app.extensions.pop("flaskr_db_pool", None)
+    if pool is not None:
+        pool.close()
+    writer = app.extensions.pop("flaskr_db_writer", None)
+    if writer is not None:
+        writer.close()
+
+
+def get_pool_stats():
+    """
+    Return usage statistics of the current app's connection pool
+
+    If reads and writes are split, the statistics of the writer are included
+    as `writer`.
+    """
+    stats = get_pool().stats()
+    if current_app.config["DB_SPLIT_READ_WRITE"]:
+        stats["writer"] = get_writer().stats()
+    return stats
+
+
+def run_write(func, transactional=True):
+    """
+    Run a function performing writes and commit them
+
+    By default, the function is called with the request's connection, which
+    is committed afterwards or rolled back if the function raises. If the
+    app's `DB_SPLIT_READ_WRITE` is set, the function is run by the app's
+    `DatabaseWriter` and this call waits for the commit. The function must not
+    rely on the app context in that case, because it runs in another thread.
+
+    :param func: Function which is called with a connection and performs the
+                 write.
+    :type func: callable
+
+    :param transactional: Whether the function can be run inside of a
+                          transaction. See `DatabaseWriter.submit`.
+    :type transactional: bool
+
+    :returns: Return value of the function.
+    """
+    if current_app.config["DB_SPLIT_READ_WRITE"]:
+        future = get_writer().submit(func, transactional=transactional)
+        return future.result(timeout=current_app.config["DB_WRITER_TIMEOUT"])
+
+    db = get_db()
+    try:
+        result = func(db)
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
+    return result
+
+
+def execute_write(sql, parameters=()):
+    """
+    Execute a single writing statement and commit it
+
+    :param sql: SQL statement to execute.
+    :type sql: str
+
+    :param parameters: Parameters of the statement.
+    :type parameters: tuple
+
+    :rtype: WriteResult
+    """
+    def write(db):
+        cursor = db.execute(sql, parameters)
+        return WriteResult(cursor.lastrowid, cursor.rowcount)
+
+    return run_write(write)
+
+
+def run_locked_write(func):
+    """
+    Run a function in a transaction which holds the write lock from its start
+
+    sqlite3 begins the transactions of `run_write` with the first writing
+    statement, so a function which only reads holds no lock. Functions which
+    act outside of the database on what they read, e.g. remove files which are
+    not referenced, have to run here, so that no other write can commit in
+    between.
+
+    :param func: Function which is called with a connection.
+    :type func: callable
+
+    :returns: Return value of the function.
+    """
+    def run_locked(db):
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(db)
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        return result
+
+    return run_write(run_locked, transactional=False)
+
+
 def get_db():
     if "db" not in g:
-        g.db = sqlite3.connect(
-            current_app.config["DATABASE"],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db = get_pool().acquire()
 
     return g.db
 
@@ -24,10 +541,16 @@ def close_db(e=None):
 
 
 def init_db():
-    db = get_db()
+    # The module of the feeds uses this one
+    from flaskr.rss import lock_feed_snapshots, remove_feed_snapshots
 
     with current_app.open_resource("schema.sql") as f:
-        db.executescript(f.read().decode("utf8"))
+        script = f.read().decode("utf8")
+    # The snapshots of the feeds would still show the removed posts. Holding
+    # their lock, no snapshot of the old posts is published afterwards.
+    with lock_feed_snapshots():
+        run_write(lambda db: db.executescript(script), transactional=False)
+        remove_feed_snapshots()
 
 
 @click.command("init-db")
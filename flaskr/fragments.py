@@ -0,0 +1,125 @@
+"""
+Caching of rendered template fragments
+
+The `{% cache key, timeout, *dependencies %}` tag of `FragmentCacheExtension`
+caches the rendered content of its block in an in-process LRU cache, e.g.
+
+    {% cache ("comments", post["id"]), 300, "post:" ~ post["id"] %}
+        ...
+    {% endcache %}
+
+The key has to identify everything the content depends on, apart from the
+dependencies. The dependencies are content versions as used by
+`flaskr.cache.conditional_response`, so a fragment is stale as soon as any
+process calls `invalidate` for one of them. A timeout of 0 renders the block
+without caching it.
+"""
+import time
+
+from flask import current_app, g
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from flaskr.cache import LRUCache, get_content_versions
+
+
+class FragmentCache(object):
+    """Cache of rendered fragments stored with their dependencies' versions"""
+
+    def __init__(self, max_entries):
+        """
+        Initialize FragmentCache object
+
+        :param max_entries: Maximum number of fragments kept in the cache.
+        :type max_entries: int
+        """
+        super(FragmentCache, self).__init__()
+        self.backend = LRUCache(max_entries=max_entries)
+
+    def get(self, key, versions):
+        """
+        Return the fragment stored for the key or None
+
+        :param versions: Current versions of the dependencies of the fragment.
+        :type versions: dict
+
+        :rtype: str or None
+        """
+        entry = self.backend.get(key)
+        if entry is None:
+            return None
+        expires, stored_versions, html = entry
+        if expires < time.time() or stored_versions != versions:
+            return None
+        return html
+
+    def set(self, key, versions, html, timeout):
+        """Store the fragment for the key for at most timeout seconds"""
+        self.backend.set(key, (time.time() + timeout, versions, html))
+
+    def clear(self):
+        self.backend.clear()
+
+
+def get_fragment_cache():
+    """Return the fragment cache of the current app or None if disabled"""
+    return current_app.extensions.get("flaskr_fragment_cache")
+
+
+def get_fragment_versions(dependencies):
+    """
+    Return the content versions of the dependencies of a fragment
+
+    The versions are read once per request and dependency, because a page
+    usually contains many fragments depending on the same content.
+
+    :rtype: dict
+    """
+    if "fragment_versions" not in g:
+        g.fragment_versions = {}
+    known = g.fragment_versions
+    missing = [name for name in dependencies if name not in known]
+    if missing:
+        versions = get_content_versions(missing)
+        for name in missing:
+            known[name] = versions.get(name, (0, None))[0]
+    return {name: known[name] for name in dependencies}
+
+
+class FragmentCacheExtension(Extension):
+    """Jinja extension adding the `{% cache %}` tag"""
+
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(("name:endcache",), drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method("_render_cached", [nodes.List(args)]),
+            [], [], body
+        ).set_lineno(lineno)
+
+    def _render_cached(self, args, caller):
+        key, timeout, *dependencies = args
+        cache = get_fragment_cache()
+        if cache is None or not timeout:
+            return caller()
+
+        key = repr(key)
+        versions = get_fragment_versions(dependencies)
+        html = cache.get(key, versions)
+        if html is None:
+            html = str(caller())
+            cache.set(key, versions, html, timeout)
+        return Markup(html)
+
+
+def init_app(app):
+    max_entries = app.config["FRAGMENT_CACHE_MAX_ENTRIES"]
+    app.extensions["flaskr_fragment_cache"] = (
+        FragmentCache(max_entries=max_entries) if max_entries else None)
+    app.jinja_env.add_extension(FragmentCacheExtension)
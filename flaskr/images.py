@@ -1,20 +1,85 @@
+import hashlib
+import json
 import os
+import re
+import tempfile
+import time
 import uuid
+from collections import namedtuple
+from urllib.parse import quote
 
-from flask import (Blueprint, send_from_directory, current_app, redirect,
-                   url_for)
+import click
+from flask import Blueprint, abort, current_app, request
+from flask.cli import with_appcontext
+from werkzeug.utils import send_file
 
-from flaskr.auth import login_required
-from flaskr.db import get_db
+from flaskr.auth import login_required, skip_user_lookup
+from flaskr.cache import bump_content_versions, invalidate_cached_responses
+from flaskr.db import get_db, run_locked_write, run_write
+from flaskr.uploads import find_path, get_path, iter_files, remove
+from flaskr.variants import (
+    generate_variants_in_background, get_manifest_filename
+)
 
 
 bp = Blueprint("images", __name__, url_prefix="/images")
 
 
+# Filenames of originals are the SHA-256 of their content, see `receive_image`
+CONTENT_ADDRESSED_FILENAME = re.compile(r"^([0-9a-f]{64})(\.[^.]*)?$")
+
+
 @bp.route("/<string:filename>")
+@skip_user_lookup
 def get(filename):
-    return send_from_directory(current_app.config['UPLOAD_DIR'],
-                               filename, as_attachment=False)
+    """
+    Send an image or a variant from the upload directory
+
+    Originals are named after the hash of their content, so they are cached
+    for `IMAGE_CACHE_MAX_AGE` without revalidation and the hash is their ETag.
+    Variants and manifests may be generated again under the same name, so
+    clients have to revalidate them. Range requests are answered with partial
+    content.
+
+    With `IMAGE_SENDFILE` the app only sends the headers and the front proxy
+    sends the file. The proxy then also answers range requests.
+    """
+    config = current_app.config
+    path = find_path(
+        config["UPLOAD_DIR"], filename, config["UPLOAD_DIR_LAYOUT"])
+    if path is None:
+        abort(404)
+
+    mode = config["IMAGE_SENDFILE"]
+    if mode not in (None, "x-sendfile", "x-accel-redirect"):
+        raise ValueError("Unknown IMAGE_SENDFILE {!r}".format(mode))
+    match = CONTENT_ADDRESSED_FILENAME.match(filename)
+    response = send_file(
+        path,
+        request.environ,
+        etag=match.group(1) if match else True,
+        max_age=config["IMAGE_CACHE_MAX_AGE"] if match else None,
+        use_x_sendfile=mode is not None,
+        # The proxy handles ranges of the files it sends
+        conditional=mode is None,
+        response_class=current_app.response_class
+    )
+    if match:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+
+    if mode is not None:
+        response.make_conditional(request.environ)
+        if response.status_code == 304:
+            response.headers.pop("X-Sendfile", None)
+        elif mode == "x-accel-redirect":
+            response.headers.pop("X-Sendfile")
+            relative_path = os.path.relpath(path, config["UPLOAD_DIR"])
+            response.headers["X-Accel-Redirect"] = "{}/{}".format(
+                config["IMAGE_ACCEL_REDIRECT_PREFIX"].rstrip("/"),
+                quote(relative_path.replace(os.sep, "/")))
+    return response
 
 
 def get_random_string():
@@ -22,34 +87,130 @@ def get_random_string():
     return uuid.uuid4().hex
 
 
+class ImageTooLargeError(ValueError):
+    """Raised when an uploaded image is larger than `IMAGE_MAX_SIZE`"""
+
+
+def get_upload_path(filename):
+    """
+    Return the path at which a file is stored in the upload directory
+
+    The path follows `UPLOAD_DIR_LAYOUT`, its directory may not exist yet.
+    """
+    return get_path(
+        current_app.config["UPLOAD_DIR"], filename,
+        current_app.config["UPLOAD_DIR_LAYOUT"])
+
+
+def find_upload_path(filename):
+    """Return the path of an existing file or None, see `find_path`"""
+    return find_path(
+        current_app.config["UPLOAD_DIR"], filename,
+        current_app.config["UPLOAD_DIR_LAYOUT"])
+
+
+def receive_image(filestrorage_obj):
+    """
+    Stream an uploaded image to a temporary file while hashing it
+
+    Images are stored content-addressed: the filename is the SHA-256 of the
+    content with the lower case file extension of the file on the client. The
+    same image uploaded for many posts is stored only once.
+
+    The temporary file is created in the upload directory, so that it can be
+    moved into place atomically. The caller has to move or remove it.
+
+    :param filestorage_obj: FileStorage object that is attached to the request
+                            when uploaded.
+    :type filestrorage_obj: werkzeug.datastructures.FileStorage
+
+    :raises ImageTooLargeError: If the image is larger than `IMAGE_MAX_SIZE`.
+                                No temporary file is left behind.
+
+    :returns: Tuple of the path of the temporary file and the filename.
+    :rtype: tuple
+    """
+    max_size = current_app.config["IMAGE_MAX_SIZE"]
+    chunk_size = current_app.config["IMAGE_UPLOAD_CHUNK_SIZE"]
+    sha256 = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(
+        dir=current_app.config["UPLOAD_DIR"], suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode="wb") as f:
+            for chunk in iter(
+                    lambda: filestrorage_obj.stream.read(chunk_size), b""):
+                size += len(chunk)
+                if size > max_size:
+                    raise ImageTooLargeError(
+                        "The image is larger than {} bytes.".format(max_size))
+                sha256.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    _, extension = os.path.splitext(filestrorage_obj.filename)
+    return temp_path, sha256.hexdigest() + extension.lower()
+
+
 def save_image_to_upload_dir(filestrorage_obj, _filename=None):
     """
     Save the filestorage object as a file in the upload directory
 
-    The file is saved with a random filename. The private `_filename` argument
-    can be used during testing to force the file being saved with a defined
-    filename.
-
-    The random filename will have the same fileextension as the file extension
-    on the client. The random filename is based on UUID which should make
-    name clashes basically impossible.
+    The file is saved content-addressed, see `receive_image`. The private
+    `_filename` argument can be used during testing to force the file being
+    saved with a defined filename.
 
     :param filestorage_obj: FileStorage object that is attached to the request
                             when uploaded.
     :type filestrorage_obj: werkzeug.datastructures.FileStorage
 
-    :param _filename: Private argument for testing to override the randomly
-                      generated filename
+    :param _filename: Private argument for testing to override the filename
+                      derived from the content
     :type filename: string
     """
-    _, extension = os.path.splitext(filestrorage_obj.filename)
-    filename = _filename or (get_random_string() + extension)
-    save_image_path = os.path.join(
-        current_app.config["UPLOAD_DIR"], filename)
-    filestrorage_obj.save(dst=save_image_path)
+    temp_path, filename = receive_image(filestrorage_obj)
+    filename = _filename or filename
+    upload_path = get_upload_path(filename)
+    os.makedirs(os.path.dirname(upload_path), exist_ok=True)
+    os.replace(temp_path, upload_path)
     return filename
 
 
+def _remove_unreferenced(db, upload_dir, layout, filenames):
+    """
+    Remove the image files which no post references anymore
+
+    This runs with `run_locked_write` after the transaction which removed the
+    references has been committed, so that no file is removed for a reference
+    which is rolled back. Holding the write lock, no other transaction can add
+    a reference while the files are removed. Files left behind by a failure
+    are removed by `gc-images`. It does not use the app context, see
+    `run_write`.
+    """
+    for filename in filenames:
+        if db.execute(
+                "SELECT 1 FROM post_image WHERE filename = ? LIMIT 1",
+                (filename,)).fetchone() is not None:
+            continue
+        names = [filename]
+        manifest_path = find_path(
+            upload_dir, get_manifest_filename(filename), layout)
+        try:
+            if manifest_path is None:
+                raise FileNotFoundError(get_manifest_filename(filename))
+            with open(manifest_path) as f:
+                variants = json.load(f)["variants"]
+            names.extend(variant["filename"] for variant in variants)
+        except FileNotFoundError:
+            pass
+        else:
+            names.append(get_manifest_filename(filename))
+        for name in names:
+            remove(upload_dir, name)
+
+
 def create_post_image_association(post_id, filename):
     """
     Create association of post id with image filename
@@ -63,15 +224,19 @@ def create_post_image_association(post_id, filename):
                      raised.
     :type filename: string
     """
-    if not os.path.exists(
-            os.path.join(current_app.config["UPLOAD_DIR"], filename)):
+    if find_upload_path(filename) is None:
         raise FileNotFoundError
-    db = get_db()
-    db.execute(
-        "INSERT INTO post_image (post_id, filename)"
-        " VALUES (?, ?)", (post_id, filename)
-    )
-    db.commit()
+
+    def create(db):
+        db.execute(
+            "INSERT INTO post_image (post_id, filename)"
+            " VALUES (?, ?)", (post_id, filename)
+        )
+        bump_content_versions(db, dependencies)
+
+    dependencies = ["posts", "post:{}".format(post_id)]
+    run_write(create)
+    invalidate_cached_responses(*dependencies)
 
 
 def get_image_of_post(post_id):
@@ -100,29 +265,87 @@ def delete_post_image_associations_of_post(post_id):
     """
     Delete post-image association and image for given post
 
-    The image on disk is also deleted.
+    The image and its variants on disk are only deleted when no other post
+    references the image.
 
     :param post_id: Id of the post for which the image associations shall be
                     deleted
     :type post_id: int
     """
-    image_filename = get_image_of_post(post_id)
-    os.remove(
-        os.path.join(current_app.config["UPLOAD_DIR"], image_filename))
-    db = get_db()
-    db.execute(
-        "DELETE FROM post_image WHERE post_id = ?",
-        (post_id,)
-    )
-    db.commit()
+    upload_dir = current_app.config["UPLOAD_DIR"]
+    layout = current_app.config["UPLOAD_DIR_LAYOUT"]
+
+    def delete(db):
+        rows = db.execute(
+            "SELECT filename FROM post_image WHERE post_id = ?", (post_id,)
+        ).fetchall()
+        db.execute("DELETE FROM post_image WHERE post_id = ?", (post_id,))
+        bump_content_versions(db, dependencies)
+        return [row["filename"] for row in rows]
+
+    dependencies = ["posts", "post:{}".format(post_id)]
+    filenames = run_write(delete)
+    invalidate_cached_responses(*dependencies)
+    if filenames:
+        run_locked_write(lambda db: _remove_unreferenced(
+            db, upload_dir, layout, filenames))
+
+
+def associate_received_image_with_post(temp_path, filename, post_id):
+    """
+    Store a received image and make it the image of the post
+
+    The image file is moved into place once the write transaction creating
+    the association has been committed. An image which was associated with
+    the post before is deleted afterwards, unless other posts reference it.
+
+    :param temp_path: Path of the temporary file returned by `receive_image`.
+    :type temp_path: str
+
+    :param filename: Filename returned by `receive_image`.
+    :type filename: str
+
+    :param post_id: Id of the post to which the image shall be associated.
+    :type post_id: int
+    """
+    upload_dir = current_app.config["UPLOAD_DIR"]
+    layout = current_app.config["UPLOAD_DIR_LAYOUT"]
+    upload_path = get_upload_path(filename)
+
+    def associate(db):
+        rows = db.execute(
+            "SELECT filename FROM post_image WHERE post_id = ?", (post_id,)
+        ).fetchall()
+        db.execute("DELETE FROM post_image WHERE post_id = ?", (post_id,))
+        db.execute(
+            "INSERT INTO post_image (post_id, filename) VALUES (?, ?)",
+            (post_id, filename)
+        )
+        bump_content_versions(db, dependencies)
+        return [row["filename"] for row in rows
+                if row["filename"] != filename]
+
+    dependencies = ["posts", "post:{}".format(post_id)]
+    try:
+        replaced = run_write(associate)
+        os.makedirs(os.path.dirname(upload_path), exist_ok=True)
+        os.replace(temp_path, upload_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    invalidate_cached_responses(*dependencies)
+    if replaced:
+        run_locked_write(lambda db: _remove_unreferenced(
+            db, upload_dir, layout, replaced))
+    generate_variants_in_background(filename)
 
 
 def save_image_and_create_or_update_post_association(image, post_id):
     """
     Save image and associate it with the post
 
-    If the post already has an image associated with it, that association and
-    file are deleted.
+    If the post already has an image associated with it, that association is
+    replaced and the file is deleted, unless other posts reference it.
 
     :param image: FileStorage object that is attached to the request
                   when uploaded and which shall be stored and associated with
@@ -132,10 +355,196 @@ def save_image_and_create_or_update_post_association(image, post_id):
     :param post_id: Id of the post to which the image shall be associated.
     :type post_id: int
     """
-    current_associatied_image = get_image_of_post(post_id=post_id)
-    if current_associatied_image:
-        delete_post_image_associations_of_post(post_id=post_id)
-    saved_filename = save_image_to_upload_dir(filestrorage_obj=image)
-    create_post_image_association(post_id=post_id, filename=saved_filename)
+    temp_path, filename = receive_image(image)
+    associate_received_image_with_post(temp_path, filename, post_id)
+
+
+# Downscaled and WebP variants of an original, see `flaskr.variants`
+VARIANT_FILENAME = re.compile(r"^(.+)\.\d+w(\.[^.]*)?$")
+
+
+def _get_owner(filename):
+    """
+    Return the original image to which a file in the upload directory belongs
+
+    :returns: Tuple of the filename of the original and its stem. The filename
+              is None for variants, of which only the stem is known. Both are
+              None for temporary files.
+    :rtype: tuple
+    """
+    if filename.endswith(".tmp"):
+        return None, None
+    manifest_suffix = get_manifest_filename("")
+    if filename.endswith(manifest_suffix):
+        original = filename[:-len(manifest_suffix)]
+        return original, os.path.splitext(original)[0]
+    match = VARIANT_FILENAME.match(filename)
+    if match:
+        return None, match.group(1)
+    return filename, os.path.splitext(filename)[0]
+
+
+def _is_referenced(db, original, stem):
+    """Return whether a post references the original the file belongs to"""
+    if original is not None:
+        query, params = "filename = ?", (original,)
+    elif stem is not None:
+        # Any original with the stem, "/" sorts right after "."
+        query = "filename = ? OR (filename >= ? AND filename < ?)"
+        params = (stem, stem + ".", stem + "/")
+    else:
+        return False
+    return db.execute(
+        "SELECT 1 FROM post_image WHERE " + query + " LIMIT 1", params
+    ).fetchone() is not None
+
+
+ImageGarbage = namedtuple(
+    "ImageGarbage", ("associations", "files", "bytes", "missing"))
+
+
+def collect_image_garbage(grace_period=3600, batch_size=1000,
+                          quarantine_dir=None, dry_run=False):
+    """
+    Remove files from the upload directory which no post references
+
+    Associations with deleted posts are removed first. The directory is then
+    streamed with `os.scandir` and each file is looked up in the set of
+    referenced filenames, which is read with one query. Files belonging to a
+    referenced image, i.e. the original, its variants and its manifest, are
+    kept. So are all files changed within the grace period, which may belong
+    to an upload in progress.
+
+    The orphans are removed in batches. Each batch is checked again holding
+    the write lock, see `run_locked_write`, so that files which were
+    referenced in the meantime are kept.
+
+    :param grace_period: Seconds for which new files are kept in any case.
+    :type grace_period: int
 
+    :param batch_size: Number of files removed in one transaction.
+    :type batch_size: int
 
+    :param quarantine_dir: Directory into which orphans are moved instead of
+                           removing them. It should be on the same file
+                           system as the upload directory.
+    :type quarantine_dir: str or None
+
+    :param dry_run: Only count the garbage without removing anything.
+    :type dry_run: bool
+
+    :returns: Number of removed associations, number and bytes of removed
+              files and the referenced filenames missing in the directory.
+    :rtype: ImageGarbage
+    """
+    upload_dir = current_app.config["UPLOAD_DIR"]
+    db = get_db()
+    if dry_run:
+        associations = db.execute(
+            "SELECT COUNT() FROM post_image"
+            " WHERE post_id NOT IN (SELECT id FROM post)").fetchone()[0]
+    else:
+        associations = run_write(lambda db: db.execute(
+            "DELETE FROM post_image"
+            " WHERE post_id NOT IN (SELECT id FROM post)").rowcount)
+
+    referenced = set()
+    referenced_stems = set()
+    query = "SELECT DISTINCT filename FROM post_image"
+    if dry_run:
+        query += " WHERE post_id IN (SELECT id FROM post)"
+    for (filename,) in db.execute(query):
+        referenced.add(filename)
+        referenced_stems.add(os.path.splitext(filename)[0])
+
+    if quarantine_dir is not None:
+        os.makedirs(quarantine_dir, exist_ok=True)
+
+    def remove_orphans(batch):
+        def remove_batch(db):
+            removed = []
+            for entry, original, stem, size in batch:
+                if _is_referenced(db, original, stem):
+                    continue
+                try:
+                    if quarantine_dir is None:
+                        os.remove(entry.path)
+                    else:
+                        os.replace(entry.path, os.path.join(
+                            quarantine_dir, entry.name))
+                except FileNotFoundError:
+                    continue
+                removed.append(size)
+            return removed
+
+        if dry_run:
+            return [size for *_, size in batch]
+        return run_locked_write(remove_batch)
+
+    found = set()
+    files = size = 0
+    batch = []
+    newest = time.time() - grace_period
+    for entry in iter_files(upload_dir):
+        if entry.name in referenced:
+            found.add(entry.name)
+            continue
+        original, stem = _get_owner(entry.name)
+        if original is None and stem in referenced_stems:
+            continue
+        if original is not None and original in referenced:
+            continue
+        stat = entry.stat(follow_symlinks=False)
+        if stat.st_mtime > newest:
+            continue
+        batch.append((entry, original, stem, stat.st_size))
+        if len(batch) >= batch_size:
+            removed = remove_orphans(batch)
+            files += len(removed)
+            size += sum(removed)
+            batch = []
+    if batch:
+        removed = remove_orphans(batch)
+        files += len(removed)
+        size += sum(removed)
+
+    return ImageGarbage(
+        associations=associations,
+        files=files,
+        bytes=size,
+        missing=sorted(referenced - found))
+
+
+@click.command("gc-images")
+@click.option("--grace-period", type=click.IntRange(min=0), default=3600,
+              show_default=True,
+              help="Seconds for which new files are kept in any case.")
+@click.option("--batch-size", type=click.IntRange(min=1), default=1000,
+              show_default=True, help="Number of files removed at once.")
+@click.option("--quarantine", "quarantine_dir", default=None,
+              type=click.Path(file_okay=False),
+              help="Move the orphaned files into this directory.")
+@click.option("--dry-run", is_flag=True,
+              help="Only report what would be removed.")
+@with_appcontext
+def gc_images_command(grace_period, batch_size, quarantine_dir, dry_run):
+    """Remove uploaded files which no post references"""
+    garbage = collect_image_garbage(
+        grace_period=grace_period, batch_size=batch_size,
+        quarantine_dir=quarantine_dir, dry_run=dry_run)
+    if dry_run:
+        verb = "Would remove"
+    elif quarantine_dir is None:
+        verb = "Removed"
+    else:
+        verb = "Quarantined"
+    click.echo("{} {} associations with deleted posts.".format(
+        "Would remove" if dry_run else "Removed", garbage.associations))
+    click.echo("{} {} files ({} bytes).".format(
+        verb, garbage.files, garbage.bytes))
+    for filename in garbage.missing:
+        click.echo("Missing referenced file {}.".format(filename))
+
+
+def init_app(app):
+    app.cli.add_command(gc_images_command)
@@ -4,7 +4,8 @@ from flask import Blueprint, request, redirect, url_for, g
 from werkzeug.exceptions import abort
 
 from flaskr.auth import login_required
-from flaskr.db import get_db
+from flaskr.cache import bump_content_versions, invalidate_cached_responses
+from flaskr.db import get_db, run_write
 
 bp = Blueprint("likes", __name__, url_prefix="/likes")
 
@@ -19,20 +20,94 @@ def get_users_liking_post(post_id):
     return user_ids
 
 
+def user_likes_post(user_id, post_id):
+    """
+    Check if the user likes the post
+
+    The check is answered from the unique index of the likes, no matter how
+    many likes the post has.
+
+    :param user_id: Id of the user.
+    :type user_id: int
+
+    :param post_id: Id of the post.
+    :type post_id: int
+
+    :rtype: bool
+    """
+    row = get_db().execute(
+        "SELECT 1 FROM like WHERE user_id = ? AND post_id = ?",
+        (user_id, post_id)
+    ).fetchone()
+    return row is not None
+
+
+def create_like(user_id, post_id):
+    """
+    Create a like and increment the like count of the post
+
+    Raises `sqlite3.IntegrityError` if the user already likes the post.
+
+    :param user_id: Id of the user liking the post.
+    :type user_id: int
+
+    :param post_id: Id of the post being liked.
+    :type post_id: int
+    """
+    def create(db):
+        db.execute(
+            "INSERT INTO like (user_id, post_id) "
+            " VALUES (?, ?)",
+            (user_id, post_id)
+        )
+        db.execute(
+            "UPDATE post SET like_count = like_count + 1 WHERE id = ?",
+            (post_id,)
+        )
+        bump_content_versions(db, dependencies)
+
+    dependencies = ["post:{}".format(post_id)]
+    run_write(create)
+    invalidate_cached_responses(*dependencies)
+
+
+def delete_like(user_id, post_id):
+    """
+    Delete a like and decrement the like count of the post
+
+    Nothing happens if the user does not like the post.
+
+    :param user_id: Id of the user who liked the post.
+    :type user_id: int
+
+    :param post_id: Id of the post which was liked.
+    :type post_id: int
+    """
+    def delete(db):
+        cursor = db.execute(
+            "DELETE FROM like WHERE user_id = ? AND post_id = ?",
+            (user_id, post_id)
+        )
+        if cursor.rowcount:
+            db.execute(
+                "UPDATE post SET like_count = like_count - ? WHERE id = ?",
+                (cursor.rowcount, post_id)
+            )
+            bump_content_versions(db, dependencies)
+
+    dependencies = ["post:{}".format(post_id)]
+    run_write(delete)
+    invalidate_cached_responses(*dependencies)
+
+
 @bp.route("/create", methods=("POST",))
 @login_required
 def create():
     post_id = request.form["post_id"]
     user_id = g.user["id"]
 
-    db = get_db()
     try:
-        db.execute(
-            "INSERT INTO like (user_id, post_id) "
-            " VALUES (?, ?)",
-            (user_id, post_id)
-        )
-        db.commit()
+        create_like(user_id=user_id, post_id=post_id)
     except IntegrityError:
         abort(403, "Like already exists")
 
@@ -47,11 +122,6 @@ def delete():
     # users likes.
     user_id = g.user["id"]
 
-    db = get_db()
-    db.execute(
-        "DELETE FROM like WHERE user_id = ? AND post_id = ?",
-        (user_id, post_id)
-    )
-    db.commit()
+    delete_like(user_id=user_id, post_id=post_id)
 
     return redirect(url_for("blog.detail", id=post_id))
@@ -0,0 +1,197 @@
+"""
+Versioned schema migrations for existing databases
+
+The schema version of a database is stored in its `user_version` PRAGMA.
+`init-db` creates the latest schema from `schema.sql`, which sets the version
+to the number of migrations. `migrate-db` applies the migrations which are
+missing in an existing database, each in a transaction of its own. The
+transaction is begun explicitly, because sqlite3 does not begin one for DDL
+statements, so that a failing migration leaves no partial changes.
+
+New migrations are appended to `MIGRATIONS` and `schema.sql` has to be
+changed accordingly, including its `user_version`. Migrations must not be
+changed or reordered once they have been released. They should tolerate
+databases which have already been created with some of their changes.
+"""
+import click
+from flask.cli import with_appcontext
+
+from flaskr.db import get_db, run_write
+
+
+MIGRATIONS = []
+
+
+def migration(func):
+    """Register a migration function. The version is its position."""
+    MIGRATIONS.append(func)
+    return func
+
+
+def column_exists(db, table, column):
+    """Check if the table in the database has a column with the given name"""
+    rows = db.execute("PRAGMA table_info({})".format(table)).fetchall()
+    return column in [row["name"] for row in rows]
+
+
+@migration
+def add_post_tag_string(db):
+    """Add the denormalized tag_string column to post"""
+    if not column_exists(db, "post", "tag_string"):
+        db.execute(
+            "ALTER TABLE post ADD COLUMN tag_string TEXT NOT NULL DEFAULT ''")
+    db.execute(
+        "UPDATE post SET tag_string = COALESCE(("
+        "  SELECT GROUP_CONCAT(t.name, ' ')"
+        "  FROM post_tag pt JOIN tag t ON pt.tag_id = t.id"
+        "  WHERE pt.post_id = post.id), '')"
+    )
+
+
+@migration
+def add_post_search_index(db):
+    """Add the full-text search index of the posts and its triggers"""
+    db.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5("
+        " title, body, tags, tokenize = 'unicode61 remove_diacritics 2')"
+    )
+    db.execute("DROP TRIGGER IF EXISTS post_fts_after_insert_post_tag")
+    db.execute("DROP TRIGGER IF EXISTS post_fts_after_delete_post_tag")
+    db.execute(
+        "CREATE TRIGGER IF NOT EXISTS post_fts_after_insert_post"
+        " AFTER INSERT ON post BEGIN"
+        "  INSERT INTO post_fts (rowid, title, body, tags)"
+        "  VALUES (new.id, new.title, new.body, new.tag_string);"
+        " END"
+    )
+    db.execute("DROP TRIGGER IF EXISTS post_fts_after_update_post")
+    db.execute(
+        "CREATE TRIGGER post_fts_after_update_post"
+        " AFTER UPDATE OF title, body, tag_string ON post BEGIN"
+        "  UPDATE post_fts"
+        "  SET title = new.title, body = new.body, tags = new.tag_string"
+        "  WHERE rowid = new.id;"
+        " END"
+    )
+    db.execute(
+        "CREATE TRIGGER IF NOT EXISTS post_fts_after_delete_post"
+        " AFTER DELETE ON post BEGIN"
+        "  DELETE FROM post_fts WHERE rowid = old.id;"
+        " END"
+    )
+    db.execute("DELETE FROM post_fts")
+    db.execute(
+        "INSERT INTO post_fts (rowid, title, body, tags)"
+        " SELECT id, title, body, tag_string FROM post"
+    )
+
+
+@migration
+def add_secondary_indexes(db):
+    """Add indexes for the columns the views filter and order by"""
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS post_author_id_idx ON post (author_id)")
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS post_created_idx ON post (created)")
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS comment_post_id_idx ON comment (post_id)")
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS like_post_id_user_id_idx"
+        " ON like (post_id, user_id)")
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS post_tag_tag_id_post_id_idx"
+        " ON post_tag (tag_id, post_id)")
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS post_image_post_id_idx"
+        " ON post_image (post_id)")
+
+
+@migration
+def add_post_like_count(db):
+    """Add the denormalized like_count column to post"""
+    if not column_exists(db, "post", "like_count"):
+        db.execute(
+            "ALTER TABLE post"
+            " ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0")
+    db.execute(
+        "UPDATE post SET like_count = ("
+        "  SELECT COUNT() FROM like WHERE like.post_id = post.id)"
+    )
+
+
+@migration
+def add_content_version(db):
+    """Add the table of content versions used as response validators"""
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS content_version ("
+        " name TEXT PRIMARY KEY,"
+        " counter INTEGER NOT NULL,"
+        " modified INTEGER NOT NULL)"
+    )
+
+
+@migration
+def add_post_render_options(db):
+    """Add the column recording the options body_html is rendered with"""
+    if not column_exists(db, "post", "render_options"):
+        db.execute(
+            "ALTER TABLE post"
+            " ADD COLUMN render_options TEXT NOT NULL DEFAULT ''")
+
+
+@migration
+def add_post_image_filename_index(db):
+    """Add the index to count the references of a stored image"""
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS post_image_filename_idx"
+        " ON post_image (filename)")
+
+
+def get_schema_version():
+    """Return the schema version of the current app's database"""
+    return get_db().execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate_db():
+    """
+    Apply the missing migrations to the current app's database
+
+    :returns: Names of the applied migrations.
+    :rtype: list
+    """
+    version = get_schema_version()
+    if version > len(MIGRATIONS):
+        raise click.ClickException(
+            "The database schema version {} is newer than this app's {}."
+            .format(version, len(MIGRATIONS)))
+
+    applied = []
+    for new_version, func in enumerate(MIGRATIONS[version:], version + 1):
+        def apply(db, func=func, new_version=new_version):
+            db.execute("BEGIN")
+            try:
+                func(db)
+                db.execute("PRAGMA user_version = {:d}".format(new_version))
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+        run_write(apply, transactional=False)
+        applied.append(func.__name__)
+    return applied
+
+
+@click.command("migrate-db")
+@with_appcontext
+def migrate_db_command():
+    """Apply missing schema migrations to the existing database"""
+    applied = migrate_db()
+    for name in applied:
+        click.echo("Applied migration {}.".format(name))
+    click.echo("The database schema is at version {}.".format(
+        get_schema_version()))
+
+
+def init_app(app):
+    app.cli.add_command(migrate_db_command)
@@ -1,9 +1,13 @@
 from math import ceil
 
+from flask import current_app, request
+
 
 class Pagination(object):
     """Class to hold state of pagination"""
 
+    is_keyset = False
+
     def __init__(self, total_items, items_per_page, current_page):
         """
         Initialize Pagination object
@@ -89,3 +93,280 @@ class Pagination(object):
         The returned offset in that case would be 5.
         """
         return (self.current_page - 1) * self.items_per_page
+
+    def key_condition(self, key, cursor_key="?", cursor_params=(),
+                      descending=True, fallback_key=None,
+                      fallback_cursor_key="?"):
+        """
+        Return SQL condition and parameters restricting rows to the page
+
+        Offset based pagination does not restrict the rows by their key, the
+        page is selected by the limit clause instead. This method exists so
+        that views can treat offset and keyset pagination the same way.
+
+        :param key: SQL expression of the key the rows are ordered by.
+        :type key: str
+
+        :param cursor_key: SQL expression evaluating to the key of the cursor.
+        :type cursor_key: str
+
+        :param cursor_params: Parameters of placeholders in the `cursor_key`
+                              which precede the placeholder of the cursor id.
+        :type cursor_params: tuple
+
+        :param descending: Whether the rows are ordered by descending key.
+        :type descending: bool
+
+        :param fallback_key: SQL expression of the key the rows are compared
+                             by if the cursor item does not exist.
+        :type fallback_key: str or None
+
+        :param fallback_cursor_key: SQL expression evaluating to the fallback
+                                    key of the cursor.
+        :type fallback_cursor_key: str
+
+        :returns: Tuple of SQL condition and tuple of its parameters.
+        :rtype: tuple
+        """
+        return "1", ()
+
+    def order_by(self, *columns, descending=True):
+        """
+        Return SQL order by expression for the given columns
+
+        :param columns: SQL expressions of the columns to order by.
+        :type columns: str
+
+        :param descending: Whether the rows are ordered descending.
+        :type descending: bool
+
+        :rtype: str
+        """
+        direction = " DESC" if descending else " ASC"
+        return ", ".join(column + direction for column in columns)
+
+    def limit_clause(self):
+        """
+        Return SQL limit clause and its parameters for the current page
+
+        :returns: Tuple of SQL limit clause and tuple of its parameters.
+        :rtype: tuple
+        """
+        return "LIMIT ? OFFSET ?", (self.items_per_page, self.item_offset)
+
+    def paginate(self, rows):
+        """
+        Return the rows to display on the current page
+
+        The rows selected with an offset based limit clause are all displayed.
+        """
+        return rows
+
+
+class KeysetPagination(object):
+    """
+    Class to hold state of keyset (aka. seek or cursor) based pagination
+
+    Instead of skipping a number of rows with an offset, the rows of a page
+    are selected by comparing their key with the key of a cursor item. The
+    `after` cursor is the id of the last item of the previous page and the
+    `before` cursor is the id of the first item of the following page.
+
+    The key comparison can be answered from an index, so that the cost of
+    selecting a page does not depend on how deep into the item set the page
+    is. There is no need to count the total number of items either. The
+    trade-off is that the pages are not numbered.
+    """
+
+    is_keyset = True
+
+    def __init__(self, items_per_page, after=None, before=None):
+        """
+        Initialize KeysetPagination object
+
+        :param items_per_page: Number of items which to display on one page.
+        :type items_per_page: int
+
+        :param after: Id of the item after which the page starts.
+        :type after: int or None
+
+        :param before: Id of the item before which the page ends. Ignored if
+                       `after` is given.
+        :type before: int or None
+        """
+        super(KeysetPagination, self).__init__()
+        self.items_per_page = items_per_page
+        self.after = after
+        self.before = before if after is None else None
+        self.has_previous = after is not None
+        self.has_next = self.before is not None
+        self.previous = None
+        self.next = None
+
+    @property
+    def is_backwards(self):
+        """Check if the page is selected backwards from the `before` cursor"""
+        return self.before is not None
+
+    @property
+    def is_first(self):
+        """Check if the current page is the first"""
+        return not(self.has_previous)
+
+    @property
+    def is_last(self):
+        """Check if the current page is the last"""
+        return not(self.has_next)
+
+    def key_condition(self, key, cursor_key="?", cursor_params=(),
+                      descending=True, fallback_key=None,
+                      fallback_cursor_key="?"):
+        """
+        Return SQL condition and parameters restricting rows to the page
+
+        The condition compares the key of the rows with the key of the cursor
+        item. For composite keys, SQL row values can be passed, e.g. a `key` of
+        `(p.created, p.id)` with a `cursor_key` of
+        `(SELECT created, id FROM post WHERE id = ?)`. The placeholder in the
+        `cursor_key` is bound to the cursor id.
+
+        Such a `cursor_key` is NULL if the cursor item has been deleted, and no
+        row would be selected. The rows are then compared by `fallback_key`
+        with `fallback_cursor_key`, which are ordered the same way, e.g.
+        `p.id`.
+
+        :param key: SQL expression of the key the rows are ordered by.
+        :type key: str
+
+        :param cursor_key: SQL expression evaluating to the key of the cursor.
+        :type cursor_key: str
+
+        :param cursor_params: Parameters of placeholders in the `cursor_key`
+                              which precede the placeholder of the cursor id.
+        :type cursor_params: tuple
+
+        :param descending: Whether the rows are ordered by descending key.
+        :type descending: bool
+
+        :param fallback_key: SQL expression of the key the rows are compared
+                             by if the cursor item does not exist.
+        :type fallback_key: str or None
+
+        :param fallback_cursor_key: SQL expression evaluating to the fallback
+                                    key of the cursor. Its placeholder is
+                                    bound to the cursor id.
+        :type fallback_cursor_key: str
+
+        :returns: Tuple of SQL condition and tuple of its parameters.
+        :rtype: tuple
+        """
+        if self.after is not None:
+            cursor = self.after
+            operator = "<" if descending else ">"
+        elif self.before is not None:
+            cursor = self.before
+            operator = ">" if descending else "<"
+        else:
+            return "1", ()
+        condition = "{} {} {}".format(key, operator, cursor_key)
+        params = tuple(cursor_params) + (cursor,)
+        if fallback_key is not None:
+            condition = "COALESCE({}, {} {} {})".format(
+                condition, fallback_key, operator, fallback_cursor_key)
+            params += (cursor,)
+        return condition, params
+
+    def order_by(self, *columns, descending=True):
+        """
+        Return SQL order by expression for the given columns
+
+        When the page is selected backwards from the `before` cursor, the
+        direction is reversed. `paginate` restores the display order.
+
+        :param columns: SQL expressions of the columns to order by.
+        :type columns: str
+
+        :param descending: Whether the rows are displayed descending.
+        :type descending: bool
+
+        :rtype: str
+        """
+        if descending != self.is_backwards:
+            direction = " DESC"
+        else:
+            direction = " ASC"
+        return ", ".join(column + direction for column in columns)
+
+    def limit_clause(self):
+        """
+        Return SQL limit clause and its parameters for the current page
+
+        One more row than displayed is selected to find out whether there is
+        another page in the direction of selection.
+
+        :returns: Tuple of SQL limit clause and tuple of its parameters.
+        :rtype: tuple
+        """
+        return "LIMIT ?", (self.items_per_page + 1,)
+
+    def paginate(self, rows, key="id"):
+        """
+        Return the rows to display on the current page and set the cursors
+
+        :param rows: Rows selected with the condition, order and limit clause
+                     of this pagination object.
+        :type rows: list
+
+        :param key: Name of the column holding the item id used as cursor.
+        :type key: str
+
+        :returns: Rows to display in display order.
+        :rtype: list
+        """
+        rows = list(rows)
+        has_more = len(rows) > self.items_per_page
+        rows = rows[:self.items_per_page]
+        if self.is_backwards:
+            rows.reverse()
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+
+        if rows and self.has_previous:
+            self.previous = rows[0][key]
+        if rows and self.has_next:
+            self.next = rows[-1][key]
+        return rows
+
+
+# Query arguments read by `get_pagination`
+PAGINATION_ARGS = ("page", "after", "before")
+
+
+def get_pagination(count_items):
+    """
+    Create the pagination object for the current request
+
+    Keyset pagination is used when the app's `PAGINATION_MODE` is "keyset" or
+    when the request contains an `after` or `before` cursor. Otherwise, offset
+    based pagination with page numbers is used.
+
+    :param count_items: Callable returning the total number of items. It is
+                        only called for offset based pagination.
+    :type count_items: callable
+
+    :rtype: Pagination or KeysetPagination
+    """
+    items_per_page = current_app.config["POSTS_PER_PAGE"]
+    after = request.args.get("after", type=int)
+    before = request.args.get("before", type=int)
+    if (after is not None or before is not None
+            or current_app.config["PAGINATION_MODE"] == "keyset"):
+        return KeysetPagination(
+            items_per_page=items_per_page, after=after, before=before)
+
+    page = int(request.args.get("page", default="1"))
+    return Pagination(
+        total_items=count_items(),
+        items_per_page=items_per_page,
+        current_page=page)
@@ -0,0 +1,164 @@
+"""
+Hashing and verification of passwords
+
+The hash method and its cost are configured by `PASSWORD_HASH_METHOD` in the
+format of werkzeug's `generate_password_hash`, e.g. "scrypt:32768:8:1" or
+"pbkdf2:sha256:600000". Hashes created with other parameters are replaced on
+the next successful login of the user.
+
+Hashing is CPU bound. It runs in a pool of `PASSWORD_HASH_WORKERS` threads,
+so that a burst of logins can only occupy that many CPUs. At most
+`PASSWORD_HASH_MAX_PENDING` further requests wait for a free worker. Others
+get a `PasswordHashingBusyError` right away.
+"""
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class PasswordHashingBusyError(Exception):
+    """Raised when too many passwords are waiting to be hashed"""
+
+
+class PasswordHasher(object):
+    """Bounded pool of threads hashing and verifying passwords"""
+
+    def __init__(self, method, workers, max_pending):
+        """
+        Initialize PasswordHasher object
+
+        :param method: Hash method and parameters as understood by
+                       `generate_password_hash`.
+        :type method: str
+
+        :param workers: Number of passwords hashed at the same time.
+        :type workers: int
+
+        :param max_pending: Number of passwords waiting for a worker.
+        :type max_pending: int
+        """
+        super(PasswordHasher, self).__init__()
+        self.method = method
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="flaskr-password")
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHashingBusyError(
+                "Too many passwords are waiting to be hashed.")
+        try:
+            return self._executor.submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """Return the hash of the password with the configured method"""
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        """Check if the password matches the hash"""
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """Check if the hash has been created with other parameters"""
+        return pwhash.split("$", 1)[0] != get_method_prefix(self.method)
+
+
+@functools.lru_cache(maxsize=None)
+def get_method_prefix(method):
+    """
+    Return the prefix of the hashes created with the method
+
+    Werkzeug adds default parameters which are missing in the method, e.g.
+    "pbkdf2" creates hashes starting with "pbkdf2:sha256:<iterations>".
+    """
+    return generate_password_hash("", method).split("$", 1)[0]
+
+
+def get_password_hasher():
+    """Return the password hasher of the current app"""
+    return current_app.extensions["flaskr_password_hasher"]
+
+
+def hash_password(password):
+    """
+    Hash the password with the configured method in the hashing pool
+
+    :raises PasswordHashingBusyError: If the pool is too busy.
+    :rtype: str
+    """
+    return get_password_hasher().hash(password)
+
+
+def verify_password(pwhash, password):
+    """
+    Check the password against the hash in the hashing pool
+
+    :raises PasswordHashingBusyError: If the pool is too busy.
+    :rtype: bool
+    """
+    return get_password_hasher().verify(pwhash, password)
+
+
+def password_needs_rehash(pwhash):
+    """Check if the hash has been created with other parameters"""
+    return get_password_hasher().needs_rehash(pwhash)
+
+
+def benchmark_hash_method(method, duration=1.0):
+    """
+    Measure how many passwords one thread hashes per second with the method
+
+    :param method: Hash method and parameters.
+    :type method: str
+
+    :param duration: Minimum number of seconds to hash passwords for.
+    :type duration: float
+
+    :rtype: float
+    """
+    count = 0
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < duration:
+        generate_password_hash("benchmark password", method)
+        count += 1
+        elapsed = time.perf_counter() - start
+    return count / elapsed
+
+
+@click.command("benchmark-password-hashing")
+@click.option("--method", "methods", multiple=True,
+              help="Hash method to measure. Can be given several times."
+                   " Defaults to the configured and some common methods.")
+@click.option("--duration", type=float, default=1.0, show_default=True,
+              help="Seconds to hash passwords for per method.")
+@with_appcontext
+def benchmark_password_hashing_command(methods, duration):
+    """Report the passwords hashed per second for hash methods"""
+    if not methods:
+        methods = dict.fromkeys((
+            current_app.config["PASSWORD_HASH_METHOD"],
+            "scrypt:16384:8:1",
+            "scrypt:32768:8:1",
+            "pbkdf2:sha256:600000",
+            "pbkdf2:sha256:1000000",
+        ))
+    for method in methods:
+        rate = benchmark_hash_method(method, duration=duration)
+        click.echo("{:<24} {:>10.1f} hashes/s per thread".format(method, rate))
+
+
+def init_app(app):
+    app.extensions["flaskr_password_hasher"] = PasswordHasher(
+        method=app.config["PASSWORD_HASH_METHOD"],
+        workers=app.config["PASSWORD_HASH_WORKERS"],
+        max_pending=app.config["PASSWORD_HASH_MAX_PENDING"])
+    app.cli.add_command(benchmark_password_hashing_command)
@@ -0,0 +1,188 @@
+"""
+Rendering of the markdown bodies of posts to HTML
+
+The rendered HTML is stored in the `body_html` column of a post together with
+a digest of the rendering options in `render_options`. Posts rendered with
+other options than the current ones are stale and can be re-rendered with
+`flask rerender-posts`, e.g. after changing `MARKDOWN_EXTRAS`.
+
+Rendered HTML is cached in-process by the hash of the options and the body,
+so that unchanged bodies, e.g. of posts of which only the title is updated,
+are not rendered again.
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import markdown2
+from flask import current_app
+from flask.cli import with_appcontext
+
+from flaskr.cache import (
+    LRUCache, bump_content_versions, invalidate_cached_responses
+)
+from flaskr.db import get_db, run_write
+
+
+def get_render_options(app=None):
+    """
+    Return the digest of the current rendering options
+
+    The digest changes with the configured `MARKDOWN_EXTRAS` and the version
+    of markdown2.
+
+    :rtype: str
+    """
+    app = app or current_app
+    options = json.dumps(
+        [markdown2.__version__, sorted(app.config["MARKDOWN_EXTRAS"])])
+    return hashlib.sha1(options.encode("utf8")).hexdigest()
+
+
+def _render(body, extras):
+    """Render markdown to HTML. This runs in the workers of the pool too."""
+    return markdown2.markdown(body, extras=list(extras))
+
+
+def get_render_cache():
+    """Return the cache of rendered HTML of the current app"""
+    return current_app.extensions["flaskr_render_cache"]
+
+
+def render_markdown(body):
+    """
+    Render the markdown body of a post with the current rendering options
+
+    :param body: Markdown body of a post.
+    :type body: str
+
+    :returns: Tuple of the HTML and the digest of the rendering options.
+    :rtype: tuple
+    """
+    options = get_render_options()
+    key = hashlib.sha256(
+        (options + "\0" + body).encode("utf8")).hexdigest()
+    cache = get_render_cache()
+    html = cache.get(key)
+    if html is None:
+        html = _render(body, current_app.config["MARKDOWN_EXTRAS"])
+        cache.set(key, html)
+    return html, options
+
+
+def render_markdown_batch(bodies, extras, pool=None, workers=1):
+    """
+    Render many markdown bodies, in parallel if a process pool is given
+
+    :param bodies: Markdown bodies.
+    :type bodies: list
+
+    :param extras: Extras of markdown2 to render the bodies with.
+    :type extras: tuple
+
+    :param pool: Pool of processes rendering the bodies or None to render
+                 them in this process.
+    :type pool: concurrent.futures.ProcessPoolExecutor or None
+
+    :param workers: Number of processes in the pool.
+    :type workers: int
+
+    :returns: HTML of the bodies in their order.
+    :rtype: list
+    """
+    if pool is None:
+        return [_render(body, extras) for body in bodies]
+    return list(pool.map(
+        _render, bodies, [extras] * len(bodies),
+        chunksize=max(1, len(bodies) // (4 * workers))))
+
+
+def rerender_posts(rerender_all=False, workers=None, batch_size=100):
+    """
+    Re-render the bodies of stale posts with the current rendering options
+
+    The posts are rendered in parallel by a pool of processes. The results
+    of each batch are written in one transaction. A post which has been
+    changed in the meantime is left alone, because it has been rendered with
+    its new body already.
+
+    :param rerender_all: Re-render all posts, not only the stale ones.
+    :type rerender_all: bool
+
+    :param workers: Number of processes rendering the posts. The posts are
+                    rendered in this process if it is 1. Defaults to the
+                    number of CPUs.
+    :type workers: int or None
+
+    :param batch_size: Number of posts read, rendered and written at once.
+    :type batch_size: int
+
+    :returns: Number of re-rendered posts.
+    :rtype: int
+    """
+    options = get_render_options()
+    extras = tuple(current_app.config["MARKDOWN_EXTRAS"])
+    condition = "1" if rerender_all else "render_options != ?"
+    condition_params = () if rerender_all else (options,)
+    workers = workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    count = 0
+    last_id = 0
+    try:
+        while True:
+            rows = get_db().execute(
+                "SELECT id, body FROM post WHERE id > ? AND " + condition +
+                " ORDER BY id LIMIT ?",
+                (last_id,) + condition_params + (batch_size,)
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]["id"]
+
+            htmls = render_markdown_batch(
+                [row["body"] for row in rows], extras,
+                pool=pool, workers=workers)
+            updates = [(html, options, row["id"], row["body"])
+                       for html, row in zip(htmls, rows)]
+
+            dependencies = ["posts"] + [
+                "post:{}".format(row["id"]) for row in rows]
+
+            def update(db):
+                db.executemany(
+                    "UPDATE post SET body_html = ?, render_options = ?"
+                    " WHERE id = ? AND body = ?",
+                    updates
+                )
+                bump_content_versions(db, dependencies)
+
+            run_write(update)
+            invalidate_cached_responses(*dependencies)
+            count += len(rows)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return count
+
+
+@click.command("rerender-posts")
+@click.option("--all", "rerender_all", is_flag=True,
+              help="Re-render all posts, not only the stale ones.")
+@click.option("--workers", type=click.IntRange(min=1), default=None,
+              help="Number of rendering processes. Defaults to the CPUs.")
+@click.option("--batch-size", type=click.IntRange(min=1), default=100,
+              show_default=True, help="Number of posts written at once.")
+@with_appcontext
+def rerender_posts_command(rerender_all, workers, batch_size):
+    """Re-render the HTML of the posts with the current markdown extras"""
+    count = rerender_posts(
+        rerender_all=rerender_all, workers=workers, batch_size=batch_size)
+    click.echo("Re-rendered {} posts.".format(count))
+
+
+def init_app(app):
+    app.extensions["flaskr_render_cache"] = LRUCache(
+        max_entries=app.config["MARKDOWN_RENDER_CACHE_SIZE"])
+    app.cli.add_command(rerender_posts_command)
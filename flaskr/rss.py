@@ -1,17 +1,256 @@
-from flask import Blueprint, render_template
+"""
+RSS and JSON feeds of the newest posts
 
+The first page of each feed is the same for every client and polled the most.
+It is published as a static snapshot into `FEED_SNAPSHOT_DIR` whenever a post
+is created, updated or deleted, and sent from the file without querying the
+database. The feeds are rendered from the database as long as there is no
+snapshot and for all further pages.
+"""
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import click
+from flask import (
+    Blueprint, abort, current_app, render_template, request, send_file,
+    stream_template, url_for
+)
+from flask.cli import with_appcontext
+
+from flaskr.auth import skip_user_lookup
+from flaskr.cache import cached_response, conditional_response
 from flaskr.db import get_db
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
 bp = Blueprint("rss", __name__)
 
+# File names of the snapshots, media types and endpoints of the feed formats
+FEED_FORMATS = {
+    "rss": ("feed.rss", "application/rss+xml", "rss.send_feed"),
+    "json": ("feed.json", "application/feed+json", "rss.send_json_feed"),
+}
 
-@bp.route("/feed.rss")
-def send_feed():
-    db = get_db()
-    posts = db.execute(
+
+def get_feed_page(page, endpoint):
+    """
+    Return the posts of a page of the feed and the links to other pages
+
+    The feed is paged as described in RFC 5005. Each page contains at most
+    `RSS_FEED_ITEMS` posts and links to the next (older) and previous (newer)
+    page by the `page` argument.
+
+    :param page: Number of the page, starting at 1.
+    :type page: int
+
+    :param endpoint: Endpoint of the feed format the links point to.
+    :type endpoint: str
+
+    :returns: Tuple of the list of posts and a dictionary mapping link
+              relations to URLs.
+    :rtype: tuple
+    """
+    items_per_page = current_app.config["RSS_FEED_ITEMS"]
+    # One more post than shown is selected to know whether there is a next page
+    posts = get_db().execute(
         "SELECT p.id, p.title, p.created, u.username"
         " FROM post p "
         " JOIN user u ON p.author_id = u.id"
         " ORDER BY p.id DESC"
+        " LIMIT ? OFFSET ?",
+        (items_per_page + 1, (page - 1) * items_per_page)
     ).fetchall()
-    return render_template("rss/feed.rss.j2", posts=posts)
+
+    def page_url(page):
+        return url_for(endpoint, page=page, _external=True)
+
+    links = {"self": page_url(page), "first": page_url(1)}
+    if page > 1:
+        links["previous"] = page_url(page - 1)
+    if len(posts) > items_per_page:
+        links["next"] = page_url(page + 1)
+    return posts[:items_per_page], links
+
+
+def render_json_feed(posts, links):
+    """Return a page of the feed as JSON Feed 1.1 document"""
+    feed = {
+        "version": "https://jsonfeed.org/version/1.1",
+        "title": "Flaskr",
+        "home_page_url": url_for("index", _external=True),
+        "feed_url": links["self"],
+        "description": "New Post's on the Flaskr Blog",
+        "items": [{
+            "id": str(post["id"]),
+            "url": url_for("blog.detail", id=post["id"], _external=True),
+            "title": post["title"],
+            "content_text": "A new post by {} on Flaskr".format(
+                post["username"]),
+            "date_published": post["created"].isoformat() + "Z",
+            "authors": [{"name": post["username"]}],
+        } for post in posts],
+    }
+    if "next" in links:
+        feed["next_url"] = links["next"]
+    return json.dumps(feed)
+
+
+def render_feed(feed_format, posts, links):
+    """Return a page of the feed in the given format as string"""
+    if feed_format == "json":
+        return render_json_feed(posts, links)
+    return render_template("rss/feed.rss.j2", posts=posts, links=links)
+
+
+def get_snapshot_path(feed_format):
+    """Return the path of the snapshot of the feed format"""
+    filename, _, _ = FEED_FORMATS[feed_format]
+    return os.path.join(current_app.config["FEED_SNAPSHOT_DIR"], filename)
+
+
+@contextmanager
+def lock_feed_snapshots():
+    """
+    Hold the lock of the snapshots
+
+    The lock is shared by the threads of the app and, where `fcntl` is
+    available, by all processes through a lock file in the snapshot directory.
+    """
+    snapshot_dir = current_app.config["FEED_SNAPSHOT_DIR"]
+    os.makedirs(snapshot_dir, exist_ok=True)
+    with current_app.extensions["flaskr_feed_snapshot_lock"]:
+        if fcntl is None:  # pragma: no cover
+            yield
+            return
+        with open(os.path.join(snapshot_dir, "snapshots.lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+
+def publish_feeds():
+    """
+    Write the snapshots of the first page of the feeds
+
+    The formats in `FEED_SNAPSHOT_FORMATS` are published. Each snapshot is
+    written to a temporary file which is then moved into place, so that the
+    snapshot is replaced atomically. This has to be called in a request
+    context after every committed change of the posts shown in the feeds.
+
+    Publishing is serialized by a lock held while the posts are read and the
+    snapshots are written. Otherwise a snapshot of posts read before a change
+    could replace the snapshot published after it.
+    """
+    snapshot_dir = current_app.config["FEED_SNAPSHOT_DIR"]
+    with lock_feed_snapshots():
+        for feed_format in current_app.config["FEED_SNAPSHOT_FORMATS"]:
+            _, _, endpoint = FEED_FORMATS[feed_format]
+            posts, links = get_feed_page(1, endpoint)
+            data = render_feed(feed_format, posts, links).encode("utf8")
+            fd, temp_path = tempfile.mkstemp(dir=snapshot_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, mode="wb") as f:
+                    f.write(data)
+                os.replace(temp_path, get_snapshot_path(feed_format))
+            except BaseException:
+                os.remove(temp_path)
+                raise
+
+
+def remove_feed_snapshots():
+    """
+    Remove the snapshots of all feed formats
+
+    The feeds are then rendered from the database until they are published
+    again. This has to be called holding `lock_feed_snapshots`.
+    """
+    for feed_format in FEED_FORMATS:
+        try:
+            os.remove(get_snapshot_path(feed_format))
+        except FileNotFoundError:
+            pass
+
+
+@click.command("publish-feeds")
+@with_appcontext
+def publish_feeds_command():
+    """Write the snapshots of the feeds, e.g. after init-db"""
+    # The links of the feeds are built for SERVER_NAME, if it is configured
+    with current_app.test_request_context():
+        publish_feeds()
+    click.echo("Published the feeds.")
+
+
+def init_app(app):
+    app.extensions["flaskr_feed_snapshot_lock"] = threading.Lock()
+    app.cli.add_command(publish_feeds_command)
+
+
+def send_feed_snapshot(feed_format):
+    """
+    Send the snapshot of the feed format or return None if there is none
+
+    The file is sent by the server without reading it in Python where
+    possible. Validators are derived from the file, so that conditional
+    requests are answered without touching the database.
+    """
+    if (feed_format not in current_app.config["FEED_SNAPSHOT_FORMATS"]
+            or "page" in request.args):
+        return None
+    _, mimetype, _ = FEED_FORMATS[feed_format]
+    try:
+        response = send_file(
+            get_snapshot_path(feed_format), mimetype=mimetype,
+            conditional=True, etag=True)
+    except FileNotFoundError:
+        return None
+    # Clients may store the feed, but have to revalidate it
+    response.cache_control.no_cache = True
+    return response
+
+
+@conditional_response("posts")
+@cached_response("posts", query_args=("page",))
+def send_feed_page(feed_format):
+    """
+    Send the requested page of the feed rendered from the database
+
+    The posts of the page are selected up front, but an RSS document is
+    rendered while it is sent.
+    """
+    page = request.args.get("page", default=1, type=int)
+    if page < 1:
+        abort(404)
+    posts, links = get_feed_page(page, request.endpoint)
+    if not posts and page > 1:
+        abort(404)
+
+    _, mimetype, _ = FEED_FORMATS[feed_format]
+    if feed_format == "json":
+        body = render_json_feed(posts, links)
+    else:
+        body = stream_template("rss/feed.rss.j2", posts=posts, links=links)
+    return current_app.response_class(body, mimetype=mimetype)
+
+
+@bp.route("/feed.rss")
+@skip_user_lookup
+def send_feed():
+    response = send_feed_snapshot("rss")
+    if response is None:
+        response = send_feed_page(feed_format="rss")
+    return response
+
+
+@bp.route("/feed.json")
+@skip_user_lookup
+def send_json_feed():
+    response = send_feed_snapshot("json")
+    if response is None:
+        response = send_feed_page(feed_format="json")
+    return response
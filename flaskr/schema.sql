@@ -1,3 +1,4 @@
+DROP TABLE IF EXISTS post_fts;
 DROP TABLE IF EXISTS user;
 DROP TABLE IF EXISTS post;
 DROP TABLE IF EXISTS comment;
@@ -5,6 +6,7 @@ DROP TABLE IF EXISTS like;
 DROP TABLE IF EXISTS tag;
 DROP TABLE IF EXISTS post_tag;
 DROP TABLE IF EXISTS post_image;
+DROP TABLE IF EXISTS content_version;
 
 CREATE TABLE user (
 	id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -19,6 +21,12 @@ CREATE TABLE post (
 	title TEXT NOT NULL,
 	body TEXT NOT NULL,
 	body_html TEXT,
+	-- Digest of the options body_html has been rendered with
+	render_options TEXT NOT NULL DEFAULT '',
+	-- Denormalized space separated names of the tags of the post
+	tag_string TEXT NOT NULL DEFAULT '',
+	-- Denormalized number of likes of the post
+	like_count INTEGER NOT NULL DEFAULT 0,
 	FOREIGN KEY (author_id) REFERENCES user (id)
 );
 
@@ -64,4 +72,49 @@ CREATE TABLE post_image (
 	post_id INTEGER NOT NULL,
 	filename TEXT NOT NULL, 
 	FOREIGN KEY (post_id) REFERENCES post (id)
-);
\ No newline at end of file
+);
+
+-- Versions of content shown by the views, e.g. "posts" or "post:1". They
+-- are incremented by the write paths and used as validators of responses.
+CREATE TABLE content_version (
+	name TEXT PRIMARY KEY,
+	counter INTEGER NOT NULL,
+	modified INTEGER NOT NULL -- Unix time
+);
+
+-- Full-text search index of the posts. The rowid is the id of the post.
+CREATE VIRTUAL TABLE post_fts USING fts5(
+	title,
+	body,
+	tags,
+	tokenize = 'unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER post_fts_after_insert_post AFTER INSERT ON post BEGIN
+	INSERT INTO post_fts (rowid, title, body, tags)
+	VALUES (new.id, new.title, new.body, new.tag_string);
+END;
+
+CREATE TRIGGER post_fts_after_update_post
+AFTER UPDATE OF title, body, tag_string ON post
+BEGIN
+	UPDATE post_fts
+	SET title = new.title, body = new.body, tags = new.tag_string
+	WHERE rowid = new.id;
+END;
+
+CREATE TRIGGER post_fts_after_delete_post AFTER DELETE ON post BEGIN
+	DELETE FROM post_fts WHERE rowid = old.id;
+END;
+
+CREATE INDEX post_author_id_idx ON post (author_id);
+CREATE INDEX post_created_idx ON post (created);
+CREATE INDEX comment_post_id_idx ON comment (post_id);
+CREATE INDEX like_post_id_user_id_idx ON like (post_id, user_id);
+CREATE INDEX post_tag_tag_id_post_id_idx ON post_tag (tag_id, post_id);
+CREATE INDEX post_image_post_id_idx ON post_image (post_id);
+-- Images are shared by posts and deleted with their last reference
+CREATE INDEX post_image_filename_idx ON post_image (filename);
+
+-- Number of migrations in flaskr.migrations contained in this schema
+PRAGMA user_version = 7;
@@ -1,44 +1,131 @@
-from flask import Blueprint, request, render_template, current_app
+import click
+from flask import Blueprint, request, render_template, redirect, url_for
+from flask.cli import with_appcontext
+from markupsafe import Markup, escape
 
-from flaskr.db import get_db
-from flaskr.pagination import Pagination
+from flaskr.cache import conditional_response
+from flaskr.db import get_db, run_write
+from flaskr.pagination import get_pagination
 
 
 bp = Blueprint("search", __name__, url_prefix="/search")
 
+# Control characters are used to mark the matches in the search results. They
+# can not be part of the indexed text and are turned into <mark> elements only
+# after the text has been escaped by the `highlight` template filter.
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_END = "\x03"
+
+
+def build_match_query(query):
+    """
+    Build a FTS5 match expression from the user's search query
+
+    Each whitespace separated word of the query is turned into a quoted prefix
+    query, so that FTS5 syntax characters in the query are treated as text.
+    All words have to be contained in a post for it to match.
+
+    :param query: Search query as entered by the user.
+    :type query: str
+
+    :returns: FTS5 match expression or None if the query contains no words.
+    :rtype: str or None
+    """
+    terms = ['"{}"*'.format(word.replace('"', '""'))
+             for word in query.split()]
+    if not terms:
+        return None
+    return " ".join(terms)
+
+
+@bp.app_template_filter("highlight")
+def highlight_filter(text):
+    """
+    Escape a highlighted search result text and mark the matches
+
+    The text stored in the database is already escaped. It is unescaped first
+    because the snippet might have cut through an HTML entity.
+    """
+    if not text:
+        return ""
+    text = escape(Markup(text).unescape())
+    return (text.replace(HIGHLIGHT_START, Markup("<mark>"))
+                .replace(HIGHLIGHT_END, Markup("</mark>")))
+
+
+def rebuild_search_index():
+    """
+    Rebuild the full-text search index from the post and tag tables
+
+    The index is kept up to date by triggers on the post table.
+    Rebuilding is only necessary for posts which have been created before the
+    index existed.
+    """
+    def rebuild(db):
+        db.execute("DELETE FROM post_fts")
+        db.execute(
+            "INSERT INTO post_fts (rowid, title, body, tags)"
+            " SELECT p.id, p.title, p.body, p.tag_string FROM post p"
+        )
+        db.execute("INSERT INTO post_fts (post_fts) VALUES ('optimize')")
+
+    run_write(rebuild)
+
+
+@click.command("rebuild-search-index")
+@with_appcontext
+def rebuild_search_index_command():
+    """Rebuild the full-text search index of the posts"""
+    rebuild_search_index()
+    click.echo("Rebuilt the search index.")
+
+
+def init_app(app):
+    app.cli.add_command(rebuild_search_index_command)
+
 
 @bp.route("/")
+@conditional_response("posts")
 def display_search_filtered_index():
     query = request.args["q"]
+    match = build_match_query(query)
+    if match is None:
+        return redirect(url_for("index"))
+
     db = get_db()
-    post_count = db.execute(
-        "SELECT COUNT()"
-        " FROM post p"
-        " JOIN user u ON p.author_id = u.id"
-        # LEFT JOIN makes the existence of values in the right table optional!
-        " LEFT JOIN post_tag pt ON p.id = pt.post_id"
-        " LEFT JOIN tag t ON pt.tag_id = t.id"
-        " WHERE p.title LIKE ?",
-        ("%" + query + "%",)
-    ).fetchone()[0]
-    page = int(request.args.get("page", default="1"))
-    pagination = Pagination(
-        total_items=post_count,
-        items_per_page=current_app.config["POSTS_PER_PAGE"],
-        current_page=page)
+    pagination = get_pagination(
+        count_items=lambda: db.execute(
+            "SELECT COUNT() FROM post_fts WHERE post_fts MATCH ?",
+            (match,)
+        ).fetchone()[0])
+    # Results are ordered by relevance (bm25). Ties are broken by showing the
+    # newer post first. The negated id keeps both key columns ascending.
+    condition, condition_params = pagination.key_condition(
+        "(f.rank, -p.id)",
+        cursor_key="(SELECT rank, -rowid FROM post_fts"
+                   " WHERE post_fts MATCH ? AND rowid = ?)",
+        cursor_params=(match,),
+        descending=False,
+        # If the cursor post is gone, its rank is unknown and the id decides.
+        fallback_key="-p.id",
+        fallback_cursor_key="-?")
+    limit, limit_params = pagination.limit_clause()
     posts = db.execute(
         "SELECT p.id, p.title, p.body, p.created, p.author_id, u.username,"
-        " GROUP_CONCAT(t.name, ' ') AS tag_string"
-        " FROM post p"
+        " p.tag_string,"
+        " (SELECT pi.filename FROM post_image pi WHERE pi.post_id = p.id)"
+        "  AS image_filename,"
+        " snippet(post_fts, 1, ?, ?, '…', 32) AS body_snippet"
+        " FROM post_fts f"
+        " JOIN post p ON f.rowid = p.id"
         " JOIN user u ON p.author_id = u.id"
-        # LEFT JOIN makes the existence of values in the right table optional!
-        " LEFT JOIN post_tag pt ON p.id = pt.post_id"
-        " LEFT JOIN tag t ON pt.tag_id = t.id"
-        " WHERE p.title LIKE ?"
-        " GROUP BY p.id"
-        " ORDER BY p.created DESC"
-        " LIMIT ? OFFSET ?",
-        ("%" + query + "%", pagination.items_per_page, pagination.item_offset)
+        " WHERE post_fts MATCH ? AND " + condition +
+        " ORDER BY " + pagination.order_by(
+            "f.rank", "-p.id", descending=False) +
+        " " + limit,
+        (HIGHLIGHT_START, HIGHLIGHT_END, match)
+        + condition_params + limit_params
     ).fetchall()
+    posts = pagination.paginate(posts)
     return render_template(
         "blog/index.html", posts=posts, search=query, pagination=pagination)
@@ -0,0 +1,23 @@
+// Load the next page of comments in place of the "More comments" link. The
+// link leads to a complete page of the comments without the script.
+document.addEventListener("click", function (event) {
+	var link = event.target.closest("a.more-comments");
+	if (link === null) {
+		return;
+	}
+	event.preventDefault();
+	fetch(link.href, {headers: {"X-Requested-With": "XMLHttpRequest"}})
+		.then(function (response) {
+			if (!response.ok) {
+				throw new Error(response.statusText);
+			}
+			return response.text();
+		})
+		.then(function (html) {
+			link.insertAdjacentHTML("beforebegin", html);
+			link.remove();
+		})
+		.catch(function () {
+			window.location.href = link.href;
+		});
+});
@@ -1,7 +1,13 @@
-from flask import Blueprint, render_template, current_app, request
+import click
+from flask import Blueprint, render_template
+from flask.cli import with_appcontext
 
-from flaskr.db import get_db
-from flaskr.pagination import Pagination
+from flaskr.cache import (
+    bump_content_versions, cached_response, conditional_response,
+    invalidate_cached_responses
+)
+from flaskr.db import execute_write, get_db, run_write
+from flaskr.pagination import PAGINATION_ARGS, get_pagination
 
 
 bp = Blueprint("tags", __name__, url_prefix="/tags")
@@ -17,20 +23,112 @@ def get_or_create_tag(name):
     :returns: Id of the tag created in the database or None if id not found.
     :rtype: int or None
     """
-    db = get_db()
     name = name.strip()
     if name:
         # Create the tag or ignore if it exists
-        db.execute("INSERT OR IGNORE INTO tag (name) VALUES (?)", (name,))
-        db.commit()
+        execute_write("INSERT OR IGNORE INTO tag (name) VALUES (?)", (name,))
         # Grab the id of the tag
-        tag_id = db.execute(
+        tag_id = get_db().execute(
             "SELECT (id) FROM tag WHERE name = ?", (name,)
         ).fetchone()["id"]
         return tag_id
     return None
 
 
+def _get_or_create_tags(db, names):
+    """
+    Get or create the tags with the given names using the given connection
+
+    All tags are created with one `executemany` and their ids are selected
+    with one query. The caller is responsible for committing.
+
+    :param db: Connection to use for the statements.
+    :type db: sqlite3.Connection
+
+    :param names: Names of the tags. The names have to be stripped already.
+    :type names: list
+
+    :returns: Dictionary mapping the tag names to the tag ids.
+    :rtype: dict
+    """
+    if not names:
+        return {}
+    db.executemany(
+        "INSERT OR IGNORE INTO tag (name) VALUES (?)",
+        [(name,) for name in names]
+    )
+    rows = db.execute(
+        "SELECT id, name FROM tag WHERE name IN ({})".format(
+            ", ".join("?" * len(names))),
+        tuple(names)
+    ).fetchall()
+    return {row["name"]: row["id"] for row in rows}
+
+
+# The tag names of a post joined by spaces are stored denormalized in the
+# `tag_string` column of the post, so that listings do not need to join and
+# group the tags of each post. It is maintained by the functions which change
+# the tag associations of a post.
+REFRESH_TAG_STRING_SQL = (
+    "UPDATE post SET tag_string = COALESCE(("
+    "  SELECT GROUP_CONCAT(t.name, ' ')"
+    "  FROM post_tag pt JOIN tag t ON pt.tag_id = t.id"
+    "  WHERE pt.post_id = post.id), '')"
+)
+
+
+def _refresh_tag_string(db, post_id):
+    """Recompute the stored tag string of a post from its associations"""
+    db.execute(REFRESH_TAG_STRING_SQL + " WHERE id = ?", (post_id,))
+
+
+def rebuild_tag_strings():
+    """Recompute the stored tag strings of all posts"""
+    run_write(lambda db: db.execute(REFRESH_TAG_STRING_SQL))
+
+
+@click.command("rebuild-tag-strings")
+@with_appcontext
+def rebuild_tag_strings_command():
+    """Recompute the stored tag strings of all posts"""
+    rebuild_tag_strings()
+    click.echo("Rebuilt the tag strings.")
+
+
+def init_app(app):
+    app.cli.add_command(rebuild_tag_strings_command)
+
+
+def parse_tag_string(tag_string):
+    """
+    Return the unique tag names contained in a string of space separated tags
+
+    :param tag_string: String of space separated words.
+    :type tag_string: str
+
+    :returns: List of tag names in the order of their first occurrence.
+    :rtype: list
+    """
+    return list(dict.fromkeys(tag_string.split()))
+
+
+def get_or_create_tags(names):
+    """
+    Get or create the tags with the given names in one transaction
+
+    :param names: Names or words that the tags are made of. Empty names are
+                  ignored.
+    :type names: list
+
+    :returns: Dictionary mapping the tag names to the tag ids.
+    :rtype: dict
+    """
+    names = [name.strip() for name in names if name.strip()]
+    if not names:
+        return {}
+    return run_write(lambda db: _get_or_create_tags(db, names))
+
+
 def get_or_create_tags_from_string(tag_string):
     """
     Get or create tags from a string of space separated tags.
@@ -46,8 +144,9 @@ def get_or_create_tags_from_string(tag_string):
     :returns: Tuple of ids of the tags in the database
     :rtype: tuple
     """
-    tag_names = tag_string.split(" ")
-    return tuple([get_or_create_tag(t) for t in tag_names if t.strip()])
+    tag_names = parse_tag_string(tag_string)
+    tag_ids = get_or_create_tags(tag_names)
+    return tuple([tag_ids[name] for name in tag_names])
 
 
 def get_tags_for_post(post_id):
@@ -79,12 +178,17 @@ def associate_tag_with_post(tag_id, post_id):
     :param post_id: Id of the post with which the tag shall be associated.
     :type post_id: int
     """
-    db = get_db()
-    db.execute(
-        "INSERT OR IGNORE INTO post_tag (tag_id, post_id)"
-        " VALUES (?, ?)", (tag_id, post_id)
-    )
-    db.commit()
+    def associate(db):
+        db.execute(
+            "INSERT OR IGNORE INTO post_tag (tag_id, post_id)"
+            " VALUES (?, ?)", (tag_id, post_id)
+        )
+        _refresh_tag_string(db, post_id)
+        bump_content_versions(db, dependencies)
+
+    dependencies = ["posts", "post:{}".format(post_id)]
+    run_write(associate)
+    invalidate_cached_responses(*dependencies)
 
 
 def disassociate_tag_from_post(tag_id, post_id):
@@ -97,12 +201,17 @@ def disassociate_tag_from_post(tag_id, post_id):
     :param post_id: Id of the post from which the tag shall be disassociated.
     :type post_id: int
     """
-    db = get_db()
-    db.execute(
-        "DELETE FROM post_tag WHERE post_id = ? AND tag_id = ?",
-        (post_id, tag_id)
-    )
-    db.commit()
+    def disassociate(db):
+        db.execute(
+            "DELETE FROM post_tag WHERE post_id = ? AND tag_id = ?",
+            (post_id, tag_id)
+        )
+        _refresh_tag_string(db, post_id)
+        bump_content_versions(db, dependencies)
+
+    dependencies = ["posts", "post:{}".format(post_id)]
+    run_write(disassociate)
+    invalidate_cached_responses(*dependencies)
 
 
 def remove_tag_associations_for_post(post_id):
@@ -112,9 +221,15 @@ def remove_tag_associations_for_post(post_id):
     :param post_id: Id of the post for which the associations should be removed
     :type post_id: int
     """
-    db = get_db()
-    db.execute("DELETE FROM post_tag WHERE post_id = ?", (post_id,))
-    db.commit()
+    def remove(db):
+        db.execute("DELETE FROM post_tag WHERE post_id = ?", (post_id,))
+        db.execute(
+            "UPDATE post SET tag_string = '' WHERE id = ?", (post_id,))
+        bump_content_versions(db, dependencies)
+
+    dependencies = ["posts", "post:{}".format(post_id)]
+    run_write(remove)
+    invalidate_cached_responses(*dependencies)
 
 
 def update_tag_associations_for_post(tag_string, post_id):
@@ -122,7 +237,9 @@ def update_tag_associations_for_post(tag_string, post_id):
     Update tag associations for a post.
 
     Tags are given as space separated words in a string. If a tag does not
-    exist in the DB it is created first.
+    exist in the DB it is created first. All tags are resolved in bulk and
+    the associations and the post's stored tag string are updated in a single
+    transaction.
 
     Associations in the DB with tags that are not contained in the `tag_string`
     are removed. This allows to delete all tag association by passing an empty
@@ -135,51 +252,66 @@ def update_tag_associations_for_post(tag_string, post_id):
     :param post_id: Id of the post the tags shall be associated with.
     :type post_id: int
     """
-    current_associated_tags = get_tags_for_post(post_id)
-    desired_associated_tags = tag_string.strip().split()
-
-    tags_to_add = [tag for tag in desired_associated_tags
-                   if tag not in current_associated_tags]
-    tags_to_remove = [tag for tag in current_associated_tags
-                      if tag not in desired_associated_tags]
-
-    for tag in tags_to_add:
-        tag_id = get_or_create_tag(tag)
-        associate_tag_with_post(tag_id=tag_id, post_id=post_id)
-
-    for tag in tags_to_remove:
-        tag_id = get_or_create_tag(tag)
-        disassociate_tag_from_post(tag_id=tag_id, post_id=post_id)
+    desired_tags = parse_tag_string(tag_string)
+
+    def update(db):
+        tag_ids = list(_get_or_create_tags(db, desired_tags).values())
+        # Only associations which do not exist yet are inserted and only
+        # associations which are not desired anymore are deleted.
+        db.execute(
+            "DELETE FROM post_tag WHERE post_id = ? AND tag_id NOT IN ({})"
+            .format(", ".join("?" * len(tag_ids))),
+            (post_id,) + tuple(tag_ids)
+        )
+        db.executemany(
+            "INSERT OR IGNORE INTO post_tag (tag_id, post_id) VALUES (?, ?)",
+            [(tag_id, post_id) for tag_id in tag_ids]
+        )
+        db.execute(
+            "UPDATE post SET tag_string = ? WHERE id = ?",
+            (" ".join(desired_tags), post_id)
+        )
+        bump_content_versions(db, dependencies)
+
+    dependencies = ["posts", "post:{}".format(post_id)]
+    run_write(update)
+    invalidate_cached_responses(*dependencies)
 
 
 @bp.route("/<string:tag>")
+@conditional_response("posts")
+@cached_response("posts", query_args=PAGINATION_ARGS)
 def display_tagged_posts(tag):
     db = get_db()
-    page = int(request.args.get("page", default="1"))
-    post_count = db.execute(
-        "SELECT COUNT()"
-        " FROM post p"
-        " JOIN user u ON p.author_id = u.id"
-        " JOIN post_tag pt ON p.id = pt.post_id"
-        " JOIN tag t ON pt.tag_id = t.id"
-        " WHERE t.name = ?",
-        (tag,)
-    ).fetchone()[0]
-    pagination = Pagination(
-        total_items=post_count,
-        items_per_page=current_app.config["POSTS_PER_PAGE"],
-        current_page=page)
+    pagination = get_pagination(
+        count_items=lambda: db.execute(
+            "SELECT COUNT()"
+            " FROM post p"
+            " JOIN user u ON p.author_id = u.id"
+            " JOIN post_tag pt ON p.id = pt.post_id"
+            " JOIN tag t ON pt.tag_id = t.id"
+            " WHERE t.name = ?",
+            (tag,)
+        ).fetchone()[0])
+    condition, condition_params = pagination.key_condition(
+        "(p.created, p.id)",
+        cursor_key="(SELECT created, id FROM post WHERE id = ?)",
+        fallback_key="p.id")
+    limit, limit_params = pagination.limit_clause()
     posts = db.execute(
-        "SELECT p.id, p.title, p.body, p.created, p.author_id, u.username"
-        # " GROUP_CONCAT(t.name, ' ') AS tag_string"
+        "SELECT p.id, p.title, p.body, p.body_html, p.created, p.author_id,"
+        " u.username, p.tag_string,"
+        " (SELECT pi.filename FROM post_image pi WHERE pi.post_id = p.id)"
+        "  AS image_filename"
         " FROM post p"
         " JOIN user u ON p.author_id = u.id"
         " JOIN post_tag pt ON p.id = pt.post_id"
         " JOIN tag t ON pt.tag_id = t.id"
-        " WHERE t.name = ?"
-        " ORDER BY p.created DESC"
-        " LIMIT ? OFFSET ?",
-        (tag, pagination.items_per_page, pagination.item_offset)
+        " WHERE t.name = ? AND " + condition +
+        " ORDER BY " + pagination.order_by("p.created", "p.id") +
+        " " + limit,
+        (tag,) + condition_params + limit_params
     ).fetchall()
+    posts = pagination.paginate(posts)
     return render_template(
         "blog/index.html", posts=posts, tag=tag, pagination=pagination)
@@ -0,0 +1,255 @@
+"""
+Bulk export and import of the content as newline delimited JSON
+
+Every line of the data is one record with a `type` of "user", "post",
+"comment" or "like". Users come first, then posts with the names of their tags
+and then comments and likes, so that every record only references records
+before it. The fields are stored as they are, i.e. titles and bodies are
+escaped like the forms store them. The rendered HTML is not part of the data,
+the bodies are rendered again on import. Images are not exported.
+
+Both directions stream the records, so they run in constant memory.
+"""
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from flaskr.cache import invalidate
+from flaskr.db import get_db, run_write
+from flaskr.rendering import get_render_options, render_markdown_batch
+from flaskr.rss import publish_feeds
+from flaskr.search import rebuild_search_index
+from flaskr.tags import parse_tag_string
+
+RECORD_TYPES = ("user", "post", "comment", "like")
+
+EXPORT_QUERIES = (
+    ("user", "SELECT id, username, password FROM user ORDER BY id"),
+    ("post",
+     "SELECT id, author_id, created, title, body, tag_string"
+     " FROM post ORDER BY id"),
+    ("comment",
+     "SELECT id, post_id, author_id, created, body FROM comment ORDER BY id"),
+    ("like", "SELECT user_id, post_id, created FROM like ORDER BY id"),
+)
+
+
+def export_records():
+    """
+    Generate the records of all content of the database
+
+    :returns: Iterator of dictionaries with the type and fields of a record.
+    :rtype: iterator
+    """
+    db = get_db()
+    for record_type, query in EXPORT_QUERIES:
+        for row in db.execute(query):
+            record = dict(row, type=record_type)
+            if record_type == "post":
+                record["tags"] = record.pop("tag_string").split()
+            if record.get("created") is not None:
+                record["created"] = str(record["created"])
+            yield record
+
+
+def _insert_users(db, records):
+    db.executemany(
+        "INSERT INTO user (id, username, password) VALUES (?, ?, ?)",
+        [(r["id"], r["username"], r["password"]) for r in records])
+
+
+def _insert_posts(db, records):
+    tag_names = [parse_tag_string(" ".join(r.get("tags", ())))
+                 for r in records]
+    db.executemany(
+        "INSERT INTO post (id, author_id, created, title, body, body_html,"
+        "  render_options, tag_string)"
+        " VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?, ?, ?, ?)",
+        [(r["id"], r["author_id"], r.get("created"), r["title"], r["body"],
+          r["body_html"], r["render_options"], " ".join(names))
+         for r, names in zip(records, tag_names)])
+    db.executemany(
+        "INSERT OR IGNORE INTO tag (name) VALUES (?)",
+        [(name,) for name in sorted(set(
+            itertools.chain.from_iterable(tag_names)))])
+    db.executemany(
+        "INSERT INTO post_tag (post_id, tag_id)"
+        " SELECT ?, id FROM tag WHERE name = ?",
+        [(r["id"], name) for r, names in zip(records, tag_names)
+         for name in names])
+
+
+def _insert_comments(db, records):
+    db.executemany(
+        "INSERT INTO comment (id, post_id, author_id, created, body)"
+        " VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?)",
+        [(r["id"], r["post_id"], r["author_id"], r.get("created"), r["body"])
+         for r in records])
+
+
+def _insert_likes(db, records):
+    db.executemany(
+        "INSERT INTO like (user_id, post_id, created)"
+        " VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP))",
+        [(r["user_id"], r["post_id"], r.get("created")) for r in records])
+
+
+INSERTS = {
+    "user": _insert_users,
+    "post": _insert_posts,
+    "comment": _insert_comments,
+    "like": _insert_likes,
+}
+
+
+def _drop_indexes_and_triggers(db):
+    """Drop the indexes and triggers and return the SQL to create them"""
+    rows = db.execute(
+        "SELECT type, name, sql FROM sqlite_master"
+        " WHERE type IN ('index', 'trigger') AND sql IS NOT NULL"
+    ).fetchall()
+    for row in rows:
+        db.execute('DROP {} "{}"'.format(row["type"].upper(), row["name"]))
+    return [row["sql"] for row in rows]
+
+
+def _create_indexes_and_triggers(db, statements):
+    for statement in statements:
+        db.execute(statement)
+    # The likes have not been counted while importing them
+    db.execute(
+        "UPDATE post SET like_count = ("
+        "  SELECT COUNT() FROM like WHERE like.post_id = post.id)"
+    )
+
+
+def _batches(records, batch_size):
+    """Group consecutive records of the same type into lists"""
+    for record_type, group in itertools.groupby(
+            records, key=lambda record: record.get("type")):
+        if record_type not in INSERTS:
+            raise ValueError("Unknown record type {!r}".format(record_type))
+        while True:
+            batch = list(itertools.islice(group, batch_size))
+            if not batch:
+                break
+            yield record_type, batch
+
+
+def import_records(records, batch_size=10000, workers=None, progress=None):
+    """
+    Insert records into an empty database
+
+    Each batch of records is inserted with `executemany` in one transaction.
+    The indexes and triggers are dropped during the import and created again
+    afterwards, which is much faster than updating them with every row. The
+    search index and the like counts are built at the end.
+    The bodies of the posts are rendered by a pool of processes.
+
+    If the import fails, the records imported so far stay in the database.
+
+    :param records: Iterable of records as produced by `export_records`.
+    :type records: iterable
+
+    :param batch_size: Number of records inserted in one transaction.
+    :type batch_size: int
+
+    :param workers: Number of processes rendering the posts. The posts are
+                    rendered in this process if it is 1. Defaults to the
+                    number of CPUs.
+    :type workers: int or None
+
+    :param progress: Function called with the counts after each batch.
+    :type progress: callable or None
+
+    :raises ValueError: If the database is not empty or a record has an
+                        unknown type.
+
+    :returns: Number of imported records by type.
+    :rtype: dict
+    """
+    db = get_db()
+    if db.execute(
+            "SELECT EXISTS (SELECT 1 FROM user)"
+            " OR EXISTS (SELECT 1 FROM post)").fetchone()[0]:
+        raise ValueError("Data can only be imported into an empty database.")
+
+    render_options = get_render_options()
+    extras = tuple(current_app.config["MARKDOWN_EXTRAS"])
+    workers = workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    counts = dict.fromkeys(RECORD_TYPES, 0)
+    statements = run_write(_drop_indexes_and_triggers)
+    try:
+        for record_type, batch in _batches(records, batch_size):
+            if record_type == "post":
+                htmls = render_markdown_batch(
+                    [record["body"] for record in batch], extras,
+                    pool=pool, workers=workers)
+                for record, html in zip(batch, htmls):
+                    record["body_html"] = html
+                    record["render_options"] = render_options
+            insert = INSERTS[record_type]
+            run_write(lambda db: insert(db, batch))
+            counts[record_type] += len(batch)
+            if progress is not None:
+                progress(counts)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        run_write(lambda db: _create_indexes_and_triggers(db, statements))
+    rebuild_search_index()
+    invalidate("posts")
+    return counts
+
+
+@click.command("export-data")
+@click.argument("output", type=click.File("w"), default="-")
+@with_appcontext
+def export_data_command(output):
+    """Write all posts, comments, likes and users as NDJSON"""
+    for record in export_records():
+        output.write(json.dumps(record) + "\n")
+
+
+@click.command("import-data")
+@click.argument("input", type=click.File("r"), default="-")
+@click.option("--batch-size", type=click.IntRange(min=1), default=10000,
+              show_default=True,
+              help="Number of records inserted in one transaction.")
+@click.option("--workers", type=click.IntRange(min=1), default=None,
+              help="Number of rendering processes. Defaults to the CPUs.")
+@with_appcontext
+def import_data_command(input, batch_size, workers):
+    """Import NDJSON written by export-data into an empty database"""
+    start = time.perf_counter()
+
+    def get_rate(counts):
+        return sum(counts.values()) / max(time.perf_counter() - start, 1e-9)
+
+    def report(counts):
+        click.echo("Imported {} records ({:.0f} records/s).".format(
+            sum(counts.values()), get_rate(counts)), err=True)
+
+    records = (json.loads(line) for line in input if line.strip())
+    try:
+        counts = import_records(
+            records, batch_size=batch_size, workers=workers, progress=report)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    with current_app.test_request_context():
+        publish_feeds()
+    click.echo("Imported {} ({:.0f} records/s).".format(", ".join(
+        "{} {}s".format(count, record_type)
+        for record_type, count in counts.items()), get_rate(counts)))
+
+
+def init_app(app):
+    app.cli.add_command(export_data_command)
+    app.cli.add_command(import_data_command)
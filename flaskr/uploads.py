@@ -0,0 +1,205 @@
+"""
+Layout of the upload directory
+
+Uploaded files are stored either flat in `UPLOAD_DIR` or, with
+`UPLOAD_DIR_LAYOUT = "sharded"`, in two levels of subdirectories named after
+the first four characters of the filename, e.g. `ab/cd/abcd....png`. The
+filenames of originals are SHA-256 hashes, so the files are spread evenly over
+up to 65536 directories. Variants and manifests start with the filename of
+their original and are stored next to it.
+
+Files are looked up in the configured layout and then in the other one, so the
+site keeps working while `migrate-uploads` moves the files. Apart from the
+command, nothing here needs an app context.
+"""
+import os
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.security import safe_join
+
+LAYOUTS = ("flat", "sharded")
+
+
+def get_relative_path(filename, layout):
+    """Return the path of a file relative to the upload directory"""
+    if layout == "sharded":
+        return os.path.join(filename[:2], filename[2:4], filename)
+    if layout == "flat":
+        return filename
+    raise ValueError("Unknown upload directory layout {!r}".format(layout))
+
+
+def get_path(upload_dir, filename, layout):
+    """
+    Return the path at which a file is stored in the layout
+
+    :returns: Path of the file or None if the filename would not be in the
+              upload directory.
+    :rtype: str or None
+    """
+    return safe_join(upload_dir, *get_relative_path(
+        filename, layout).split(os.sep))
+
+
+def find_path(upload_dir, filename, layout):
+    """
+    Return the path of an existing file in any layout
+
+    The layout is checked again in the end: a file moved from the other
+    layout into it during the lookup is still found.
+
+    :param upload_dir: Upload directory.
+    :type upload_dir: str
+
+    :param filename: Filename of the file.
+    :type filename: str
+
+    :param layout: Layout in which the file is looked up first.
+    :type layout: str
+
+    :returns: Path of the file or None if it does not exist.
+    :rtype: str or None
+    """
+    other_layout = "flat" if layout == "sharded" else "sharded"
+    for each_layout in (layout, other_layout, layout):
+        path = get_path(upload_dir, filename, each_layout)
+        if path is not None and os.path.isfile(path):
+            return path
+    return None
+
+
+def remove(upload_dir, filename):
+    """Remove a file from all layouts, if it exists"""
+    for layout in LAYOUTS:
+        path = get_path(upload_dir, filename, layout)
+        if path is None:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _is_shard(entry):
+    return len(entry.name) == 2 and entry.is_dir(follow_symlinks=False)
+
+
+def iter_files(upload_dir):
+    """
+    Iterate over the files in all layouts with `os.scandir`
+
+    :returns: Iterator of `os.DirEntry` objects.
+    :rtype: iterator
+    """
+    with os.scandir(upload_dir) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                yield entry
+            elif _is_shard(entry):
+                with os.scandir(entry.path) as inner_entries:
+                    for inner_entry in inner_entries:
+                        if not _is_shard(inner_entry):
+                            continue
+                        with os.scandir(inner_entry.path) as files:
+                            for file_entry in files:
+                                if file_entry.is_file(follow_symlinks=False):
+                                    yield file_entry
+
+
+def migrate_uploads(upload_dir, layout, batch_size=1000, pause=0,
+                    progress=None):
+    """
+    Move the files of the upload directory into the layout
+
+    Each file is moved atomically with `os.replace`, so it can always be
+    found with `find_path`. A file which already exists in the layout is
+    removed from the other one. Temporary files are left where they are.
+
+    :param upload_dir: Upload directory.
+    :type upload_dir: str
+
+    :param layout: Layout into which the files are moved.
+    :type layout: str
+
+    :param batch_size: Number of files moved before pausing.
+    :type batch_size: int
+
+    :param pause: Seconds to pause after each batch to spare the disk.
+    :type pause: float
+
+    :param progress: Function called with the number of moved files after
+                     each batch.
+    :type progress: callable or None
+
+    :returns: Number of moved files.
+    :rtype: int
+    """
+    moved = 0
+    for entry in iter_files(upload_dir):
+        if entry.name.endswith(".tmp"):
+            continue
+        path = get_path(upload_dir, entry.name, layout)
+        if path is None or path == entry.path:
+            continue
+        try:
+            if os.path.exists(path):
+                os.remove(entry.path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(entry.path, path)
+        except FileNotFoundError:
+            # Removed by the app in the meantime
+            continue
+        moved += 1
+        if moved % batch_size == 0:
+            if progress is not None:
+                progress(moved)
+            time.sleep(pause)
+
+    if layout == "flat":
+        _remove_empty_shards(upload_dir)
+    return moved
+
+
+def _remove_empty_shards(upload_dir):
+    with os.scandir(upload_dir) as entries:
+        shards = [entry.path for entry in entries if _is_shard(entry)]
+    for shard in shards:
+        with os.scandir(shard) as entries:
+            inner_shards = [
+                entry.path for entry in entries if _is_shard(entry)]
+        # Only empty directories are removed
+        for path in inner_shards + [shard]:
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+
+
+@click.command("migrate-uploads")
+@click.option("--batch-size", type=click.IntRange(min=1), default=1000,
+              show_default=True,
+              help="Number of files moved before pausing.")
+@click.option("--pause", type=click.FloatRange(min=0), default=0,
+              show_default=True, help="Seconds to pause after each batch.")
+@with_appcontext
+def migrate_uploads_command(batch_size, pause):
+    """Move the uploaded files into the UPLOAD_DIR_LAYOUT"""
+    moved = migrate_uploads(
+        current_app.config["UPLOAD_DIR"],
+        current_app.config["UPLOAD_DIR_LAYOUT"],
+        batch_size=batch_size,
+        pause=pause,
+        progress=lambda moved: click.echo("Moved {} files.".format(moved)))
+    click.echo("Moved {} files into the {} layout.".format(
+        moved, current_app.config["UPLOAD_DIR_LAYOUT"]))
+
+
+def init_app(app):
+    if app.config["UPLOAD_DIR_LAYOUT"] not in LAYOUTS:
+        raise ValueError("UPLOAD_DIR_LAYOUT must be one of {}".format(
+            ", ".join(LAYOUTS)))
+    app.cli.add_command(migrate_uploads_command)
@@ -0,0 +1,288 @@
+"""
+Downscaled and WebP variants of uploaded images
+
+After an image has been stored, its variants are generated by a pool of
+background threads, so that the upload request is not blocked. For each of the
+`IMAGE_VARIANT_WIDTHS` smaller than the image, a downscaled copy in the
+original format and in WebP is stored in the directory of the original, e.g.
+`<sha256>.320w.webp`. A WebP copy of the full size is stored as well.
+
+The variants are listed in a manifest `<filename>.variants.json`, which is
+written last. Templates select the variants through `srcset` with the
+`image_variants` template global. As long as there is no manifest, only the
+original is shown. Once the variants are generated, the cached pages of the
+posts showing the image are invalidated.
+
+Generating variants requires Pillow (`pip install flaskr[images]`). Without
+it, no variants are generated.
+"""
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from flaskr.cache import LRUCache, invalidate
+from flaskr.db import get_db
+from flaskr.uploads import find_path
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    Image = None
+
+
+def get_manifest_filename(filename):
+    """Return the filename of the manifest of the image's variants"""
+    return filename + ".variants.json"
+
+
+def _save_atomically(image, path, image_format, **params):
+    """Save the image to a temporary file and move it into place"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode="wb") as f:
+            image.save(f, format=image_format, **params)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def generate_variants(upload_dir, filename, widths, webp_quality):
+    """
+    Generate the variants of an image and write their manifest
+
+    This does not need an app context, so that it can run in any thread.
+
+    :param upload_dir: Directory in which the image is stored.
+    :type upload_dir: str
+
+    :param filename: Filename of the image.
+    :type filename: str
+
+    :param widths: Widths of the downscaled variants.
+    :type widths: list
+
+    :param webp_quality: Quality of the WebP variants from 0 to 100.
+    :type webp_quality: int
+
+    :returns: The variants as written to the manifest. Each variant is a
+              dictionary with its filename, width and media type.
+    :rtype: list
+    """
+    stem, extension = os.path.splitext(filename)
+    variants = []
+    with Image.open(os.path.join(upload_dir, filename)) as image:
+        # Animated images would lose all frames but the first
+        if not getattr(image, "is_animated", False):
+            image.load()
+            mimetype = Image.MIME[image.format]
+            webp_mode = "RGBA" if (
+                "A" in image.getbands() or "transparency" in image.info
+            ) else "RGB"
+            # Palette images could only be resized without interpolation
+            source = image.convert(webp_mode) if image.mode == "P" else image
+
+            sizes = [(image.width, image)]
+            for width in sorted(w for w in set(widths) if w < image.width):
+                height = max(1, round(image.height * width / image.width))
+                resized = source.resize((width, height), Image.LANCZOS)
+                resized_filename = "{}.{}w{}".format(stem, width, extension)
+                _save_atomically(
+                    resized, os.path.join(upload_dir, resized_filename),
+                    image.format)
+                sizes.append((width, resized))
+                variants.append({
+                    "filename": resized_filename,
+                    "width": width,
+                    "type": mimetype,
+                })
+            variants.append({
+                "filename": filename,
+                "width": image.width,
+                "type": mimetype,
+            })
+
+            for width, sized in sizes:
+                webp_filename = "{}.{}w.webp".format(stem, width)
+                _save_atomically(
+                    sized.convert(webp_mode),
+                    os.path.join(upload_dir, webp_filename),
+                    "WEBP", quality=webp_quality)
+                variants.append({
+                    "filename": webp_filename,
+                    "width": width,
+                    "type": "image/webp",
+                })
+
+    manifest_path = os.path.join(upload_dir, get_manifest_filename(filename))
+    fd, temp_path = tempfile.mkstemp(dir=upload_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode="w") as f:
+            json.dump({"variants": variants}, f)
+        os.replace(temp_path, manifest_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return variants
+
+
+def get_variant_pool():
+    """
+    Return the pool generating variants for the current app
+
+    Returns None if variants are disabled by `IMAGE_VARIANT_WORKERS` being 0
+    or Pillow is not installed.
+    """
+    app = current_app._get_current_object()
+    if Image is None or not app.config["IMAGE_VARIANT_WORKERS"]:
+        return None
+    pool = app.extensions.get("flaskr_image_variant_pool")
+    if pool is None:
+        pool = app.extensions.setdefault(
+            "flaskr_image_variant_pool",
+            ThreadPoolExecutor(
+                max_workers=app.config["IMAGE_VARIANT_WORKERS"],
+                thread_name_prefix="flaskr-image-variants"))
+    return pool
+
+
+def invalidate_pages_with_image(filename):
+    """Invalidate the cached pages of the posts showing an image"""
+    post_ids = [row["post_id"] for row in get_db().execute(
+        "SELECT post_id FROM post_image WHERE filename = ?", (filename,))]
+    if post_ids:
+        invalidate("posts", *("post:{}".format(id) for id in post_ids))
+
+
+def generate_variants_in_background(filename):
+    """
+    Generate the variants of a stored image in the background
+
+    The pages showing the image are invalidated when the variants have been
+    generated.
+
+    :returns: Future of the list of variants or None if variants are disabled.
+    :rtype: concurrent.futures.Future or None
+    """
+    pool = get_variant_pool()
+    if pool is None:
+        return None
+    path = find_path(
+        current_app.config["UPLOAD_DIR"], filename,
+        current_app.config["UPLOAD_DIR_LAYOUT"])
+    if path is None:
+        return None
+    app = current_app._get_current_object()
+    logger = app.logger
+    widths = app.config["IMAGE_VARIANT_WIDTHS"]
+    webp_quality = app.config["IMAGE_WEBP_QUALITY"]
+
+    def generate():
+        generated = generate_variants(
+            os.path.dirname(path), filename, widths, webp_quality)
+        with app.app_context():
+            invalidate_pages_with_image(filename)
+        return generated
+
+    future = pool.submit(generate)
+
+    def log_error(future):
+        if future.exception() is not None:
+            logger.error(
+                "Generating the variants of %s failed.", filename,
+                exc_info=future.exception())
+
+    future.add_done_callback(log_error)
+    return future
+
+
+def get_manifest_cache():
+    """Return the cache of read manifests of the current app"""
+    return current_app.extensions["flaskr_image_manifest_cache"]
+
+
+def get_image_variants(filename):
+    """
+    Return the variants of an image grouped by media type
+
+    Variants of a content-addressed image never change, so manifests are
+    cached once they have been read.
+
+    :param filename: Filename of the original image.
+    :type filename: str
+
+    :returns: Dictionary mapping media types to lists of variants ordered by
+              width. Empty if the variants have not been generated.
+    :rtype: dict
+    """
+    cache = get_manifest_cache()
+    variants = cache.get(filename)
+    if variants is None:
+        manifest_path = find_path(
+            current_app.config["UPLOAD_DIR"], get_manifest_filename(filename),
+            current_app.config["UPLOAD_DIR_LAYOUT"])
+        if manifest_path is None:
+            return {}
+        try:
+            with open(manifest_path) as f:
+                variants = json.load(f)["variants"]
+        except FileNotFoundError:
+            return {}
+        cache.set(filename, variants)
+
+    grouped = {}
+    for variant in sorted(variants, key=lambda variant: variant["width"]):
+        grouped.setdefault(variant["type"], []).append(variant)
+    return grouped
+
+
+@click.command("generate-image-variants")
+@click.option("--all", "regenerate_all", is_flag=True,
+              help="Regenerate the variants of all images.")
+@with_appcontext
+def generate_image_variants_command(regenerate_all):
+    """Generate the variants of the images of the posts"""
+    if Image is None:
+        raise click.ClickException("Generating variants requires Pillow.")
+    upload_dir = current_app.config["UPLOAD_DIR"]
+    layout = current_app.config["UPLOAD_DIR_LAYOUT"]
+    paths = {}
+    for row in get_db().execute(
+            "SELECT DISTINCT filename FROM post_image").fetchall():
+        filename = row["filename"]
+        if not regenerate_all and find_path(
+                upload_dir, get_manifest_filename(filename), layout):
+            continue
+        path = find_path(upload_dir, filename, layout)
+        if path is None:
+            click.echo("The image {} is missing.".format(filename))
+            continue
+        paths[filename] = path
+    filenames = list(paths)
+    workers = current_app.config["IMAGE_VARIANT_WORKERS"] or None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(
+            generate_variants, os.path.dirname(paths[filename]), filename,
+            current_app.config["IMAGE_VARIANT_WIDTHS"],
+            current_app.config["IMAGE_WEBP_QUALITY"]
+        ): filename for filename in filenames}
+    failed = [filename for future, filename in futures.items()
+              if future.exception() is not None]
+    for filename in filenames:
+        if filename not in failed:
+            invalidate_pages_with_image(filename)
+    for filename in failed:
+        click.echo("Generating the variants of {} failed.".format(filename))
+    click.echo("Generated the variants of {} images.".format(
+        len(filenames) - len(failed)))
+
+
+def init_app(app):
+    app.extensions["flaskr_image_manifest_cache"] = LRUCache(max_entries=1024)
+    app.add_template_global(get_image_variants, name="image_variants")
+    app.cli.add_command(generate_image_variants_command)
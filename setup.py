@@ -13,5 +13,6 @@ setup(
     ],
     extras_require={
         'dev': ['pytest', 'pytest-cov'],
+        'images': ['Pillow'],
     },
 )
@@ -4,7 +4,7 @@ import tempfile
 
 import pytest
 from flaskr import create_app
-from flaskr.db import get_db, init_db
+from flaskr.db import close_connections, get_db, init_db
 
 with open(os.path.join(os.path.dirname(__file__), "data.sql"), "rb") as f:
     _data_sql = f.read().decode("utf8")
@@ -14,11 +14,17 @@ with open(os.path.join(os.path.dirname(__file__), "data.sql"), "rb") as f:
 def app():
     db_fd, db_path = tempfile.mkstemp()
     upload_dir = tempfile.mkdtemp()
+    feed_dir = tempfile.mkdtemp()
 
     app = create_app({
         "TESTING": True,
         "DATABASE": db_path,
-        "UPLOAD_DIR": upload_dir
+        "UPLOAD_DIR": upload_dir,
+        "FEED_SNAPSHOT_DIR": feed_dir,
+        # The method of the password hashes in data.sql
+        "PASSWORD_HASH_METHOD": "pbkdf2:sha256:50000",
+        # Tests of image variants generate them explicitly
+        "IMAGE_VARIANT_WORKERS": 0
     })
 
     with app.app_context():
@@ -27,9 +33,13 @@ def app():
 
     yield app
 
+    close_connections(app)
     os.close(db_fd)
-    os.unlink(db_path)
+    for path in (db_path, db_path + "-wal", db_path + "-shm"):
+        if os.path.exists(path):
+            os.unlink(path)
     shutil.rmtree(upload_dir)
+    shutil.rmtree(feed_dir)
 
 
 @pytest.fixture
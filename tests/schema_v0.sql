@@ -0,0 +1,60 @@
+-- Schema of databases created before the first migration
+CREATE TABLE user (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	username TEXT UNIQUE NOT NULL,
+	password TEXT NOT NULL
+);
+
+CREATE TABLE post (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	author_id INTEGER NOT NULL,
+	created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	title TEXT NOT NULL,
+	body TEXT NOT NULL,
+	body_html TEXT,
+	FOREIGN KEY (author_id) REFERENCES user (id)
+);
+
+CREATE TABLE comment (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	author_id INTEGER NOT NULL,
+	post_id INTEGER NOT NULL,
+	created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	body TEXT NOT NULL,
+	FOREIGN KEY (author_id) REFERENCES user (id),
+	FOREIGN KEY (post_id) REFERENCES post (id)
+);
+
+CREATE TABLE like (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	user_id INTEGER NOT NULL,
+	post_id INTEGER NOT NULL,
+	created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	FOREIGN KEY (user_id) REFERENCES user (id),
+	FOREIGN KEY (post_id) REFERENCES post (id),
+	CONSTRAINT user_post_like UNIQUE (user_id, post_id)
+);
+
+CREATE TABLE tag (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	name TEXT NOT NULL,
+	created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	CONSTRAINT unique_tag_names UNIQUE (name)
+);
+
+CREATE TABLE post_tag (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	post_id INTEGER NOT NULL,
+	tag_id INTEGER NOT NULL,
+	created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	FOREIGN KEY (post_id) REFERENCES post (id),
+	FOREIGN KEY (tag_id) REFERENCES tag (id),
+	CONSTRAINT post_tag_relation UNIQUE (post_id, tag_id)
+);
+
+CREATE TABLE post_image (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	post_id INTEGER NOT NULL,
+	filename TEXT NOT NULL,
+	FOREIGN KEY (post_id) REFERENCES post (id)
+);
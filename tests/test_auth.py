@@ -1,5 +1,7 @@
 import pytest
 from flask import g, session
+
+from flaskr.auth import invalidate_user
 from flaskr.db import get_db
 
 
@@ -65,3 +67,50 @@ def test_logout(client, auth):
     with client:
         auth.logout()
         assert "user_id" not in session
+
+
+def rename_user_directly(app, user_id, username):
+    with app.app_context():
+        db = get_db()
+        db.execute(
+            "UPDATE user SET username = ? WHERE id = ?", (username, user_id))
+        db.commit()
+
+
+def test_logged_in_user_is_cached(client, auth, app):
+    auth.login()
+    with client:
+        client.get("/")
+        assert g.user["username"] == "test"
+        assert "password" not in g.user.keys()
+
+    rename_user_directly(app, 1, "renamed")
+    assert b"renamed" not in client.get("/").data
+
+    with app.app_context():
+        invalidate_user(1)
+    assert b"renamed" in client.get("/").data
+
+
+def test_user_cache_timeout(client, auth, app):
+    app.config["USER_CACHE_TIMEOUT"] = 0
+    auth.login()
+    client.get("/")
+    rename_user_directly(app, 1, "renamed")
+    assert b"renamed" in client.get("/").data
+
+
+def test_user_cache_disabled(client, auth, app):
+    app.extensions["flaskr_user_cache"] = None
+    auth.login()
+    client.get("/")
+    rename_user_directly(app, 1, "renamed")
+    assert b"renamed" in client.get("/").data
+
+
+@pytest.mark.parametrize("path", ("/feed.rss", "/images/missing.png"))
+def test_user_lookup_skipped(client, auth, app, path):
+    auth.login()
+    with client:
+        client.get(path)
+        assert g.user is None
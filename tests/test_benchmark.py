@@ -0,0 +1,133 @@
+import collections
+import json
+
+import pytest
+
+from flaskr.benchmark import (
+    compare_results, generate_records, percentile, summarize
+)
+from flaskr.db import get_db, init_db
+
+
+def test_generate_records():
+    records = list(generate_records(
+        users=3, posts=4, tags=5, comments=6, likes=7, seed=1))
+    counts = collections.Counter(record["type"] for record in records)
+    assert counts == {"user": 3, "post": 4, "comment": 6, "like": 7}
+    likes = [(r["user_id"], r["post_id"])
+             for r in records if r["type"] == "like"]
+    assert len(set(likes)) == 7
+    # The first user can like every post
+    assert all(user_id != 1 for user_id, _ in likes)
+    assert records == list(generate_records(
+        users=3, posts=4, tags=5, comments=6, likes=7, seed=1))
+
+    with pytest.raises(ValueError):
+        list(generate_records(users=2, posts=1, likes=2))
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([3], 99) == 3
+    assert percentile([], 50) is None
+
+    summary = summarize([0.001, 0.002, 0.003, 0.004], errors=1, elapsed=0.5)
+    assert summary["requests"] == 4
+    assert summary["errors"] == 1
+    assert summary["throughput"] == 8
+    assert summary["latency_ms"]["p50"] == 2
+    assert summary["latency_ms"]["max"] == 4
+
+
+def test_compare_results():
+    def result(p50, p99, throughput):
+        return {"latency_ms": {"p50": p50, "p99": p99},
+                "throughput": throughput}
+
+    baseline = {"index": result(1, 2, 100), "search": result(1, 2, 100)}
+    results = {"index": result(1.1, 2, 90), "search": result(2, 2, 40),
+               "new": result(1, 1, 1)}
+    assert compare_results(results, baseline, threshold=1.2) == [
+        ("search", "p50", 1, 2, 2.0),
+        ("search", "throughput", 100, 40, 2.5),
+    ]
+
+
+@pytest.fixture
+def generated_app(app, runner):
+    with app.app_context():
+        init_db()
+    result = runner.invoke(args=[
+        "generate-data", "--users", "3", "--posts", "10", "--tags", "4",
+        "--comments", "20", "--likes", "5"])
+    assert "Generated 3 users, 10 posts" in result.output
+    return app
+
+
+def test_generate_data_command(generated_app):
+    with generated_app.app_context():
+        db = get_db()
+        assert db.execute("SELECT COUNT() FROM post").fetchone()[0] == 10
+        assert db.execute("SELECT COUNT() FROM tag").fetchone()[0] == 4
+
+
+@pytest.mark.parametrize("args", (
+    [],
+    ["--server", "--concurrency", "2"],
+))
+def test_benchmark_command(generated_app, runner, tmp_path, args):
+    path = str(tmp_path / "result.json")
+    result = runner.invoke(args=[
+        "benchmark", "--requests", "6", "--warmup", "1", "--output", path
+    ] + args)
+    assert result.exit_code == 0, result.output
+    with open(path) as f:
+        data = json.load(f)
+    assert list(data["scenarios"]) == [
+        "index", "detail", "search", "tags", "feed", "comment", "like"]
+    for scenario in data["scenarios"].values():
+        assert scenario["requests"] == 6
+        assert scenario["errors"] == 0
+        assert scenario["latency_ms"]["p99"] > 0
+
+
+def test_concurrent_clients_like_their_own_posts(
+        generated_app, runner, tmp_path):
+    path = str(tmp_path / "result.json")
+    result = runner.invoke(args=[
+        "benchmark", "--scenario", "like", "--server", "--concurrency", "5",
+        "--requests", "50", "--warmup", "5", "--output", path])
+    assert result.exit_code == 0, result.output
+    with open(path) as f:
+        assert json.load(f)["scenarios"]["like"]["errors"] == 0
+
+    result = runner.invoke(args=[
+        "benchmark", "--server", "--concurrency", "11"])
+    assert result.exit_code != 0
+    assert "Every client needs a post of its own" in result.output
+
+
+def test_benchmark_against_baseline(generated_app, runner, tmp_path):
+    path = tmp_path / "baseline.json"
+    runner.invoke(args=[
+        "benchmark", "--scenario", "index", "--requests", "5",
+        "--output", str(path)])
+    data = json.loads(path.read_text())
+    data["scenarios"]["index"]["latency_ms"]["p50"] /= 1000
+    path.write_text(json.dumps(data))
+
+    result = runner.invoke(args=[
+        "benchmark", "--scenario", "index", "--requests", "5",
+        "--baseline", str(path)])
+    assert result.exit_code != 0
+    assert "Regression of index p50" in result.output
+
+
+def test_benchmark_needs_data(app, runner):
+    with app.app_context():
+        init_db()
+    result = runner.invoke(args=["benchmark"])
+    assert result.exit_code != 0
+    assert "run generate-data first" in result.output
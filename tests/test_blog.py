@@ -1,7 +1,8 @@
 import pytest
+from werkzeug.exceptions import NotFound
 
+from flaskr.blog import create_post, load_post_detail
 from flaskr.db import get_db
-from flaskr.blog import create_post
 
 
 def test_index(client, auth):
@@ -132,3 +133,36 @@ def test_delete(client, auth, app):
         db = get_db()
         post = db.execute("SELECT * FROM post WHERE id = 1").fetchone()
         assert post is None
+
+
+def test_load_post_detail(app):
+    with app.app_context():
+        db = get_db()
+        db.execute(
+            "INSERT INTO comment (author_id, post_id, body)"
+            " VALUES (1, 1, 'second comment')")
+        db.commit()
+        app.config["COMMENTS_PER_PAGE"] = 1
+
+        statements = []
+        db.set_trace_callback(statements.append)
+        detail = load_post_detail(1, user_id=2)
+        db.set_trace_callback(None)
+        assert len(statements) == 1
+
+        assert detail.post["title"] == "test title"
+        assert detail.post["tag_string"] == "testtag"
+        assert detail.liked
+        assert not load_post_detail(1, user_id=1).liked
+        assert not load_post_detail(1).liked
+        assert [c["body"] for c in detail.comments] == ["test comment body"]
+        assert detail.comments[0]["username"] == "other"
+        assert detail.comments_pagination.next == detail.comments[0]["id"]
+        with pytest.raises(TypeError):
+            detail.comments[0]["body"] = "changed"
+
+
+def test_load_post_detail_of_missing_post(app):
+    with app.app_context():
+        with pytest.raises(NotFound):
+            load_post_detail(2)
@@ -0,0 +1,230 @@
+import pytest
+
+from flaskr import cache, likes
+from flaskr.cache import (
+    DirectoryCache, LRUCache, ResponseCache, create_response_cache,
+    get_content_versions, invalidate
+)
+from flaskr.db import get_db
+from flaskr.tags import update_tag_associations_for_post
+
+
+@pytest.fixture(params=("memory", "directory"))
+def cached_app(app, request, tmp_path):
+    app.config["RESPONSE_CACHE_BACKEND"] = request.param
+    app.config["RESPONSE_CACHE_DIR"] = str(tmp_path / "response_cache")
+    app.extensions["flaskr_response_cache"] = create_response_cache(app)
+    return app
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_directory_cache_is_shared(tmp_path):
+    cache = DirectoryCache(str(tmp_path))
+    cache.set("key", {"value": 1})
+    assert DirectoryCache(str(tmp_path)).get("key") == {"value": 1}
+
+    cache.delete("key")
+    assert cache.get("key") is None
+    cache.delete("key")
+
+
+def test_directory_cache_is_bounded(tmp_path):
+    cache = DirectoryCache(str(tmp_path), max_entries=10)
+    for i in range(25):
+        cache.set(str(i), i)
+    assert len(list(tmp_path.iterdir())) <= 10
+    assert cache.get("24") == 24
+
+
+@pytest.mark.parametrize("backend", (
+    LRUCache(max_entries=10),
+    DirectoryCache,
+))
+def test_response_cache_invalidation(backend, tmp_path):
+    if backend is DirectoryCache:
+        backend = DirectoryCache(str(tmp_path))
+    cache = ResponseCache(backend=backend, timeout=60)
+
+    versions = cache.get_versions(["posts", "post:1"])
+    cache.set("/1/detail", versions, (200, [], b"page"))
+    assert cache.get("/1/detail") == (200, [], b"page")
+
+    cache.invalidate("post:2")
+    assert cache.get("/1/detail") == (200, [], b"page")
+
+    cache.invalidate("post:1")
+    assert cache.get("/1/detail") is None
+
+
+def test_response_cache_timeout():
+    cache = ResponseCache(backend=LRUCache(max_entries=10), timeout=-1)
+    cache.set("/", cache.get_versions(["posts"]), (200, [], b"page"))
+    assert cache.get("/") is None
+
+
+def test_evicted_version_makes_responses_stale():
+    cache = ResponseCache(backend=LRUCache(max_entries=10), timeout=60)
+    cache.set("/", cache.get_versions(["posts"]), (200, [], b"page"))
+    cache.backend.delete("version:posts")
+    assert cache.get("/") is None
+
+
+@pytest.mark.parametrize("path", (
+    "/",
+    "/1/detail",
+    "/tags/testtag",
+    "/feed.rss",
+))
+def test_anonymous_responses_are_cached(cached_app, client, path):
+    response = client.get(path)
+    assert response.headers["X-Cache"] == "MISS"
+    # Streamed responses are stored once they have been sent completely
+    assert b"test title" in response.data
+    response = client.get(path)
+    assert response.headers["X-Cache"] == "HIT"
+    assert b"test title" in response.data
+
+
+def test_cache_key_includes_query_string(cached_app, client):
+    client.get("/?page=1")
+    assert client.get("/?page=2").headers["X-Cache"] == "MISS"
+    assert client.get("/?page=1").headers["X-Cache"] == "HIT"
+
+
+def test_cache_key_ignores_unused_query_args(cached_app, client):
+    client.get("/?page=1")
+    assert client.get("/?page=1&x=1").headers["X-Cache"] == "HIT"
+    assert client.get("/?x=2&page=1").headers["X-Cache"] == "HIT"
+    assert client.get("/feed.rss?x=1").data
+    assert client.get("/feed.rss?x=2").headers["X-Cache"] == "HIT"
+
+
+def test_logged_in_users_bypass_cache(cached_app, client, auth):
+    client.get("/")
+    auth.login()
+    response = client.get("/")
+    assert "X-Cache" not in response.headers
+    assert b"Log Out" in response.data
+
+
+def test_stale_data_is_served_without_invalidation(cached_app, client):
+    """Changes which bypass the write functions are not seen"""
+    client.get("/")
+    with cached_app.app_context():
+        db = get_db()
+        db.execute("UPDATE post SET title = 'changed' WHERE id = 1")
+        db.commit()
+    assert b"test title" in client.get("/").data
+
+
+def test_write_paths_invalidate_cached_pages(cached_app, client, auth):
+    other_client = cached_app.test_client()
+    assert b"1 Likes" in other_client.get("/1/detail").data
+    other_client.get("/")
+
+    auth.login()
+    client.post("/comments/create", data={"post_id": 1, "body": "fresh"})
+    response = other_client.get("/1/detail")
+    assert response.headers["X-Cache"] == "MISS"
+    assert b"fresh" in response.data
+    # Comments are not shown in the listing
+    assert other_client.get("/").headers["X-Cache"] == "HIT"
+
+    client.post("/likes/create", data={"post_id": 1})
+    assert b"2 Likes" in other_client.get("/1/detail").data
+
+    client.post("/1/update", data={
+        "title": "updated title", "body": "", "tags": "newtag"})
+    assert b"updated title" in other_client.get("/").data
+    assert b"updated title" in other_client.get("/1/detail").data
+    assert b"updated title" in other_client.get("/tags/newtag").data
+    assert b"updated title" in other_client.get("/feed.rss").data
+
+    client.post("/create", data={"title": "brand new", "body": ""})
+    assert b"brand new" in other_client.get("/").data
+
+
+@pytest.mark.parametrize("path", (
+    "/", "/1/detail", "/tags/testtag", "/search/?q=title", "/feed.rss"))
+def test_conditional_get_not_modified(client, path):
+    response = client.get(path)
+    assert response.status_code == 200
+    assert b"test title" in response.data
+    assert response.headers["ETag"]
+    assert "no-cache" in response.headers["Cache-Control"]
+
+    response = client.get(
+        path, headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    assert response.data == b""
+
+
+def test_conditional_get_after_change(client, auth):
+    etag = client.get("/1/detail").headers["ETag"]
+    auth.login()
+    user_etag = client.get("/1/detail").headers["ETag"]
+    # The pages of logged in users differ from the anonymous pages
+    assert user_etag != etag
+
+    client.post("/comments/create", data={"post_id": 1, "body": "fresh"})
+    response = client.get("/1/detail", headers={"If-None-Match": user_etag})
+    assert response.status_code == 200
+    assert b"fresh" in response.data
+    # The listing does not show comments
+    etag = client.get("/").headers["ETag"]
+    client.post("/likes/create", data={"post_id": 1})
+    assert client.get(
+        "/", headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_conditional_get_last_modified(client, auth):
+    # There is no Last-Modified until the content has been changed once
+    assert "Last-Modified" not in client.get("/").headers
+
+    auth.login()
+    client.post("/create", data={"title": "brand new", "body": ""})
+    client.get("/")  # Consume the flashed message, if any
+    last_modified = client.get("/").headers["Last-Modified"]
+    response = client.get("/", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+    response = client.get("/", headers={
+        "If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"})
+    assert response.status_code == 200
+
+
+def test_content_versions_bumped_with_change(app):
+    with app.app_context():
+        assert get_content_versions(["posts", "post:1"]) == {}
+        update_tag_associations_for_post(tag_string="newtag", post_id=1)
+        versions = get_content_versions(["posts", "post:1", "post:2"])
+        assert sorted(versions) == ["post:1", "posts"]
+        assert versions["posts"][0] == 1
+
+        invalidate("posts")
+        assert get_content_versions(["posts"])["posts"][0] == 2
+
+
+def test_content_versions_bumped_in_writing_transaction(app, monkeypatch):
+    run_write = likes.run_write
+    calls = []
+
+    def counting_run_write(func, **kwargs):
+        calls.append(func)
+        return run_write(func, **kwargs)
+
+    monkeypatch.setattr(likes, "run_write", counting_run_write)
+    monkeypatch.setattr(cache, "run_write", counting_run_write)
+    with app.app_context():
+        likes.create_like(user_id=1, post_id=1)
+        assert get_content_versions(["post:1"])["post:1"][0] == 1
+    assert len(calls) == 1
@@ -1,6 +1,6 @@
 from flask import url_for
 
-from flaskr.comments import get_comments_for_post
+from flaskr.comments import get_comment_page, get_comments_for_post
 from flaskr.db import get_db
 
 
@@ -81,3 +81,116 @@ def test_post_author_sees_delete_button_on_detail(client, auth):
     response = client.get("/1/detail")
     assert b"Comments" in response.data
     assert b"/comments/1/delete" in response.data
+
+
+def create_comments(app, count):
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            "INSERT INTO comment (author_id, post_id, body) VALUES (1, 1, ?)",
+            [("comment {}".format(i),) for i in range(count)]
+        )
+        db.commit()
+
+
+def test_get_comment_page(app):
+    app.config["COMMENTS_PER_PAGE"] = 2
+    create_comments(app, 2)
+    with app.app_context():
+        comments, pagination = get_comment_page(post_id=1)
+        assert [c["body"] for c in comments] == [
+            "test comment body", "comment 0"]
+        assert pagination.next == comments[-1]["id"]
+
+        comments, pagination = get_comment_page(
+            post_id=1, after=pagination.next)
+        assert [c["body"] for c in comments] == ["comment 1"]
+        assert pagination.next is None
+
+
+def test_detail_shows_first_comment_page(client, app):
+    app.config["COMMENTS_PER_PAGE"] = 2
+    create_comments(app, 2)
+    response = client.get("/1/detail")
+    assert b"comment 0" in response.data
+    assert b"comment 1" not in response.data
+    assert b'href="/comments/post/1?after=2"' in response.data
+
+
+XHR = {"X-Requested-With": "XMLHttpRequest"}
+
+
+def test_load_more_comments_fragment(client, auth, app):
+    app.config["COMMENTS_PER_PAGE"] = 1
+    create_comments(app, 3)
+    response = client.get("/comments/post/1?after=2", headers=XHR)
+    assert b"<html" not in response.data
+    assert b"<script" not in response.data
+    assert b"comment 1" in response.data
+    assert b"comment 2" not in response.data
+    assert b'href="/comments/post/1?after=3"' in response.data
+    assert b"/delete" not in response.data
+
+    auth.login()
+    response = client.get("/comments/post/1?after=3", headers=XHR)
+    assert b"comment 2" in response.data
+    assert b"/comments/4/delete" in response.data
+    assert b"after=" not in response.data
+
+
+def test_load_more_comments_page(client, app):
+    app.config["COMMENTS_PER_PAGE"] = 1
+    create_comments(app, 3)
+    response = client.get("/1/detail")
+    assert b"comments.js" in response.data
+
+    response = client.get("/comments/post/1?after=2")
+    assert b"<!doctype html>" in response.data
+    assert b"Comments on test title" in response.data
+    assert b"comment 1" in response.data
+    assert b'href="/comments/post/1?after=3"' in response.data
+    assert b"comments.js" in response.data
+
+
+def test_comment_page_representations_differ(client, app):
+    app.config["COMMENTS_PER_PAGE"] = 1
+    create_comments(app, 1)
+    responses = [
+        client.get("/comments/post/1"),
+        client.get("/comments/post/1", headers=XHR),
+        client.get(
+            "/comments/post/1", headers={"Accept": "application/json"}),
+    ]
+    assert len({response.headers["ETag"] for response in responses}) == 3
+    for response in responses:
+        assert "Accept" in response.vary
+        assert "X-Requested-With" in response.vary
+
+    etag = responses[0].headers["ETag"]
+    response = client.get(
+        "/comments/post/1",
+        headers={"Accept": "application/json", "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.is_json
+    response = client.get("/comments/post/1", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert "Accept" in response.vary
+
+
+def test_load_more_comments_json(client, app):
+    app.config["COMMENTS_PER_PAGE"] = 1
+    create_comments(app, 1)
+    data = client.get("/comments/post/1?format=json").get_json()
+    assert data["comments"][0]["body"] == "test comment body"
+    assert data["comments"][0]["username"] == "other"
+    assert data["next"] == "/comments/post/1?after=1&format=json"
+
+    data = client.get(
+        "/comments/post/1?after=1",
+        headers={"Accept": "application/json"}).get_json()
+    assert data["comments"][0]["body"] == "comment 0"
+    assert data["next"] is None
+
+
+def test_load_more_comments_of_missing_post(client):
+    assert client.get("/comments/post/2").status_code == 404
@@ -1,7 +1,12 @@
+import functools
 import sqlite3
+import threading
 
 import pytest
-from flaskr.db import get_db
+from flaskr.db import (
+    ConnectionPool, DatabaseWriter, PoolTimeoutError, close_connections,
+    execute_write, get_db, get_pool, get_pool_stats
+)
 
 
 def test_get_close_db(app):
@@ -29,3 +34,129 @@ def test_init_db_command(runner, monkeypatch):
     result = runner.invoke(args=["init-db"])
     assert "Initialized" in result.output
     assert Recorder.called
+
+
+def test_connections_are_reused_from_pool(app):
+    with app.app_context():
+        connection = get_db()._connection
+    with app.app_context():
+        assert get_db()._connection is connection
+        assert get_pool_stats()["idle"] == 0
+
+    # The fixture has already used the pool to initialize the database
+    stats = get_pool(app).stats()
+    assert stats["opens"] == 1
+    assert stats["hits"] == 2
+    assert stats["idle"] == 1
+
+
+def test_pragmas_applied_to_pooled_connection(app):
+    with app.app_context():
+        db = get_db()
+        assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert db.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+        assert db.execute("PRAGMA temp_store").fetchone()[0] == 2  # MEMORY
+
+
+def test_open_transaction_rolled_back_on_release(app):
+    with app.app_context():
+        get_db().execute("DELETE FROM post")
+
+    with app.app_context():
+        count = get_db().execute("SELECT COUNT() FROM post").fetchone()[0]
+        assert count == 1
+
+
+def test_pool_waits_for_released_connection(app):
+    pool = ConnectionPool(
+        database=app.config["DATABASE"], size=1, timeout=0.01)
+    connection = pool.acquire()
+    with pytest.raises(PoolTimeoutError):
+        pool.acquire()
+    connection.close()
+    pool.acquire()
+    assert pool.stats()["opens"] == 1
+    assert pool.stats()["waits"] == 1
+    pool.close()
+
+
+@pytest.fixture
+def split_app(app):
+    # The fixture has already used the default connections for the test data
+    close_connections(app)
+    app.config["DB_SPLIT_READ_WRITE"] = True
+    return app
+
+
+def test_split_read_connections_are_query_only(split_app):
+    with split_app.app_context():
+        with pytest.raises(sqlite3.OperationalError):
+            get_db().execute("DELETE FROM post")
+
+
+def test_split_writes_go_through_writer(split_app):
+    with split_app.app_context():
+        result = execute_write(
+            "INSERT INTO comment (author_id, post_id, body)"
+            " VALUES (1, 1, 'written by the writer')")
+        assert result.rowcount == 1
+        row = get_db().execute(
+            "SELECT body FROM comment WHERE id = ?", (result.lastrowid,)
+        ).fetchone()
+        assert row["body"] == "written by the writer"
+        assert get_pool_stats()["writer"]["writes"] == 1
+
+
+def test_split_write_errors_are_raised_to_caller(split_app):
+    with split_app.app_context():
+        with pytest.raises(sqlite3.IntegrityError):
+            execute_write("INSERT INTO like (user_id, post_id) VALUES (2, 1)")
+
+
+def test_split_views_write_through_writer(split_app, client, auth):
+    auth.login()
+    client.post("/create", data={
+        "title": "split title", "body": "split body", "tags": "split"})
+    client.post("/likes/create", data={"post_id": 2})
+    client.post("/comments/create", data={"post_id": 2, "body": "split"})
+
+    response = client.get("/2/detail")
+    assert b"split title" in response.data
+    assert b"1 Likes" in response.data
+    assert b"split body" in response.data
+
+
+def test_writer_group_commits_and_isolates_failures(app):
+    writer = DatabaseWriter(database=app.config["DATABASE"], batch_size=8)
+    started = threading.Event()
+    release = threading.Event()
+
+    def block(db):
+        started.set()
+        release.wait()
+
+    def insert(db, body):
+        db.execute(
+            "INSERT INTO comment (author_id, post_id, body)"
+            " VALUES (1, 1, ?)", (body,))
+
+    # Keep the writer busy, so that the following writes queue up
+    blocking = writer.submit(block)
+    started.wait()
+    futures = [writer.submit(functools.partial(insert, body=str(i)))
+               for i in range(3)]
+    failing = writer.submit(lambda db: db.execute("INSERT INTO nowhere"))
+    release.set()
+
+    blocking.result()
+    for future in futures:
+        future.result()
+    with pytest.raises(sqlite3.OperationalError):
+        failing.result()
+    writer.close()
+
+    assert writer.stats()["writes"] == 5
+    assert writer.stats()["batches"] == 2
+    with app.app_context():
+        count = get_db().execute("SELECT COUNT() FROM comment").fetchone()[0]
+        assert count == 4
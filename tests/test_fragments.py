@@ -0,0 +1,80 @@
+from flask import render_template_string
+
+from flaskr.cache import invalidate
+from flaskr.db import get_db
+
+TEMPLATE = (
+    '{% cache ("fragment", key), timeout, "post:1" %}'
+    "{{ value }}"
+    "{% endcache %}"
+)
+
+
+def render(app, value, key=1, timeout=60):
+    with app.test_request_context():
+        return render_template_string(
+            TEMPLATE, key=key, value=value, timeout=timeout)
+
+
+def test_fragment_is_cached(app):
+    assert render(app, "first") == "first"
+    assert render(app, "second") == "first"
+    assert render(app, "second", key=2) == "second"
+
+
+def test_fragment_invalidated_by_dependency(app):
+    render(app, "first")
+    with app.test_request_context():
+        invalidate("post:1")
+    assert render(app, "second") == "second"
+
+
+def test_fragment_timeout(app):
+    assert render(app, "first", timeout=0) == "first"
+    assert render(app, "second", timeout=0) == "second"
+    assert render(app, "third") == "third"
+    assert render(app, "fourth") == "third"
+
+
+def test_fragment_is_escaped_once(app):
+    assert render(app, "<b>") == "&lt;b&gt;"
+    assert render(app, "other") == "&lt;b&gt;"
+
+
+def test_fragment_cache_disabled(app):
+    app.extensions["flaskr_fragment_cache"] = None
+    assert render(app, "first") == "first"
+    assert render(app, "second") == "second"
+
+
+def change_body_directly(app, body_html):
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE post SET body_html = ? WHERE id = 1", (body_html,))
+        db.commit()
+
+
+def test_listing_fragments_invalidated_by_tags(client, auth, app):
+    auth.login()
+    assert b"testtag" in client.get("/").data
+    # Changes bypassing the write paths are not seen
+    change_body_directly(app, "changed body")
+    assert b"changed body" not in client.get("/").data
+
+    client.post("/1/update", data={
+        "title": "test title", "body": "", "tags": "othertag"})
+    response = client.get("/")
+    assert b"othertag" in response.data
+    assert b"testtag" not in response.data
+
+
+def test_listings_do_not_share_fragments(client):
+    assert b"test title" in client.get("/tags/testtag").data
+    assert b'<p class="body">test\nbody</p>' in client.get("/").data
+
+
+def test_comment_fragments_invalidated_by_comments(client, auth, app):
+    auth.login()
+    assert b"test comment" in client.get("/1/detail").data
+    client.post("/comments/create", data={"post_id": 1, "body": "fresh"})
+    assert b"fresh" in client.get("/1/detail").data
@@ -1,5 +1,7 @@
+import hashlib
 import os
 import shutil
+import threading
 
 import pytest
 from flask import url_for
@@ -369,3 +371,379 @@ def test_delete_image_association_via_update_form(app, client, auth):
         client.post("/1/update", data=form_data)
         # Check association is removed
         assert images.get_image_of_post(post_id=1) is None
+
+
+def test_saved_filename_is_content_hash(app):
+    example_image = ExampleImage()
+    filestorage = FileStorage(
+        stream=example_image.fileobject, filename="EXAMPLE.PNG")
+    with app.app_context():
+        saved_filename = images.save_image_to_upload_dir(
+            filestrorage_obj=filestorage)
+    assert saved_filename == (
+        hashlib.sha256(example_image.content).hexdigest() + ".png")
+
+
+def test_same_image_is_stored_once(app):
+    with app.app_context():
+        db = get_db()
+        db.execute(
+            "INSERT INTO post (title, body, author_id) VALUES ('2', '', 1)")
+        db.commit()
+
+        for post_id in (1, 2):
+            example_image = ExampleImage()
+            images.save_image_and_create_or_update_post_association(
+                image=FileStorage(
+                    stream=example_image.fileobject,
+                    filename=example_image.filename),
+                post_id=post_id)
+        filename = images.get_image_of_post(post_id=1)
+        assert images.get_image_of_post(post_id=2) == filename
+        assert os.listdir(app.config["UPLOAD_DIR"]) == [filename]
+
+        # The file is only deleted with its last reference
+        images.delete_post_image_associations_of_post(post_id=1)
+        assert os.listdir(app.config["UPLOAD_DIR"]) == [filename]
+        images.delete_post_image_associations_of_post(post_id=2)
+        assert os.listdir(app.config["UPLOAD_DIR"]) == []
+
+
+def test_image_size_limit(app, client, auth):
+    app.config["IMAGE_MAX_SIZE"] = 100
+    app.config["IMAGE_UPLOAD_CHUNK_SIZE"] = 10
+    auth.login()
+    example_image = ExampleImage()
+    response = client.post("/create", data={
+        "title": "post with image",
+        "body": "",
+        "image": [(example_image.fileobject, example_image.filename)]
+    })
+    assert response.status_code == 200
+    assert b"The image is larger than 100 bytes." in response.data
+    # Nothing has been written
+    assert os.listdir(app.config["UPLOAD_DIR"]) == []
+    with app.app_context():
+        assert get_db().execute("SELECT COUNT() FROM post").fetchone()[0] == 1
+
+
+def test_request_size_limit(app, client, auth):
+    app.config["MAX_CONTENT_LENGTH"] = 100
+    auth.login()
+    example_image = ExampleImage()
+    response = client.post("/create", data={
+        "title": "post with image",
+        "body": "",
+        "image": [(example_image.fileobject, example_image.filename)]
+    })
+    assert response.status_code == 413
+
+
+def test_image_writes_with_split_read_write(app):
+    app.config["DB_SPLIT_READ_WRITE"] = True
+    example_image = ExampleImage()
+    with app.app_context():
+        images.save_image_and_create_or_update_post_association(
+            image=FileStorage(
+                stream=example_image.fileobject,
+                filename=example_image.filename),
+            post_id=1)
+        filename = images.get_image_of_post(post_id=1)
+        assert os.listdir(app.config["UPLOAD_DIR"]) == [filename]
+
+        images.delete_post_image_associations_of_post(post_id=1)
+        assert os.listdir(app.config["UPLOAD_DIR"]) == []
+
+
+@pytest.fixture
+def saved_image(app):
+    example_image = ExampleImage()
+    with app.app_context():
+        filename = images.save_image_to_upload_dir(FileStorage(
+            stream=example_image.fileobject,
+            filename=example_image.filename))
+    return filename, example_image.content
+
+
+def test_image_is_cached_forever(client, saved_image):
+    filename, content = saved_image
+    response = client.get("/images/" + filename)
+    assert response.data == content
+    assert response.cache_control.public
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == 365 * 24 * 60 * 60
+    # Strong ETag from the content hash
+    assert response.headers["ETag"] == '"{}"'.format(filename[:64])
+
+    response = client.get("/images/" + filename, headers={
+        "If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+
+
+def test_variant_is_revalidated(app, client, saved_image):
+    filename, content = saved_image
+    variant = filename[:64] + ".320w.webp"
+    with open(os.path.join(app.config["UPLOAD_DIR"], variant), "wb") as f:
+        f.write(b"variant")
+    response = client.get("/images/" + variant)
+    assert response.data == b"variant"
+    assert response.cache_control.no_cache
+    assert not response.cache_control.immutable
+    assert response.cache_control.max_age is None
+
+    response = client.get("/images/" + variant, headers={
+        "If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+
+
+def test_image_range_request(client, saved_image):
+    filename, content = saved_image
+    response = client.get(
+        "/images/" + filename, headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.data == content[10:20]
+    assert response.headers["Content-Range"] == "bytes 10-19/{}".format(
+        len(content))
+
+    response = client.get("/images/" + filename, headers={
+        "Range": "bytes={}-".format(len(content) + 1)})
+    assert response.status_code == 416
+
+
+def test_missing_image(client):
+    assert client.get("/images/missing.png").status_code == 404
+    assert client.get("/images/..%2Fflaskr.sqlite").status_code == 404
+
+
+@pytest.mark.parametrize(("mode", "header", "value"), (
+    ("x-sendfile", "X-Sendfile", None),
+    ("x-accel-redirect", "X-Accel-Redirect", "/protected-uploads/"),
+))
+def test_image_sent_by_proxy(app, client, saved_image, mode, header, value):
+    app.config["IMAGE_SENDFILE"] = mode
+    filename, content = saved_image
+    response = client.get(
+        "/images/" + filename, headers={"Range": "bytes=10-19"})
+    assert response.status_code == 200
+    assert response.data == b""
+    assert response.mimetype == "image/png"
+    assert response.cache_control.immutable
+    if value is None:
+        value = os.path.join(app.config["UPLOAD_DIR"], filename)
+    else:
+        value += filename
+    assert response.headers[header] == value
+    assert "X-Sendfile" not in response.headers or header == "X-Sendfile"
+
+    response = client.get("/images/" + filename, headers={
+        "If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    assert header not in response.headers
+
+
+def test_deleting_post_deletes_image(app, client, auth, saved_image):
+    filename, _ = saved_image
+    with app.app_context():
+        images.create_post_image_association(post_id=1, filename=filename)
+    auth.login()
+    client.post("/1/delete")
+    with app.app_context():
+        assert images.get_image_of_post(post_id=1) is None
+    assert os.listdir(app.config["UPLOAD_DIR"]) == []
+
+
+def test_image_changes_invalidate_listings(app, client, saved_image):
+    filename, _ = saved_image
+    etag = client.get("/").headers["ETag"]
+    with app.app_context():
+        images.create_post_image_association(post_id=1, filename=filename)
+    response = client.get("/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+    etag = response.headers["ETag"]
+    with app.app_context():
+        images.delete_post_image_associations_of_post(post_id=1)
+    response = client.get("/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+
+def test_files_unchanged_when_association_fails(app, monkeypatch):
+    upload_dir = app.config["UPLOAD_DIR"]
+    with open(os.path.join(upload_dir, "old.png"), "wb") as f:
+        f.write(b"12345")
+    with app.app_context():
+        images.create_post_image_association(post_id=1, filename="old.png")
+
+        def fail(func):
+            raise RuntimeError("The transaction failed")
+
+        monkeypatch.setattr(images, "run_write", fail)
+        with pytest.raises(RuntimeError):
+            images.save_image_and_create_or_update_post_association(
+                image=FileStorage(
+                    stream=ExampleImage().fileobject, filename="example.png"),
+                post_id=1)
+        assert images.get_image_of_post(post_id=1) == "old.png"
+    # The old image is kept and the new one is not stored
+    assert os.listdir(upload_dir) == ["old.png"]
+
+
+def test_image_referenced_meanwhile_is_not_removed(app, monkeypatch):
+    example_image = ExampleImage()
+    with app.app_context():
+        images.save_image_and_create_or_update_post_association(
+            image=FileStorage(
+                stream=example_image.fileobject, filename="example.png"),
+            post_id=1)
+        filename = images.get_image_of_post(post_id=1)
+
+    def associate_again():
+        with app.app_context(), open(example_image.path, "rb") as f:
+            images.save_image_and_create_or_update_post_association(
+                image=FileStorage(stream=f, filename="example.png"),
+                post_id=1)
+
+    remove = images.remove
+    threads = []
+
+    def associate_again_then_remove(upload_dir, name):
+        if not threads:
+            # Another request uploads the same image while it is removed
+            threads.append(threading.Thread(target=associate_again))
+            threads[0].start()
+            threads[0].join(timeout=0.5)
+        remove(upload_dir, name)
+
+    monkeypatch.setattr(images, "remove", associate_again_then_remove)
+    with app.app_context():
+        images.delete_post_image_associations_of_post(post_id=1)
+    threads[0].join()
+    with app.app_context():
+        assert images.get_image_of_post(post_id=1) == filename
+    assert os.path.exists(os.path.join(app.config["UPLOAD_DIR"], filename))
+
+
+@pytest.fixture
+def upload_dir_with_garbage(app, saved_image):
+    """The saved image is referenced, everything else is garbage"""
+    filename, _ = saved_image
+    upload_dir = app.config["UPLOAD_DIR"]
+    stem = filename[:64]
+    with app.app_context():
+        images.create_post_image_association(post_id=1, filename=filename)
+        db = get_db()
+        db.execute(
+            "INSERT INTO post_image (post_id, filename) VALUES (99, 'gone')")
+        db.commit()
+    kept = [filename, stem + ".320w.png", stem + ".320w.webp",
+            filename + ".variants.json", "new.png"]
+    garbage = ["old.png", "old.320w.webp", "old.png.variants.json",
+               "tmpabc.tmp", stem + ".jpg"]
+    for name in kept[1:] + garbage:
+        with open(os.path.join(upload_dir, name), "wb") as f:
+            f.write(b"12345")
+    an_hour_ago = os.stat(upload_dir).st_mtime - 3601
+    for name in [filename] + kept[1:-1] + garbage:
+        os.utime(os.path.join(upload_dir, name), (an_hour_ago, an_hour_ago))
+    return kept, garbage
+
+
+def test_gc_images(app, runner, upload_dir_with_garbage):
+    kept, garbage = upload_dir_with_garbage
+    result = runner.invoke(args=["gc-images", "--batch-size", "2"])
+    assert "Removed 1 associations with deleted posts." in result.output
+    assert "Removed 5 files (25 bytes)." in result.output
+    assert sorted(os.listdir(app.config["UPLOAD_DIR"])) == sorted(kept)
+    with app.app_context():
+        assert [row["post_id"] for row in get_db().execute(
+            "SELECT post_id FROM post_image")] == [1]
+
+
+def test_gc_images_dry_run(app, runner, upload_dir_with_garbage):
+    kept, garbage = upload_dir_with_garbage
+    result = runner.invoke(args=["gc-images", "--dry-run"])
+    assert "Would remove 1 associations" in result.output
+    assert "Would remove 5 files (25 bytes)." in result.output
+    assert sorted(os.listdir(app.config["UPLOAD_DIR"])) == sorted(
+        kept + garbage)
+
+
+def test_gc_images_quarantine(app, runner, tmp_path, upload_dir_with_garbage):
+    kept, garbage = upload_dir_with_garbage
+    quarantine_dir = tmp_path / "quarantine"
+    result = runner.invoke(
+        args=["gc-images", "--quarantine", str(quarantine_dir)])
+    assert "Quarantined 5 files (25 bytes)." in result.output
+    assert sorted(os.listdir(app.config["UPLOAD_DIR"])) == sorted(kept)
+    assert sorted(os.listdir(quarantine_dir)) == sorted(garbage)
+
+
+def test_gc_images_keeps_files_referenced_meanwhile(app, monkeypatch):
+    upload_dir = app.config["UPLOAD_DIR"]
+    path = os.path.join(upload_dir, "late.png")
+    with open(path, "wb") as f:
+        f.write(b"12345")
+    os.utime(path, (0, 0))
+    with app.app_context():
+        db = get_db()
+        run_locked_write = images.run_locked_write
+        calls = []
+
+        def reference_then_run_locked_write(func):
+            calls.append(func)
+            # Another request references the file after it was listed
+            db.execute(
+                "INSERT INTO post_image (post_id, filename)"
+                " VALUES (1, 'late.png')")
+            db.commit()
+            return run_locked_write(func)
+
+        monkeypatch.setattr(
+            images, "run_locked_write", reference_then_run_locked_write)
+        garbage = images.collect_image_garbage()
+    assert len(calls) == 1
+    assert garbage.files == 0
+    assert os.listdir(upload_dir) == ["late.png"]
+
+
+def test_gc_images_keeps_files_uploaded_while_removing(app, monkeypatch):
+    example_image = ExampleImage()
+    filename = hashlib.sha256(example_image.content).hexdigest() + ".png"
+    path = os.path.join(app.config["UPLOAD_DIR"], filename)
+    shutil.copyfile(example_image.path, path)
+    os.utime(path, (0, 0))
+
+    def upload():
+        with app.app_context(), open(example_image.path, "rb") as f:
+            images.save_image_and_create_or_update_post_association(
+                image=FileStorage(stream=f, filename="example.png"),
+                post_id=1)
+
+    is_referenced = images._is_referenced
+    threads = []
+
+    def is_referenced_then_upload(*args):
+        referenced = is_referenced(*args)
+        # Another request uploads the image after it was checked
+        threads.append(threading.Thread(target=upload))
+        threads[0].start()
+        threads[0].join(timeout=0.5)
+        return referenced
+
+    monkeypatch.setattr(images, "_is_referenced", is_referenced_then_upload)
+    with app.app_context():
+        images.collect_image_garbage()
+    threads[0].join()
+    with app.app_context():
+        assert images.get_image_of_post(post_id=1) == filename
+    assert os.path.exists(path)
+
+
+def test_gc_images_reports_missing_files(app, runner):
+    with app.app_context():
+        db = get_db()
+        db.execute(
+            "INSERT INTO post_image (post_id, filename) VALUES (1, 'lost')")
+        db.commit()
+    result = runner.invoke(args=["gc-images"])
+    assert "Missing referenced file lost." in result.output
@@ -1,5 +1,11 @@
+from sqlite3 import IntegrityError
+
+import pytest
+
 from flaskr.db import get_db
-from flaskr.likes import get_users_liking_post
+from flaskr.likes import (
+    create_like, delete_like, get_users_liking_post, user_likes_post
+)
 
 
 def test_get_likes_for_post(app):
@@ -92,3 +98,42 @@ def test_logged_in_user_sees_like_link(client, auth, app):
     response = client.get("/1/detail")
     assert b"/likes/delete" in response.data
     auth.logout()
+
+
+def get_like_count(post_id):
+    return get_db().execute(
+        "SELECT like_count FROM post WHERE id = ?", (post_id,)
+    ).fetchone()["like_count"]
+
+
+def test_like_count_maintained(app):
+    with app.app_context():
+        assert get_like_count(1) == 1
+
+        create_like(user_id=1, post_id=1)
+        assert get_like_count(1) == 2
+
+        with pytest.raises(IntegrityError):
+            create_like(user_id=1, post_id=1)
+        assert get_like_count(1) == 2
+
+        delete_like(user_id=1, post_id=1)
+        delete_like(user_id=1, post_id=1)
+        assert get_like_count(1) == 1
+
+
+def test_user_likes_post(app):
+    with app.app_context():
+        assert user_likes_post(user_id=2, post_id=1)
+        assert not user_likes_post(user_id=1, post_id=1)
+
+
+def test_like_count_shown_on_detail(client, auth):
+    assert b"1 Likes" in client.get("/1/detail").data
+
+    auth.login()
+    client.post("/likes/create", data={"post_id": 1})
+    assert b"2 Likes" in client.get("/1/detail").data
+
+    client.post("/likes/delete", data={"post_id": 1})
+    assert b"1 Likes" in client.get("/1/detail").data
@@ -3,6 +3,7 @@ from flask import url_for
 import pytest
 
 from flaskr.db import get_db
+from flaskr.rendering import get_render_options
 
 
 @pytest.mark.parametrize(("post_path", "post_id"), (
@@ -96,3 +97,65 @@ def test_html_in_markdown_is_escaped(client, auth, app, get_path):
         print(response.data)
         assert b"<i>This HTML should be escaped</i>" not in response.data
         assert b"&lt;i&gt;This HTML should be escaped&lt;/i&gt;" in response.data
+
+
+def get_rendered_post(app, post_id):
+    with app.app_context():
+        return get_db().execute(
+            "SELECT body_html, render_options FROM post WHERE id = ?",
+            (post_id,)
+        ).fetchone()
+
+
+def test_render_options_recorded(client, auth, app):
+    auth.login()
+    client.post("/1/update", data={"title": "title", "body": "*a*"})
+    with app.app_context():
+        assert get_rendered_post(app, 1)["render_options"] == (
+            get_render_options())
+
+        app.config["MARKDOWN_EXTRAS"] = ("fenced-code-blocks",)
+        assert get_render_options() != get_rendered_post(
+            app, 1)["render_options"]
+
+
+def test_rendered_html_is_cached(client, auth, app, monkeypatch):
+    calls = []
+
+    def fake_render(body, extras):
+        calls.append(body)
+        return "<p>rendered</p>"
+
+    monkeypatch.setattr("flaskr.rendering._render", fake_render)
+    auth.login()
+    client.post("/1/update", data={"title": "title", "body": "same"})
+    client.post("/1/update", data={"title": "other title", "body": "same"})
+    assert calls == ["same"]
+
+    app.config["MARKDOWN_EXTRAS"] = ("tables",)
+    client.post("/1/update", data={"title": "title", "body": "same"})
+    assert calls == ["same", "same"]
+
+
+@pytest.mark.parametrize("workers", ("1", "2"))
+def test_rerender_posts_command(runner, app, workers):
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            "INSERT INTO post (title, body, author_id) VALUES (?, ?, 1)",
+            [("title", "## Heading {}".format(i)) for i in range(5)]
+        )
+        db.commit()
+
+    result = runner.invoke(args=[
+        "rerender-posts", "--workers", workers, "--batch-size", "2"])
+    assert "Re-rendered 6 posts." in result.output
+    assert "<h2>Heading 4</h2>" in get_rendered_post(app, 6)["body_html"]
+
+    # Only stale posts are re-rendered
+    result = runner.invoke(args=["rerender-posts", "--workers", workers])
+    assert "Re-rendered 0 posts." in result.output
+    app.config["MARKDOWN_EXTRAS"] = ("header-ids",)
+    result = runner.invoke(args=["rerender-posts", "--workers", workers])
+    assert "Re-rendered 6 posts." in result.output
+    assert 'id="heading-4"' in get_rendered_post(app, 6)["body_html"]
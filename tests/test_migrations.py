@@ -0,0 +1,156 @@
+import os
+import sqlite3
+import tempfile
+
+import pytest
+
+from flaskr import create_app
+from flaskr.db import close_connections, get_db
+from flaskr.migrations import MIGRATIONS, get_schema_version, migrate_db
+
+with open(os.path.join(os.path.dirname(__file__), "schema_v0.sql"),
+          "rb") as f:
+    _schema_v0_sql = f.read().decode("utf8")
+
+
+@pytest.fixture
+def app_v0():
+    """App with a database created before the first migration"""
+    db_fd, db_path = tempfile.mkstemp()
+    db = sqlite3.connect(db_path)
+    db.executescript(_schema_v0_sql)
+    db.executescript(
+        "INSERT INTO user (username, password) VALUES ('test', 'x');"
+        "INSERT INTO post (title, body, body_html, author_id)"
+        " VALUES ('old title', 'old body', 'old body', 1);"
+        "INSERT INTO tag (name) VALUES ('oldtag');"
+        "INSERT INTO post_tag (post_id, tag_id) VALUES (1, 1);"
+    )
+    db.close()
+
+    app = create_app({
+        "TESTING": True,
+        "DATABASE": db_path,
+        "UPLOAD_DIR": tempfile.mkdtemp()
+    })
+
+    yield app
+
+    close_connections(app)
+    os.close(db_fd)
+    for path in (db_path, db_path + "-wal", db_path + "-shm"):
+        if os.path.exists(path):
+            os.unlink(path)
+    os.rmdir(app.config["UPLOAD_DIR"])
+
+
+def test_new_database_has_latest_schema_version(app, runner):
+    with app.app_context():
+        assert get_schema_version() == len(MIGRATIONS)
+
+    result = runner.invoke(args=["migrate-db"])
+    assert "Applied" not in result.output
+    assert "version {}".format(len(MIGRATIONS)) in result.output
+
+
+def test_migrate_db_command_migrates_old_database(app_v0):
+    result = app_v0.test_cli_runner().invoke(args=["migrate-db"])
+    for func in MIGRATIONS:
+        assert "Applied migration {}.".format(func.__name__) in result.output
+
+    with app_v0.app_context():
+        assert get_schema_version() == len(MIGRATIONS)
+        post = get_db().execute(
+            "SELECT tag_string FROM post WHERE id = 1").fetchone()
+        assert post["tag_string"] == "oldtag"
+
+    client = app_v0.test_client()
+    assert b"old title" in client.get("/").data
+    assert b"old title" in client.get("/search/?q=oldtag").data
+    assert b"old title" in client.get("/tags/oldtag").data
+
+
+@pytest.mark.parametrize("split_read_write", (False, True))
+def test_failing_migration_is_rolled_back(
+        app_v0, monkeypatch, split_read_write):
+    app_v0.config["DB_SPLIT_READ_WRITE"] = split_read_write
+
+    def add_column_then_fail(db):
+        db.execute("ALTER TABLE post ADD COLUMN extra TEXT")
+        raise RuntimeError("The migration failed")
+
+    monkeypatch.setattr(
+        "flaskr.migrations.MIGRATIONS", [add_column_then_fail])
+    with app_v0.app_context():
+        with pytest.raises(RuntimeError):
+            migrate_db()
+        db = get_db()
+        assert get_schema_version() == 0
+        columns = [row["name"] for row in db.execute(
+            "PRAGMA table_info(post)")]
+        assert "extra" not in columns
+
+
+def test_migrated_schema_matches_new_schema(app, app_v0):
+    def schema_objects(app):
+        with app.app_context():
+            db = get_db()
+            objects = set(tuple(row) for row in db.execute(
+                "SELECT type, name FROM sqlite_master"
+                " WHERE name NOT LIKE 'sqlite_%'"
+            ).fetchall())
+            columns = set(
+                (table, column["name"])
+                for _, table in objects
+                for column in db.execute(
+                    "PRAGMA table_info({})".format(table)).fetchall()
+            )
+            return objects, columns
+
+    with app_v0.app_context():
+        migrate_db()
+    assert schema_objects(app_v0) == schema_objects(app)
+
+
+def test_migrate_db_refuses_newer_database(app, runner):
+    with app.app_context():
+        db = get_db()
+        db.execute("PRAGMA user_version = {}".format(len(MIGRATIONS) + 1))
+        db.commit()
+
+    result = runner.invoke(args=["migrate-db"])
+    assert result.exit_code != 0
+    assert "newer" in result.output
+
+
+def test_hot_queries_use_indexes(app, client, auth):
+    """
+    The queries of the views should select the rows of each table through an
+    index instead of scanning the whole table.
+    """
+    auth.login()
+    with app.app_context():
+        db = get_db()
+        statements = []
+        db.set_trace_callback(statements.append)
+        # The requests reuse the app context and thus the connection.
+        client.get("/")
+        client.get("/1/detail")
+        client.get("/tags/testtag")
+        client.get("/search/?q=test")
+        client.get("/?after=2")
+        db.set_trace_callback(None)
+
+        selects = [s for s in statements
+                   if s.startswith("SELECT") and "COUNT()" not in s]
+        assert len(selects) >= 5
+        for statement in selects:
+            plan = db.execute("EXPLAIN QUERY PLAN " + statement).fetchall()
+            for row in plan:
+                detail = row["detail"]
+                if detail.startswith("SCAN") and "INDEX" not in detail:
+                    # Walking a table in primary key order is fine, if the
+                    # walk stops at the limit.
+                    table = detail.split()[1]
+                    assert ("ORDER BY {}.id".format(table) in statement
+                            and "LIMIT" in statement), (statement, detail)
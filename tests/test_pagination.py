@@ -2,7 +2,7 @@ import pytest
 
 from flaskr.blog import create_post, update_post
 from flaskr.db import get_db
-from flaskr.pagination import Pagination
+from flaskr.pagination import KeysetPagination, Pagination
 from flaskr.tags import associate_tag_with_post, get_or_create_tag
 
 
@@ -315,3 +315,148 @@ def test_pagination_links_on_tagged_result_index_page(
     response = client.get("/tags/newtag?page=3")
     assert b"/tags/newtag?page=2" in response.data
     assert b"/tags/newtag?page=4" not in response.data
+
+
+def test_keyset_pagination_of_posts_after_cursor(numbered_posts, client):
+    response = client.get("/?after=11")
+    assert b"paged title 11" not in response.data
+    assert b"paged title 10" in response.data
+    assert b"paged title 06" in response.data
+    assert b"paged title 05" not in response.data
+
+
+def test_keyset_pagination_of_posts_before_cursor(numbered_posts, client):
+    response = client.get("/?before=5")
+    assert b"paged title 05" not in response.data
+    assert b"paged title 06" in response.data
+    assert b"paged title 10" in response.data
+    assert b"paged title 11" not in response.data
+
+
+def test_keyset_pagination_links_on_index_pages(numbered_posts, client, app):
+    app.config["PAGINATION_MODE"] = "keyset"
+
+    response = client.get("/")
+    assert b"paged title 15" in response.data
+    assert b"paged title 11" in response.data
+    assert b"paged title 10" not in response.data
+    assert b"/?after=11" in response.data
+    assert b"before=" not in response.data
+    assert b"page=" not in response.data
+
+    response = client.get("/?after=11")
+    assert b"/?before=10" in response.data
+    assert b"/?after=6" in response.data
+
+    response = client.get("/?after=6")
+    assert b"paged title 05" in response.data
+    assert b"paged title 01" in response.data
+    assert b"/?before=5" in response.data
+    assert b"after=" not in response.data
+
+
+def test_keyset_pagination_links_on_tagged_result_index_page(
+        numbered_posts, client, app):
+    app.config["PAGINATION_MODE"] = "keyset"
+    with app.app_context():
+        db = get_db()
+        tag_id = get_or_create_tag("newtag")
+        posts = db.execute("SELECT id FROM post").fetchall()
+        for post in posts:
+            associate_tag_with_post(post_id=post["id"], tag_id=tag_id)
+
+    response = client.get("/tags/newtag")
+    assert b"/tags/newtag?after=11" in response.data
+
+    response = client.get("/tags/newtag?after=11")
+    assert b"paged title 10" in response.data
+    assert b"paged title 11" not in response.data
+    assert b"/tags/newtag?before=10" in response.data
+    assert b"/tags/newtag?after=6" in response.data
+
+
+def test_keyset_pagination_links_on_search_result_index_page(
+        numbered_posts, client, app):
+    app.config["PAGINATION_MODE"] = "keyset"
+    response = client.get("/search/?q=paged")
+    assert b"/search/?q=paged&after=11" in response.data
+
+    response = client.get("/search/?q=paged&after=11")
+    assert b"paged title 10" in response.data
+    assert b"/search/?q=paged&before=10" in response.data
+    assert b"/search/?q=paged&after=6" in response.data
+
+
+def test_keyset_pagination_after_deleted_cursor_post(
+        numbered_posts, client, app):
+    app.config["PAGINATION_MODE"] = "keyset"
+    with app.app_context():
+        db = get_db()
+        tag_id = get_or_create_tag("newtag")
+        posts = db.execute("SELECT id FROM post").fetchall()
+        for post in posts:
+            associate_tag_with_post(post_id=post["id"], tag_id=tag_id)
+        db.execute("DELETE FROM post WHERE id = 11")
+        db.commit()
+
+    response = client.get("/tags/newtag?after=11")
+    assert b"paged title 10" in response.data
+    assert b"paged title 12" not in response.data
+    assert b"/tags/newtag?after=6" in response.data
+
+    response = client.get("/tags/newtag?before=11")
+    assert b"paged title 12" in response.data
+    assert b"paged title 10" not in response.data
+
+    response = client.get("/search/?q=paged&after=11")
+    assert b"paged title 10" in response.data
+    assert b"paged title 12" not in response.data
+    assert b"/search/?q=paged&after=6" in response.data
+
+
+@pytest.mark.parametrize(
+    ("after", "before", "condition_expected", "order_expected"), (
+        (None, None, ("1", ()), "p.id DESC"),
+        (7, None, ("p.id < ?", (7,)), "p.id DESC"),
+        (None, 7, ("p.id > ?", (7,)), "p.id ASC"),
+    ))
+def test_keyset_pagination_object_sql_clauses(
+        after, before, condition_expected, order_expected):
+    pagination = KeysetPagination(
+        items_per_page=5, after=after, before=before)
+    assert pagination.key_condition("p.id") == condition_expected
+    assert pagination.order_by("p.id") == order_expected
+    assert pagination.limit_clause() == ("LIMIT ?", (6,))
+
+
+def test_keyset_pagination_object_sql_condition_with_fallback():
+    pagination = KeysetPagination(items_per_page=5, after=7)
+    assert pagination.key_condition(
+        "(p.created, p.id)",
+        cursor_key="(SELECT created, id FROM post WHERE id = ?)",
+        fallback_key="p.id") == (
+            "COALESCE((p.created, p.id)"
+            " < (SELECT created, id FROM post WHERE id = ?), p.id < ?)",
+            (7, 7))
+
+
+@pytest.mark.parametrize(
+    ("after", "before", "row_ids", "expected"), (
+        # First page with more items following
+        (None, None, [9, 8, 7], ([9, 8], None, 8)),
+        # Page after a cursor, which is also the last page
+        (7, None, [6, 5], ([6, 5], 6, None)),
+        # Page before a cursor, selected in ascending order
+        (None, 3, [4, 5, 6], ([5, 4], 5, 4)),
+        # Page before a cursor, which is also the first page
+        (None, 3, [4, 5], ([5, 4], None, 4)),
+    ))
+def test_keyset_pagination_object_paginate(after, before, row_ids, expected):
+    pagination = KeysetPagination(
+        items_per_page=2, after=after, before=before)
+    rows = pagination.paginate([{"id": i} for i in row_ids])
+    assert ([row["id"] for row in rows],
+            pagination.previous,
+            pagination.next) == expected
+    assert pagination.is_first == (pagination.previous is None)
+    assert pagination.is_last == (pagination.next is None)
@@ -0,0 +1,97 @@
+import threading
+
+import pytest
+
+from flaskr.db import get_db
+from flaskr.passwords import (
+    PasswordHasher, PasswordHashingBusyError, benchmark_hash_method,
+    get_method_prefix
+)
+
+
+def get_password_hash(app, username):
+    with app.app_context():
+        return get_db().execute(
+            "SELECT password FROM user WHERE username = ?", (username,)
+        ).fetchone()["password"]
+
+
+def test_register_uses_configured_method(client, app):
+    app.extensions["flaskr_password_hasher"].method = "pbkdf2:sha256:1000"
+    client.post("/auth/register", data={"username": "a", "password": "a"})
+    assert get_password_hash(app, "a").startswith("pbkdf2:sha256:1000$")
+
+
+def test_rehash_on_login(client, auth, app):
+    old_hash = get_password_hash(app, "test")
+    auth.login()
+    assert get_password_hash(app, "test") == old_hash
+
+    client.get("/auth/logout")
+    app.extensions["flaskr_password_hasher"].method = "pbkdf2:sha256:1000"
+    response = auth.login()
+    assert response.status_code == 302
+    new_hash = get_password_hash(app, "test")
+    assert new_hash.startswith("pbkdf2:sha256:1000$")
+
+    # The new hash is used for following logins
+    client.get("/auth/logout")
+    assert auth.login().status_code == 302
+    assert get_password_hash(app, "test") == new_hash
+
+
+def test_wrong_password_is_not_rehashed(auth, app):
+    old_hash = get_password_hash(app, "test")
+    app.extensions["flaskr_password_hasher"].method = "pbkdf2:sha256:1000"
+    auth.login(password="wrong")
+    assert get_password_hash(app, "test") == old_hash
+
+
+@pytest.mark.parametrize(("method", "prefix"), (
+    ("pbkdf2:sha256:1000", "pbkdf2:sha256:1000"),
+    ("scrypt:16384:8:1", "scrypt:16384:8:1"),
+    ("scrypt", "scrypt:32768:8:1"),
+))
+def test_method_prefix(method, prefix):
+    assert get_method_prefix(method) == prefix
+
+
+def test_hasher_is_bounded():
+    hasher = PasswordHasher(
+        method="pbkdf2:sha256:1000", workers=1, max_pending=0)
+    blocked = threading.Event()
+    release = threading.Event()
+
+    def block():
+        blocked.set()
+        release.wait()
+
+    thread = threading.Thread(target=hasher._run, args=(block,))
+    thread.start()
+    blocked.wait()
+    try:
+        with pytest.raises(PasswordHashingBusyError):
+            hasher.hash("password")
+    finally:
+        release.set()
+        thread.join()
+    assert hasher.verify(hasher.hash("password"), "password")
+
+
+def test_busy_login_shows_error(client, auth, app, monkeypatch):
+    def busy(pwhash, password):
+        raise PasswordHashingBusyError()
+
+    monkeypatch.setattr("flaskr.auth.verify_password", busy)
+    response = auth.login()
+    assert response.status_code == 200
+    assert b"Please try again." in response.data
+
+
+def test_benchmark(runner):
+    assert benchmark_hash_method("pbkdf2:sha256:1000", duration=0.01) > 0
+    result = runner.invoke(args=[
+        "benchmark-password-hashing", "--method", "pbkdf2:sha256:1000",
+        "--duration", "0.01"])
+    assert "pbkdf2:sha256:1000" in result.output
+    assert "hashes/s" in result.output
@@ -1,6 +1,172 @@
+import os
+import threading
+
+import pytest
+
+from flaskr import rss
+from flaskr.db import get_db
+
 
 def test_get_rss_files_from_URL(client, app):
     response = client.get("/feed.rss")
     assert b"<rss " in response.data
     assert b"<channel>" in response.data
     assert b"test title" in response.data
+
+
+def create_posts(app, count):
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            "INSERT INTO post (title, body, body_html, author_id)"
+            " VALUES (?, '', '', 1)",
+            [("feed post {}".format(i),) for i in range(count)]
+        )
+        db.commit()
+
+
+def test_feed_is_streamed(client):
+    response = client.get("/feed.rss")
+    assert response.is_streamed
+    assert response.mimetype == "application/rss+xml"
+    assert b"test title" in response.data
+
+
+def test_feed_is_paged(client, app):
+    app.config["RSS_FEED_ITEMS"] = 2
+    create_posts(app, 2)
+
+    response = client.get("/feed.rss")
+    assert response.data.count(b"<item>") == 2
+    assert b"feed post 1" in response.data
+    assert b'rel="next" href="http://localhost/feed.rss?page=2"' in (
+        response.data)
+    assert b'rel="previous"' not in response.data
+
+    response = client.get("/feed.rss?page=2")
+    assert response.data.count(b"<item>") == 1
+    assert b"test title" in response.data
+    assert b'rel="previous" href="http://localhost/feed.rss?page=1"' in (
+        response.data)
+    assert b'rel="next"' not in response.data
+
+
+@pytest.mark.parametrize("page", ("0", "3"))
+def test_feed_page_not_found(client, app, page):
+    app.config["RSS_FEED_ITEMS"] = 1
+    assert client.get("/feed.rss?page=" + page).status_code == 404
+
+
+def test_feed_snapshot_published_on_write(client, auth, app):
+    snapshot_path = os.path.join(app.config["FEED_SNAPSHOT_DIR"], "feed.rss")
+    assert not os.path.exists(snapshot_path)
+
+    auth.login()
+    client.post("/create", data={"title": "snapshot post", "body": ""})
+    with open(snapshot_path, "rb") as f:
+        assert b"snapshot post" in f.read()
+
+    client.post("/1/update", data={"title": "updated title", "body": ""})
+    with open(snapshot_path, "rb") as f:
+        assert b"updated title" in f.read()
+
+    client.post("/1/delete")
+    with open(snapshot_path, "rb") as f:
+        assert b"updated title" not in f.read()
+
+
+def test_feed_snapshot_is_served_without_database(client, auth, app):
+    auth.login()
+    client.post("/create", data={"title": "snapshot post", "body": ""})
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE post SET title = 'changed' WHERE id = 1")
+        db.commit()
+
+    response = client.get("/feed.rss")
+    assert response.mimetype == "application/rss+xml"
+    assert b"snapshot post" in response.data
+    assert b"changed" not in response.data
+    response = client.get(
+        "/feed.rss", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    # Further pages are rendered from the database
+    app.config["RSS_FEED_ITEMS"] = 1
+    assert b"changed" in client.get("/feed.rss?page=2").data
+
+
+def test_json_feed(client, app):
+    app.config["RSS_FEED_ITEMS"] = 1
+    create_posts(app, 1)
+    response = client.get("/feed.json")
+    assert response.mimetype == "application/feed+json"
+    feed = response.get_json(force=True)
+    assert feed["items"][0]["title"] == "feed post 0"
+    assert feed["next_url"] == "http://localhost/feed.json?page=2"
+
+    feed = client.get("/feed.json?page=2").get_json(force=True)
+    assert feed["items"][0]["url"] == "http://localhost/1/detail"
+    assert "next_url" not in feed
+
+
+def test_publish_feeds_command(runner, app):
+    app.config["FEED_SNAPSHOT_FORMATS"] = ("rss", "json")
+    result = runner.invoke(args=["publish-feeds"])
+    assert "Published" in result.output
+    for filename in ("feed.rss", "feed.json"):
+        path = os.path.join(app.config["FEED_SNAPSHOT_DIR"], filename)
+        with open(path, "rb") as f:
+            assert b"test title" in f.read()
+
+
+def test_init_db_removes_feed_snapshots(app, client, runner):
+    app.config["FEED_SNAPSHOT_FORMATS"] = ("rss", "json")
+    runner.invoke(args=["publish-feeds"])
+    assert b"test title" in client.get("/feed.rss").data
+
+    runner.invoke(args=["init-db"])
+    for filename in ("feed.rss", "feed.json"):
+        assert not os.path.exists(
+            os.path.join(app.config["FEED_SNAPSHOT_DIR"], filename))
+    assert b"test title" not in client.get("/feed.rss").data
+    assert b"test title" not in client.get("/feed.json").data
+
+
+def test_publishing_feeds_is_serialized(app, monkeypatch):
+    read = threading.Event()
+    release = threading.Event()
+    get_feed_page = rss.get_feed_page
+
+    def get_feed_page_then_wait(*args):
+        result = get_feed_page(*args)
+        if not read.is_set():
+            read.set()
+            release.wait()
+        return result
+
+    def publish():
+        with app.test_request_context():
+            rss.publish_feeds()
+
+    monkeypatch.setattr(rss, "get_feed_page", get_feed_page_then_wait)
+    # A slow publisher reads the posts before the change
+    slow = threading.Thread(target=publish)
+    slow.start()
+    read.wait()
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE post SET title = 'changed title' WHERE id = 1")
+        db.commit()
+    # The publisher of the change waits for the slow one
+    fast = threading.Thread(target=publish)
+    fast.start()
+    try:
+        fast.join(timeout=0.5)
+        assert fast.is_alive()
+    finally:
+        release.set()
+        slow.join()
+        fast.join()
+    path = os.path.join(app.config["FEED_SNAPSHOT_DIR"], "feed.rss")
+    with open(path, "rb") as f:
+        assert b"changed title" in f.read()
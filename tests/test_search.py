@@ -1,6 +1,10 @@
+import pytest
 from flask import url_for
 
-from flaskr.blog import create_post
+from flaskr.blog import create_post, update_post
+from flaskr.db import get_db
+from flaskr.search import build_match_query
+from flaskr.tags import update_tag_associations_for_post
 
 
 def test_filtered_index_by_url(app, client):
@@ -21,3 +25,92 @@ def test_search_bar_displayed_on_index(app, client):
             'action="' + url_for('search.display_search_filtered_index'),
             encoding='utf8')
             in response.data)
+
+
+def test_search_matches_body_and_tags(app, client):
+    with app.app_context():
+        create_post("other title", "other body", 2)
+        create_post("tagged title", "plain body", 2)
+        update_tag_associations_for_post(tag_string="needle", post_id=3)
+
+    response = client.get("/search/?q=other")
+    assert b"other title" in response.data
+    assert b"test title" not in response.data
+
+    response = client.get("/search/?q=needle")
+    assert b"tagged title" in response.data
+    assert b"other title" not in response.data
+
+
+def test_search_prefix_query_and_highlighted_snippet(app, client):
+    with app.app_context():
+        create_post("other title", "a haystack with a needle", 2)
+
+    response = client.get("/search/?q=need")
+    assert b"other title" in response.data
+    assert b"<mark>needle</mark>" in response.data
+
+
+def test_search_all_words_required(app, client):
+    with app.app_context():
+        create_post("other title", "other body", 2)
+
+    response = client.get("/search/?q=test+body")
+    assert b"test title" in response.data
+    assert b"other title" not in response.data
+
+
+@pytest.mark.parametrize("query", (
+    '"',
+    "title OR",
+    "NEAR(",
+    "test*^",
+))
+def test_search_query_syntax_is_escaped(client, query):
+    response = client.get("/search/", query_string={"q": query})
+    assert response.status_code == 200
+
+
+def test_search_without_words_redirects_to_index(client):
+    response = client.get("/search/?q=+")
+    assert response.status_code == 302
+
+
+def test_search_index_follows_post_changes(app, client):
+    with app.app_context():
+        update_post(1, "renamed", "some body")
+    assert b'href="/1/detail"' in client.get("/search/?q=renamed").data
+    assert b'href="/1/detail"' not in client.get("/search/?q=title").data
+
+    with app.app_context():
+        db = get_db()
+        db.execute("DELETE FROM post WHERE id = 1")
+        db.commit()
+    assert b'href="/1/detail"' not in client.get("/search/?q=renamed").data
+
+
+def test_rebuild_search_index_command(app, runner):
+    with app.app_context():
+        db = get_db()
+        db.execute("DELETE FROM post_fts")
+        db.commit()
+
+    result = runner.invoke(args=["rebuild-search-index"])
+    assert "Rebuilt" in result.output
+
+    with app.app_context():
+        row = get_db().execute(
+            "SELECT rowid, tags FROM post_fts WHERE post_fts MATCH 'test'"
+        ).fetchone()
+        assert row["rowid"] == 1
+        assert row["tags"] == "testtag"
+
+
+@pytest.mark.parametrize(("query", "expected"), (
+    ("test", '"test"*'),
+    ("two words", '"two"* "words"*'),
+    ('say "hi"', '"say"* """hi"""*'),
+    ("  ", None),
+))
+def test_build_match_query(query, expected):
+    assert build_match_query(query) == expected
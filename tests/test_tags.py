@@ -2,7 +2,7 @@ from flask import url_for
 
 from flaskr.db import get_db
 from flaskr.tags import (
-    get_or_create_tag, get_or_create_tags_from_string,
+    get_or_create_tag, get_or_create_tags, get_or_create_tags_from_string,
     get_tags_for_post,
     associate_tag_with_post,
     disassociate_tag_from_post,
@@ -359,3 +359,80 @@ def test_editing_a_post_without_tags_does_show_none_as_tag(client, auth, app):
 #         for r in rows:
 #             print(tuple(r))
 #             print(r['tag_list'].split(","))
+
+
+def test_get_or_create_tags(app):
+    with app.app_context():
+        tag_ids = get_or_create_tags(["testtag", " newtag", "", "newtag"])
+        assert tag_ids["testtag"] == 1
+        assert set(tag_ids) == {"testtag", "newtag"}
+        db = get_db()
+        assert db.execute("SELECT COUNT(id) FROM tag").fetchone()[0] == 2
+
+        assert get_or_create_tags([]) == {}
+
+
+def test_update_tag_associations_keeps_unchanged_associations(app):
+    with app.app_context():
+        db = get_db()
+        association_id = db.execute(
+            "SELECT id FROM post_tag WHERE post_id = 1").fetchone()["id"]
+
+        update_tag_associations_for_post(
+            tag_string="testtag newtag newtag", post_id=1)
+
+        rows = db.execute(
+            "SELECT pt.id, t.name FROM post_tag pt JOIN tag t"
+            " ON pt.tag_id = t.id WHERE pt.post_id = 1 ORDER BY pt.id"
+        ).fetchall()
+        assert [tuple(row) for row in rows][0] == (association_id, "testtag")
+        assert [row["name"] for row in rows] == ["testtag", "newtag"]
+
+
+def test_update_tag_associations_in_one_transaction(app):
+    tag_string = " ".join("tag{}".format(i) for i in range(20))
+    with app.app_context():
+        db = get_db()
+        statements = []
+        db.set_trace_callback(statements.append)
+        update_tag_associations_for_post(tag_string=tag_string, post_id=1)
+        db.set_trace_callback(None)
+
+        assert len(get_tags_for_post(post_id=1)) == 20
+        assert len([s for s in statements if s == "COMMIT"]) == 1
+
+
+def get_stored_tag_string(post_id):
+    return get_db().execute(
+        "SELECT tag_string FROM post WHERE id = ?", (post_id,)
+    ).fetchone()["tag_string"]
+
+
+def test_tag_string_maintained_with_associations(app):
+    with app.app_context():
+        update_tag_associations_for_post(
+            tag_string="newtag testtag", post_id=1)
+        assert get_stored_tag_string(1) == "newtag testtag"
+
+        disassociate_tag_from_post(tag_id=1, post_id=1)
+        assert get_stored_tag_string(1) == "newtag"
+
+        associate_tag_with_post(tag_id=1, post_id=1)
+        assert sorted(get_stored_tag_string(1).split()) == [
+            "newtag", "testtag"]
+
+        remove_tag_associations_for_post(post_id=1)
+        assert get_stored_tag_string(1) == ""
+
+
+def test_rebuild_tag_strings_command(app, runner):
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE post SET tag_string = ''")
+        db.commit()
+
+    result = runner.invoke(args=["rebuild-tag-strings"])
+    assert "Rebuilt" in result.output
+
+    with app.app_context():
+        assert get_stored_tag_string(1) == "testtag"
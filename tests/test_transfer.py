@@ -0,0 +1,93 @@
+import pytest
+
+from flaskr.db import get_db, init_db
+from flaskr.transfer import export_records, import_records
+
+
+def get_schema_objects():
+    return get_db().execute(
+        "SELECT type, name FROM sqlite_master ORDER BY name").fetchall()
+
+
+def test_export_records(app):
+    with app.app_context():
+        records = list(export_records())
+    assert [record["type"] for record in records] == [
+        "user", "user", "post", "comment", "like"]
+    post = records[2]
+    assert post["tags"] == ["testtag"]
+    assert post["created"] == "2018-01-01 00:00:00"
+    assert "body_html" not in post
+
+
+@pytest.mark.parametrize("workers", (1, 2))
+def test_export_and_import(app, runner, tmp_path, workers):
+    path = str(tmp_path / "data.ndjson")
+    result = runner.invoke(args=["export-data", path])
+    assert result.exit_code == 0
+    with open(path) as f:
+        exported = f.read()
+    assert len(exported.splitlines()) == 5
+
+    with app.app_context():
+        objects = [tuple(row) for row in get_schema_objects()]
+        init_db()
+    result = runner.invoke(
+        args=["import-data", path, "--workers", str(workers)])
+    assert result.exit_code == 0, result.output
+    assert "Imported 2 users, 1 posts, 1 comments, 1 likes (" in result.output
+
+    with app.app_context():
+        assert [tuple(row) for row in get_schema_objects()] == objects
+        db = get_db()
+        post = db.execute("SELECT * FROM post").fetchone()
+        assert post["like_count"] == 1
+        assert post["body_html"] == "<p>test\nbody</p>\n"
+        assert db.execute(
+            "SELECT rowid FROM post_fts WHERE post_fts MATCH 'testtag'"
+        ).fetchone()[0] == 1
+    result = runner.invoke(args=["export-data"])
+    assert result.output == exported
+
+
+def test_import_requires_empty_database(app, runner):
+    result = runner.invoke(args=["import-data"], input="")
+    assert result.exit_code != 0
+    assert "only be imported into an empty database" in result.output
+
+
+def test_failed_import_restores_indexes(app):
+    records = [
+        {"type": "user", "id": 1, "username": "a", "password": "x"},
+        {"type": "unknown"},
+    ]
+    with app.app_context():
+        objects = [tuple(row) for row in get_schema_objects()]
+        init_db()
+        with pytest.raises(ValueError):
+            import_records(iter(records), workers=1)
+        assert [tuple(row) for row in get_schema_objects()] == objects
+        # The records before the failure stay imported
+        assert get_db().execute(
+            "SELECT username FROM user").fetchone()[0] == "a"
+
+
+def test_import_in_batches(app):
+    records = [{"type": "user", "id": 1, "username": "a", "password": "x"}]
+    records += [
+        {"type": "post", "id": i, "author_id": 1, "title": str(i),
+         "body": "*{}*".format(i), "tags": ["a", "b", "a"]}
+        for i in range(1, 8)]
+    progress = []
+    with app.app_context():
+        init_db()
+        counts = import_records(
+            iter(records), batch_size=3, workers=1,
+            progress=lambda counts: progress.append(counts["post"]))
+        assert counts["post"] == 7
+        assert progress == [0, 3, 6, 7]
+        db = get_db()
+        assert tuple(db.execute(
+            "SELECT body_html, tag_string FROM post WHERE id = 7"
+        ).fetchone()) == ("<p><em>7</em></p>\n", "a b")
+        assert db.execute("SELECT COUNT() FROM post_tag").fetchone()[0] == 14
@@ -0,0 +1,135 @@
+import os
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from flaskr import create_app, images, uploads
+
+EXAMPLE_PATH = os.path.join(os.path.dirname(__file__), "example.png")
+FILENAME = "abcdef.png"
+
+
+def write_file(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"12345")
+
+
+def list_files(upload_dir):
+    return sorted(
+        os.path.relpath(entry.path, upload_dir)
+        for entry in uploads.iter_files(upload_dir))
+
+
+def test_relative_path():
+    assert uploads.get_relative_path(FILENAME, "flat") == FILENAME
+    assert uploads.get_relative_path(FILENAME, "sharded") == os.path.join(
+        "ab", "cd", FILENAME)
+    with pytest.raises(ValueError):
+        uploads.get_relative_path(FILENAME, "nested")
+
+
+def test_paths_stay_in_upload_dir(tmp_path):
+    assert uploads.get_path(str(tmp_path), "..", "flat") is None
+    assert uploads.get_path(str(tmp_path), "..abc", "sharded") is None
+    assert uploads.find_path(str(tmp_path), "..abc", "sharded") is None
+
+
+@pytest.mark.parametrize("layout", uploads.LAYOUTS)
+def test_find_path_in_any_layout(tmp_path, layout):
+    upload_dir = str(tmp_path)
+    assert uploads.find_path(upload_dir, FILENAME, "flat") is None
+
+    path = uploads.get_path(upload_dir, FILENAME, layout)
+    write_file(path)
+    for each_layout in uploads.LAYOUTS:
+        assert uploads.find_path(upload_dir, FILENAME, each_layout) == path
+
+    uploads.remove(upload_dir, FILENAME)
+    assert uploads.find_path(upload_dir, FILENAME, layout) is None
+
+
+@pytest.mark.parametrize("layout", uploads.LAYOUTS)
+def test_migrate_uploads(tmp_path, layout):
+    upload_dir = str(tmp_path)
+    other_layout = "flat" if layout == "sharded" else "sharded"
+    filenames = [FILENAME, "abcdef.320w.webp", "012345.png"]
+    for filename in filenames:
+        write_file(uploads.get_path(upload_dir, filename, other_layout))
+    # Already migrated and temporary files
+    write_file(uploads.get_path(upload_dir, "987654.png", layout))
+    write_file(uploads.get_path(upload_dir, "987654.png", other_layout))
+    write_file(os.path.join(upload_dir, "tmp123.tmp"))
+
+    progress = []
+    moved = uploads.migrate_uploads(
+        upload_dir, layout, batch_size=2, progress=progress.append)
+    assert moved == 4
+    assert progress == [2, 4]
+    assert list_files(upload_dir) == sorted(
+        [uploads.get_relative_path(filename, layout)
+         for filename in filenames + ["987654.png"]] + ["tmp123.tmp"])
+    if layout == "flat":
+        # The emptied shards are removed
+        assert sorted(os.listdir(upload_dir)) == sorted(
+            filenames + ["987654.png", "tmp123.tmp"])
+
+    assert uploads.migrate_uploads(upload_dir, layout) == 0
+
+
+def test_migrate_uploads_command(app, runner):
+    upload_dir = app.config["UPLOAD_DIR"]
+    write_file(os.path.join(upload_dir, FILENAME))
+    app.config["UPLOAD_DIR_LAYOUT"] = "sharded"
+    result = runner.invoke(args=["migrate-uploads"])
+    assert "Moved 1 files into the sharded layout." in result.output
+    assert list_files(upload_dir) == [os.path.join("ab", "cd", FILENAME)]
+
+
+def test_unknown_layout():
+    with pytest.raises(ValueError):
+        create_app({"TESTING": True, "UPLOAD_DIR_LAYOUT": "nested"})
+
+
+def test_sharded_uploads(app, client, auth, runner):
+    app.config["UPLOAD_DIR_LAYOUT"] = "sharded"
+    upload_dir = app.config["UPLOAD_DIR"]
+    auth.login()
+    with open(EXAMPLE_PATH, mode="rb") as f:
+        client.post("/1/update", data={
+            "title": "updated", "body": "", "image": [(f, "example.png")]})
+    with app.app_context():
+        filename = images.get_image_of_post(post_id=1)
+    path = os.path.join(filename[:2], filename[2:4], filename)
+    assert list_files(upload_dir) == [path]
+
+    response = client.get("/images/" + filename)
+    assert response.status_code == 200
+    app.config["IMAGE_SENDFILE"] = "x-accel-redirect"
+    response = client.get("/images/" + filename)
+    assert response.headers["X-Accel-Redirect"] == (
+        "/protected-uploads/" + path.replace(os.sep, "/"))
+
+    # Garbage in the shards is found as well
+    write_file(os.path.join(upload_dir, "ab", "cd", "abcdef.png"))
+    os.utime(os.path.join(upload_dir, "ab", "cd", "abcdef.png"), (0, 0))
+    result = runner.invoke(args=["gc-images"])
+    assert "Removed 1 files (5 bytes)." in result.output
+    assert list_files(upload_dir) == [path]
+
+    client.post("/1/delete")
+    assert list_files(upload_dir) == []
+
+
+def test_images_found_during_migration(app, client):
+    """Files stored flat are served and deleted with the sharded layout"""
+    with app.app_context(), open(EXAMPLE_PATH, mode="rb") as f:
+        images.save_image_and_create_or_update_post_association(
+            image=FileStorage(stream=f, filename="example.png"), post_id=1)
+        filename = images.get_image_of_post(post_id=1)
+    app.config["UPLOAD_DIR_LAYOUT"] = "sharded"
+    assert client.get("/images/" + filename).status_code == 200
+
+    with app.app_context():
+        images.delete_post_image_associations_of_post(post_id=1)
+    assert list_files(app.config["UPLOAD_DIR"]) == []
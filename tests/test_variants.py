@@ -0,0 +1,124 @@
+import json
+import os
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from flaskr import images, variants
+
+
+EXAMPLE_PATH = os.path.join(os.path.dirname(__file__), "example.png")
+
+
+def associate_example_image(app, post_id=1):
+    with app.app_context(), open(EXAMPLE_PATH, mode="rb") as f:
+        images.save_image_and_create_or_update_post_association(
+            image=FileStorage(stream=f, filename="example.png"),
+            post_id=post_id)
+        return images.get_image_of_post(post_id=post_id)
+
+
+def write_manifest(app, filename):
+    """Write variants like generate_variants would, without Pillow"""
+    stem, _ = os.path.splitext(filename)
+    manifest = {"variants": [
+        {"filename": stem + ".100w.png", "width": 100, "type": "image/png"},
+        {"filename": filename, "width": 200, "type": "image/png"},
+        {"filename": stem + ".100w.webp", "width": 100, "type": "image/webp"},
+        {"filename": stem + ".200w.webp", "width": 200, "type": "image/webp"},
+    ]}
+    upload_dir = app.config["UPLOAD_DIR"]
+    for variant in manifest["variants"]:
+        with open(os.path.join(upload_dir, variant["filename"]), "ab"):
+            pass
+    with open(os.path.join(
+            upload_dir, variants.get_manifest_filename(filename)), "w") as f:
+        json.dump(manifest, f)
+    return stem
+
+
+def test_no_variants_without_manifest(app, client):
+    filename = associate_example_image(app)
+    with app.test_request_context():
+        assert variants.get_image_variants(filename) == {}
+    response = client.get("/1/detail")
+    assert b"<picture>" not in response.data
+    assert filename.encode() in response.data
+    # The original is not shown in the listing
+    assert b"post-thumbnail" not in client.get("/").data
+
+
+def test_variants_selected_through_srcset(app, client):
+    filename = associate_example_image(app)
+    stem = write_manifest(app, filename)
+    with app.test_request_context():
+        grouped = variants.get_image_variants(filename)
+    assert list(grouped) == ["image/png", "image/webp"]
+    assert [v["width"] for v in grouped["image/webp"]] == [100, 200]
+
+    response = client.get("/1/detail")
+    assert b"<picture>" in response.data
+    assert (
+        'srcset="/images/{0}.100w.webp 100w, /images/{0}.200w.webp 200w"'
+        .format(stem).encode()) in response.data
+
+    response = client.get("/")
+    assert b"post-thumbnail" in response.data
+    assert 'srcset="/images/{}.100w.webp 100w"'.format(
+        stem).encode() in response.data
+
+
+def test_variants_deleted_with_image(app):
+    filename = associate_example_image(app)
+    write_manifest(app, filename)
+    assert len(os.listdir(app.config["UPLOAD_DIR"])) == 5
+
+    with app.app_context():
+        images.delete_post_image_associations_of_post(post_id=1)
+    assert os.listdir(app.config["UPLOAD_DIR"]) == []
+
+
+def test_generate_variants(app):
+    pytest.importorskip("PIL")
+    filename = associate_example_image(app)
+    generated = variants.generate_variants(
+        app.config["UPLOAD_DIR"], filename, widths=(50, 100, 400),
+        webp_quality=80)
+    assert sorted((v["type"], v["width"]) for v in generated) == [
+        ("image/png", 50), ("image/png", 100), ("image/png", 200),
+        ("image/webp", 50), ("image/webp", 100), ("image/webp", 200)]
+    for variant in generated:
+        assert os.path.exists(
+            os.path.join(app.config["UPLOAD_DIR"], variant["filename"]))
+    with app.test_request_context():
+        assert len(variants.get_image_variants(filename)["image/webp"]) == 3
+
+
+def test_variants_generated_in_background(app):
+    pytest.importorskip("PIL")
+    app.config["IMAGE_VARIANT_WORKERS"] = 1
+    filename = associate_example_image(app)
+    with app.app_context():
+        future = variants.generate_variants_in_background(filename)
+    assert future.result(timeout=10)
+
+
+def test_pages_invalidated_after_variants_generated(app, client):
+    pytest.importorskip("PIL")
+    filename = associate_example_image(app)
+    response = client.get("/1/detail")
+    assert b"srcset" not in response.data
+    etag = response.headers["ETag"]
+    app.config["IMAGE_VARIANT_WORKERS"] = 1
+    with app.app_context():
+        future = variants.generate_variants_in_background(filename)
+    future.result(timeout=10)
+    response = client.get("/1/detail")
+    assert response.headers["ETag"] != etag
+    assert b"srcset" in response.data
+
+
+def test_variants_disabled(app):
+    app.config["IMAGE_VARIANT_WORKERS"] = 0
+    with app.app_context():
+        assert variants.generate_variants_in_background("example.png") is None